@@ -1,17 +1,61 @@
-import boto3
 import logging
-import time
 import os
 import re
-from task_queue import TaskQueue, RetryException
+from concurrent.futures import ThreadPoolExecutor
+from task import Task
+from task_queue import TaskQueue, TRANSIENT, PERMANENT
 from s3 import S3
-from awsretry import AWSRetry
+from poll_scheduler import PollScheduler
+from run_history import RunHistory, predict_makespan
+from checkpoint import ControlCheckpointer
+from clock import SYSTEM_CLOCK
 
+from lib.clients import get_client
 from lib.log import setup_logger
+from lib.retry import aws_backoff
 from lib.notification import SlackNotification
+from lib import trace
 
 logger = setup_logger(__name__)
 
+# maximum number of ids accepted by athena batch_get_query_execution
+BATCH_GET_LIMIT = 50
+
+# number of threads used to list and delete files when cleaning up output prefixes
+CLEANUP_WORKERS = 8
+
+# errors that running the query again cannot fix, matched on the StateChangeReason of a failed query or the error
+# of the call that could not start it; any other error (throttling, internal errors...) is retried.
+# A query that hit a resource or time limit (EXCEEDED_..., exhausted resources, timed out) hits it again.
+PERMANENT_ERRORS = re.compile(r"SYNTAX_ERROR|mismatched input|TABLE_NOT_FOUND|SCHEMA_NOT_FOUND|COLUMN_NOT_FOUND|"
+                              r"FUNCTION_NOT_FOUND|NOT_SUPPORTED|TYPE_MISMATCH|does not exist|cannot be resolved|"
+                              r"AccessDenied|Access Denied|InvalidRequestException|ALREADY_EXISTS|"
+                              r"EXCEEDED_|exhausted resources|timed out", re.IGNORECASE)
+
+# scheduling policies: hour jobs in calendar order, or the longest expected run time first
+FIFO = "fifo"
+LONGEST_FIRST = "longest_first"
+
+# the placeholders of a sql template that reads a range of hours, see AthenaClient.add_range_query
+RANGE_PLACEHOLDERS = ("<start_date>", "<start_hour>", "<end_date>", "<end_hour>")
+
+
+def range_batching_error(data, sql):
+    """
+    Why the hour jobs of a step cannot be run as range queries, None if they can.
+    A range query has to read every hour of its range, through the RANGE_PLACEHOLDERS of the sql template,
+    and write partitioned output so each hour still lands in its own partition when the query succeeds.
+    :param data: the config data of the step
+    :param sql: the sql template read from s3
+    """
+    missing = [placeholder for placeholder in RANGE_PLACEHOLDERS if placeholder not in sql]
+    if missing:
+        return f"the sql template has no {', '.join(missing)}"
+    parquet = data.get('parquet') and data['parquet'] != "false"
+    if not (parquet and data.get('partition_by')) and "partitioned_by" not in sql.lower():
+        return "the output is not partitioned, set parquet and partition_by or write a partitioned_by table in the sql"
+    return None
+
 
 class AthenaClientError(Exception):
     """
@@ -30,34 +74,99 @@ class AthenaClient(TaskQueue):
     """
 
     def __init__(self, region='ap-southeast-2', db='default', max_queries=3, max_retries=3, timeout_minutes=10,
-                 sleep_seconds=10, workgroup='primary', control_s3=None, control_key=None, parquet=None, control_data=None):
+                 sleep_seconds=10, workgroup='primary', control_s3=None, control_key=None, parquet=None, control_data=None,
+                 adaptive_polling=False, min_sleep_seconds=1, max_sleep_seconds=60, poll_backoff=2,
+                 control_flush_seconds=0, control_store=None,
+                 scheduling_policy=FIFO, shared_slots=None, result_cache=None, resume=False,
+                 hedge_percentile=None, hedge_factor=2, scan_budget=None, metrics=None, clock=SYSTEM_CLOCK,
+                 retry_base_seconds=5, retry_max_seconds=300):
         """
         Create an AthenaClient
         :param region the AWS region to create the object
         :param max_queries the maximum number of queries to run at any one time, defaults to three
         :type max_queries int
-        :param max_retries the maximum number of times execution of the query will be retried on failure
+        :param max_retries the maximum number of times execution of the query will be retried on a transient failure
+                           (throttling, internal errors, S3 SlowDown), a query failing on a permanent error (syntax
+                           error, missing table) is not retried: its hour jobs are FAILED and the others keep running
         :type max_retries int
+        :param retry_base_seconds the back off before the first retry of a query, doubled on every retry, with jitter
+        :param retry_max_seconds the longest back off before a retry
+        :param adaptive_polling poll when queries are expected to finish, from the run times in the control data,
+                                instead of every sleep_seconds
+        :type adaptive_polling bool
+        :param poll_backoff with adaptive_polling, the factor the poll interval of a query running past its expected
+                            run time grows by, up to max_sleep_seconds
+        :param control_flush_seconds the minimum number of seconds between two uploads of the control file,
+                                     pending changes are always uploaded when the run ends
+        :param control_store the SegmentedControlStore the control data was loaded from, None for a single control file
+        :param scheduling_policy the order hour jobs are started in, FIFO or LONGEST_FIRST (from the run times in the control data)
+        :param shared_slots a QuerySlots budget of concurrent queries shared with other clients of the process
+        :param result_cache a loaded ResultCache, queries that succeeded recently are not run again
+                            (only queries that do not create a table)
+        :param resume leave the active queries running when the run ends early (timeout, shutdown, error), with their
+                      hour jobs QUEUED/RUNNING in the control file, so the next run can re-attach to them
+        :type resume bool
+        :param hedge_percentile when set, a query that runs hedge_factor times longer than this percentile of the
+                                past run times of its hours is started a second time, to a separate output location,
+                                if a slot is free. The first copy to succeed is kept and the other one is stopped
+                                and its output deleted. Queries that create a table are never duplicated.
+        :param scan_budget a ScanBudget, queries are started while their expected scanned bytes (the median
+                           dataScannedInBytes of their hours in the control data) fit in it
+        :param metrics a RunMetrics recording the statistics of every query and the slot occupancy
+        :param clock where the time is read from and slept on, a VirtualClock in simulations
         """
-        self.athena = boto3.client(service_name='athena', region_name=region)
+        if scheduling_policy not in (FIFO, LONGEST_FIRST):
+            raise AthenaClientError(
+                "unknown scheduling policy {}".format(scheduling_policy))
+        self.scheduling_policy = scheduling_policy
+        self.athena = get_client('athena', region)
         self.db_name = db
         self.workgroup = workgroup
         self.control_s3 = control_s3
         self.control_key = control_key
         self.parquet = parquet
         self.control_data = control_data
-        # self.interleaved_priority = False
+        self.checkpointer = ControlCheckpointer(
+            control_data, control_s3, control_key, control_flush_seconds, control_store, clock)
+        # the last task added for each table, so queries on the same table are chained
+        self._last_table_tasks = {}
+        # output prefixes to clean up before the queries run, in insertion order without duplicates
+        self._cleanup_prefixes = {}
+        self.result_cache = result_cache
+        self.resume = resume
+        self.metrics = metrics
+        self.hedge_percentile = hedge_percentile
+        self.hedge_factor = float(hedge_factor)
+        self.run_history = RunHistory(
+            control_data.date_list if control_data else None)
+
+        poll_scheduler = PollScheduler(sleep_seconds, min_sleep_seconds,
+                                       max_sleep_seconds, poll_backoff) if adaptive_polling else None
 
         super(AthenaClient, self).__init__(
-            max_queries, max_retries, timeout_minutes, sleep_seconds)
+            max_queries, max_retries, timeout_minutes, sleep_seconds, poll_scheduler, shared_slots,
+            retry_base_seconds, retry_max_seconds)
+        self.trace_name = control_key or self.trace_name
+        self.clock = clock
+        self.scan_budget = scan_budget
+
+    def _sort_key(self, task):
+        # queries that are already running in athena are re-attached first
+        attached = 0 if task.arguments.get('attach_id') else 1
+        if self.scheduling_policy == LONGEST_FIRST:
+            return (task.priority, attached, -(task.schedule_seconds or 0))
+        return (task.priority, attached)
 
     def __del__(self):
         """
         when deleting the instance, ensure that all associated tasks are stopped and do not enter the queue
         """
-        self.stop_and_delete_all_tasks()
+        if self.resume:
+            self.detach_all_tasks()
+        else:
+            self.stop_and_delete_all_tasks()
 
-    @AWSRetry.backoff(added_exceptions=["ThrottlingException"])
+    @aws_backoff(added_exceptions=["ThrottlingException"])
     def _update_task_status(self, task):
         """
         Gets the status of the query, and updates its status in the queue.
@@ -68,77 +177,307 @@ class AthenaClient(TaskQueue):
             task.name, task.arguments["output_location"]))
         execution_result = self.athena.get_query_execution(
             QueryExecutionId=task.id)["QueryExecution"]
+        self._apply_task_status(task, execution_result)
+
+    def _update_task_statuses(self, tasks):
+        """
+        Gets the status of all given queries with batch_get_query_execution, at most
+        BATCH_GET_LIMIT ids per call, and updates the status of each task.
+        Queries that athena could not process in the batch are checked one by one.
+        """
+        tasks_by_id = {task.id: task for task in tasks}
+        ids = list(tasks_by_id)
+        for i in range(0, len(ids), BATCH_GET_LIMIT):
+            response = self._batch_get_query_execution(
+                ids[i:i + BATCH_GET_LIMIT])
+
+            for execution_result in response.get("QueryExecutions", []):
+                task = tasks_by_id.get(execution_result["QueryExecutionId"])
+                if task:
+                    self._apply_task_status(task, execution_result)
+
+            for unprocessed in response.get("UnprocessedQueryExecutionIds", []):
+                logger.info("Query {0} was not processed in batch: {1}".format(
+                    unprocessed.get("QueryExecutionId"), unprocessed.get("ErrorMessage")))
+                task = tasks_by_id.get(unprocessed.get("QueryExecutionId"))
+                if task:
+                    self._update_task_status(task)
+
+    def _status_batches(self, tasks):
+        return [tasks[i:i + BATCH_GET_LIMIT] for i in range(0, len(tasks), BATCH_GET_LIMIT)]
+
+    @aws_backoff(added_exceptions=["ThrottlingException"])
+    def _batch_get_query_execution(self, ids):
+        logger.debug("...checking status of queries {0}".format(ids))
+        return self.athena.batch_get_query_execution(QueryExecutionIds=ids)
+
+    def _apply_task_status(self, task, execution_result):
+        """
+        Updates the task and its control hour job from a QueryExecution returned by athena
+        """
         status = execution_result["Status"]
-        statistics = execution_result["Statistics"]
+        statistics = execution_result.get("Statistics", {})
+        final = status["State"] not in ("RUNNING", "QUEUED")
+        if task.hedge is not None:
+            # the outcome of a query with a running duplicate is decided by _resolve_hedges
+            task.arguments['execution_result'] = execution_result
 
-        if task.arguments.get('hour_job'):
+        if task.hedge_of is not None:
+            logger.info(
+                f"Duplicate {task.id} of query {task.hedge_of.id} -> {status['State']}")
+            task.arguments['execution_result'] = execution_result
+        elif task.hedge is not None and final and status["State"] != "SUCCEEDED":
+            logger.info(
+                f"Query {task.id} -> {status['State']}, waiting for its duplicate {task.hedge.id}")
+        elif task.arguments.get('hour_job'):
             logger.info(
                 f"                          -> Date: {task.arguments['date_string']}, Hour: {str(task.arguments['hour_job']['hour']).zfill(2)}, Id: {task.id}, State: {task.arguments['hour_job']['state']}  -> {status['State']}, Scanned Data: {statistics.get('DataScannedInBytes' )}, Run Time: {statistics.get('EngineExecutionTimeInMillis')}, Start Time: {status['SubmissionDateTime']}  ")
 
-            task.arguments['hour_job']['state'] = status["State"]
-            task.arguments['hour_job']['startTime'] = str(
-                status["SubmissionDateTime"])
-            task.arguments['hour_job']['dataScannedInBytes'] = statistics.get(
-                "DataScannedInBytes")
-            task.arguments['hour_job']['runTimeInMillis'] = statistics.get(
-                'EngineExecutionTimeInMillis')
+            hour_jobs = task.arguments.get('hour_jobs') or [
+                (task.arguments['date_string'], task.arguments['hour_job'])]
+            for date_string, hour_job in hour_jobs:
+                if hour_job['state'] != status["State"]:
+                    self.checkpointer.mark_dirty(date_string, hour_job)
+                hour_job['state'] = status["State"]
+                hour_job['startTime'] = str(status["SubmissionDateTime"])
+                # a range query is shared evenly by its hour jobs, so run times stay comparable per hour
+                hour_job['dataScannedInBytes'] = self._share(
+                    statistics.get("DataScannedInBytes"), len(hour_jobs))
+                hour_job['runTimeInMillis'] = self._share(
+                    statistics.get('EngineExecutionTimeInMillis'), len(hour_jobs))
         else:
             logger.info(
                 f"""Running drop table query {task.arguments['sql']}""")
 
+        # only the copy that decides the outcome of a duplicated query is recorded, by _resolve_hedges
+        if self.metrics is not None and final and task.hedge is None and task.hedge_of is None:
+            self.metrics.record_query(task, execution_result,
+                                      kind="query" if task.arguments.get('hour_job') else "drop")
+
         if status["State"] == "RUNNING" or status["State"] == "QUEUED":
             task.is_complete = False
         elif status["State"] == "SUCCEEDED":
             task.is_complete = True
-            # refresh and persist control dict object
-            self._write_control()
+            if task.arguments.get('cache_key') and self.result_cache is not None:
+                self.result_cache.record(
+                    task.arguments['cache_key'], execution_result)
         else:
             if "StateChangeReason" in status:
                 task.error = status["StateChangeReason"]
             else:
                 task.error = status["State"]
 
-    def _write_control(self):
-        with open("control_output.json", "w") as f:
-            f.write(str(self.control_data))
+    def _classify_error(self, task):
+        """
+        Permanent if the error looks like the query failed on the sql, the data or a limit,
+        transient otherwise: errors that are not recognised (a cancelled query...) are retried as before
+        """
+        if PERMANENT_ERRORS.search(task.error or ""):
+            return PERMANENT
+        return TRANSIENT
 
-        self.control_s3.put("control_output.json", self.control_key)
+    def _back_off(self, task):
+        """
+        A re-attached query creating a table was started by the previous run without a drop of the table
+        in this one: its table is dropped before the query runs again, or the retry fails with ALREADY_EXISTS
+        """
+        super(AthenaClient, self)._back_off(task)
+        table_name = task.arguments.get('table_name')
+        if table_name and task.arguments.pop('reattached', False):
+            drop_task = self.add_task(name=task.name, priority=1,
+                                      args=self._drop_table_args(table_name))
+            self._run_after(task, drop_task)
+
+    def _task_failed(self, task):
+        """Marks the hour jobs of a query that failed for good, or depends on one that did, FAILED"""
+        hour_jobs = task.arguments.get('hour_jobs') or (
+            [(task.arguments['date_string'], task.arguments['hour_job'])] if task.arguments.get('hour_job') else [])
+        for date_string, hour_job in hour_jobs:
+            if hour_job['state'] != "FAILED":
+                hour_job['state'] = "FAILED"
+                self.checkpointer.mark_dirty(date_string, hour_job)
+
+    @staticmethod
+    def _share(value, parts):
+        if value is None or parts == 1:
+            return value
+        return value // parts
+
+    def _admit_pending_tasks(self):
+        admitted = super(AthenaClient, self)._admit_pending_tasks()
+        if self.hedge_percentile is not None:
+            admitted += self._admit_hedges()
+        return admitted
+
+    def _admit_hedges(self):
+        """
+        Duplicates the active queries running past their hedge_after, while there are free slots
+        that no pending task is ready to take. A duplicate scans as much as its query, so it is skipped
+        when the scan budget cannot take it. Returns the duplicates, which must then be started.
+        """
+        if self._pending_heap:
+            return []
+        now = self.clock.monotonic()
+        hedges = []
+        for task in list(self.active_queue):
+            if self.number_active >= self.max_size:
+                break
+            if task.hedge_after is None or task.hedged or task.started_at is None or task.id is None or \
+                    now - task.started_at < task.hedge_after:
+                continue
+            if self.shared_slots is not None and not self.shared_slots.try_acquire(self):
+                break
+            args = {key: value for key, value in task.arguments.items()
+                    if key not in ('hour_job', 'hour_jobs', 'cache_key', 'attach_id')}
+            hedge = Task(task.name, task.priority, args)
+            hedge.expected_bytes = task.expected_bytes
+            if self.scan_budget is not None and not self.scan_budget.try_admit(hedge):
+                if self.shared_slots is not None:
+                    self.shared_slots.release(self)
+                continue
+            hedge.hedge_of = task
+            task.hedge = hedge
+            task.hedged = True
+            logger.info("Query {0} of {1} is running for {2:.0f}s, more than {3:.0f}s, starting a duplicate".format(
+                task.id, task.name, now - task.started_at, task.hedge_after))
+            self._activate(hedge)
+            hedges.append(hedge)
+        return hedges
+
+    def _settle_active_queue(self):
+        self._resolve_hedges()
+        return super(AthenaClient, self)._settle_active_queue()
+
+    def _resolve_hedges(self):
+        """
+        Keeps the copy of a duplicated query that finishes first: the other one is stopped and its output deleted.
+        A query that fails while its duplicate still runs is replaced by the duplicate, which decides the outcome.
+        A duplicate that fails, or could not start, is dropped and the query carries on.
+        Both copies write to the output location of the query, each under its own query id.
+        """
+        for task in [task for task in self.active_queue if task.hedge is not None]:
+            hedge = task.hedge
+            if hedge.id is None and not hedge.error:
+                continue
+            succeeded = task.is_complete and not task.error
+            if hedge.is_complete and not hedge.error and not succeeded:
+                logger.info(
+                    f"Duplicate {hedge.id} finished before query {task.id}, keeping it")
+                self._drop_hedge(task)
+                self._adopt_query(task, hedge)
+                self._apply_task_status(
+                    task, hedge.arguments['execution_result'])
+            elif succeeded or hedge.error:
+                # a duplicate that could not start has no query to discard
+                if hedge.id is not None:
+                    self._discard_query(hedge.id, hedge.arguments["output_location"])
+                self._drop_hedge(task)
+                if task.arguments.get('execution_result') is not None:
+                    # the outcome of the query was held back while its duplicate ran
+                    self._apply_task_status(task, task.arguments.pop('execution_result'))
+            elif task.error:
+                logger.info(
+                    f"Query {task.id} failed while its duplicate {hedge.id} is running, keeping the duplicate")
+                self._drop_hedge(task)
+                self._adopt_query(task, hedge)
+                task.arguments.pop('execution_result', None)
+
+    def _drop_hedge(self, task):
+        """Removes the duplicate of a query from the active queue"""
+        hedge = task.hedge
+        task.hedge = None
+        self.active_queue.remove(hedge)
+        self._deactivate(hedge)
+
+    def _adopt_query(self, task, hedge):
+        """Makes the query of a duplicate the query of the task, the query of the task is stopped and its output deleted"""
+        self._discard_query(task.id, task.arguments["output_location"])
+        task.id = hedge.id
+        task.error = None
+        for _, hour_job in task.arguments.get('hour_jobs') or []:
+            hour_job['queryid'] = hedge.id
+
+    def _discard_query(self, query_id, output_location):
+        """Stops a query and deletes the files it wrote to its output location"""
+        logger.info(f"Stopping query {query_id} and deleting its output")
+        try:
+            self.athena.stop_query_execution(QueryExecutionId=query_id)
+        except Exception as e:
+            logger.info(f"Could not stop query {query_id} due to {e}")
+        bucket, _, prefix = output_location.replace("s3://", "").partition("/")
+        output_s3 = S3(bucket=bucket)
+        keys = sorted(output_s3.list_objects(f"{prefix.rstrip('/')}/{query_id}"))
+        errors = output_s3.delete_many(keys)
+        if errors:
+            logger.info(f"Could not delete the output of query {query_id}: {errors[:5]}")
+
+    @trace.traced("write control")
+    def _write_control(self, force=False):
+        """
+        Persists the control data if it changed, coalesced to one upload per poll cycle
+        (or per control_flush_seconds) unless force is set
+        """
+        self.checkpointer.flush(force)
+
+    def _end_poll_cycle(self):
+        self._write_control()
+        if self.metrics is not None:
+            self.metrics.record_poll(self.number_active, self.max_size)
 
     def _trigger_task(self, task):
         """
-        Runs a query in Athena
+        Runs a query in Athena, or re-attaches to the query of a previous run
         """
+        if task.arguments.get('attach_id'):
+            # only the first start re-attaches, a retry runs the query again
+            task.id = task.arguments.pop('attach_id')
+            task.arguments['reattached'] = True
+            logger.info("Re-attaching to query {0} of {1}".format(
+                task.id, task.name))
+            return
+
         logger.info("Starting query {0} to {1}".format(
             task.name, task.arguments["output_location"]))
 
-        if task.arguments.get('encryptQueryResults') and task.arguments['encryptQueryResults'].lower() != "false":
-            logger.info("Running encryption..")
-
-            task.id = self.athena.start_query_execution(
-                QueryString=task.arguments["sql"],
-                QueryExecutionContext={'Database': self.db_name},
-                ResultConfiguration={
-                    'OutputLocation': task.arguments["output_location"],
-                    'EncryptionConfiguration': {
-                        # 'SSE_S3'|'SSE_KMS'|'CSE_KMS'
-                        'EncryptionOption': task.arguments['encryptionType'],
-                        'KmsKey': task.arguments['encryptionKey']
-                    }
-                },
-                WorkGroup=self.workgroup)["QueryExecutionId"]
-
-            if task.arguments.get('hour_job'):
-                task.arguments['hour_job']['queryid'] = task.id
-        else:
-            task.id = self.athena.start_query_execution(
-                QueryString=task.arguments["sql"],
-                QueryExecutionContext={'Database': self.db_name},
-                ResultConfiguration={
-                    'OutputLocation': task.arguments["output_location"]},
-                WorkGroup=self.workgroup)["QueryExecutionId"]
-
-            if task.arguments.get('hour_job'):
-                task.arguments['hour_job']['queryid'] = task.id
+        try:
+            if task.arguments.get('encryptQueryResults') and task.arguments['encryptQueryResults'].lower() != "false":
+                logger.info("Running encryption..")
+
+                task.id = self.athena.start_query_execution(
+                    QueryString=task.arguments["sql"],
+                    QueryExecutionContext={'Database': self.db_name},
+                    ResultConfiguration={
+                        'OutputLocation': task.arguments["output_location"],
+                        'EncryptionConfiguration': {
+                            # 'SSE_S3'|'SSE_KMS'|'CSE_KMS'
+                            'EncryptionOption': task.arguments['encryptionType'],
+                            'KmsKey': task.arguments['encryptionKey']
+                        }
+                    },
+                    WorkGroup=self.workgroup)["QueryExecutionId"]
+            else:
+                task.id = self.athena.start_query_execution(
+                    QueryString=task.arguments["sql"],
+                    QueryExecutionContext={'Database': self.db_name},
+                    ResultConfiguration={
+                        'OutputLocation': task.arguments["output_location"]},
+                    WorkGroup=self.workgroup)["QueryExecutionId"]
+        except Exception as e:
+            code = (getattr(e, "response", None) or {}).get("Error", {}).get("Code")
+            if code is None:
+                raise
+            # the query is settled like a failed one, retried after a back off if the error is transient
+            logger.info("Could not start query {0}: {1}".format(task.name, e))
+            task.id = None
+            task.error = "{0}: {1}".format(code, e)
+            return
+
+        for date_string, hour_job in task.arguments.get('hour_jobs') or []:
+            hour_job['queryid'] = task.id
+            if self.resume and hour_job['state'] not in ("QUEUED", "RUNNING"):
+                # recorded as in flight straight away, so a run stopped before the next poll can re-attach to it
+                hour_job['state'] = "QUEUED"
+                self.checkpointer.mark_dirty(date_string, hour_job)
 
     def add_query(self, data, sql, hour_job):
         """
@@ -150,48 +489,103 @@ class AthenaClient(TaskQueue):
         :param hour job: a tuple with date_string and control_hour_job object
         :return:
         """
+        return self.add_range_query(data, sql, [hour_job])
+
+    def add_range_query(self, data, sql, hour_jobs, attach=False):
+        """
+        Adds one query for a run of consecutive hour jobs, see ControlData.pending_hour_ranges.
+        <start_date>/<start_hour> in the sql template are replaced by the first hour job and
+        <end_date>/<end_hour> by the last one, <date>/<hour> by the first one.
+        The results are written to the output location of the first hour job, and every hour job
+        is marked with the state of the query, its scanned data and run time split evenly between them.
+        :param data: the config data passed for running this query
+        :param sql: the sql template read from s3
+        :param hour_jobs: a list of (date_string, control_hour_job) tuples, in calendar order
+        :param attach: re-attach to the query of the hour jobs, still running from a previous run, instead of starting one.
+                       Its table is neither dropped nor its output cleaned up first.
+        :return: the query task, or None when the result cache already has the result
+        :raises AthenaClientError: for several hour jobs when the step cannot be batched, see range_batching_error
+        """
+
+        if len(hour_jobs) > 1 and not attach:
+            error = range_batching_error(data, sql)
+            if error:
+                raise AthenaClientError(
+                    f"Cannot run {len(hour_jobs)} hour jobs as one query: {error}")
 
         task_name = data['controlKey'].split("/")[0]
-        date_string = hour_job[0]
-        control_hour_job = hour_job[1]
+        date_string, control_hour_job = hour_jobs[0]
+        end_date_string, end_hour_job = hour_jobs[-1]
         hour_string = str(control_hour_job["hour"])
 
-        control_hour_job["workgroup"] = data.get("workgroup")
+        for _, range_hour_job in hour_jobs:
+            range_hour_job["workgroup"] = data.get("workgroup")
 
-        output_location = f"""{data['resultsLocation']}{date_string.split("-")[0]}/{date_string.split("-")[1]}/{date_string.split("-")[2]}/{hour_string.zfill(2)}"""
+        output_locations = [self._output_location(data, range_date_string, range_hour_job)
+                            for range_date_string, range_hour_job in hour_jobs]
+        output_location = output_locations[0]
 
+        sql = sql.replace("<start_date>", date_string).replace("<start_hour>", hour_string) \
+            .replace("<end_date>", end_date_string).replace("<end_hour>", str(end_hour_job["hour"]))
         sql = sql.replace("<date>", date_string).replace("<hour>", hour_string)
 
+        table_name = data.get('dropTableName')
+        temp_table = False
         if data.get('parquet') and data['parquet'] != "false":
             if "format='parquet'" in sql.lower():
                 raise AthenaClientError(
                     "ERROR: SQL script is already creating table with parquet output. Config file cannot accept parquet again")
 
-            if not data.get('dropTableName'):
+            if not table_name:
                 # raise AthenaClientError(
                 #     "Cannot output in Parquet without a drop table name")
+                # one temp table per hour, so hours do not wait on each other
+                table_name = self._temp_table_name(
+                    task_name, date_string, hour_string)
+                temp_table = True
                 logger.info(
-                    f"Creating a temp table temp.parquet_{task_name.replace('-','_')} for parquet file output")
-                self._add_drop_table_task(
-                    'temp.parquet_'+task_name.replace('-', '_'), task_name, output_location)
+                    f"Creating a temp table {table_name} for parquet file output")
 
-            sql = f"""CREATE TABLE { data['dropTableName'] if data.get('dropTableName') else 'temp.parquet_'+task_name.replace('-','') }
+            sql = f"""CREATE TABLE { table_name }
                 WITH (
                 { "partitioned_by = ARRAY[" + data.get('partition_by') +  "]," if data.get('partition_by') else "" } 
                 format='PARQUET',
                 parquet_compression = 'SNAPPY'
                 ) AS """+sql
 
+        cache_key = None
+        attach_id = control_hour_job['queryid'] if attach else None
+        if self.result_cache is not None and not table_name:
+            cache_key = self.result_cache.cache_key(
+                sql, self.db_name, self.workgroup, output_location)
+            entry = None if attach_id else self.result_cache.lookup(cache_key)
+            if entry is not None:
+                logger.info(
+                    f"Reusing query {entry['queryId']} for {date_string} hour {hour_string}, it succeeded with the same sql")
+                self._mark_cached(hour_jobs, entry)
+                return None
+
+        expected = [self.run_history.expected_runtime_seconds(range_hour_job["hour"])
+                    for _, range_hour_job in hour_jobs]
+        expected_seconds = sum(expected) if None not in expected else None
+
         # for cases when the script is creating table in parquet format but parquet in config is not true
         # and when parquet in config is true, and also specify dropTableName in config
-        if data.get('dropTableName'):
-            self._add_drop_table_task(
-                data.get('dropTableName'), task_name, output_location)
+        depends_on = None
+        if table_name and not attach_id:
+            depends_on = [self._add_drop_table_task(
+                table_name, task_name, output_location, schedule_seconds=expected_seconds)]
+            for range_output_location in output_locations[1:]:
+                self._add_cleanup_prefix(range_output_location)
 
         args = {"sql": sql,
                 "output_location": output_location,
                 "hour_job": control_hour_job,
                 "date_string": date_string,
+                "hour_jobs": hour_jobs,
+                "cache_key": cache_key,
+                "attach_id": attach_id,
+                "table_name": table_name,
                 "parquet": data.get('parquet'),
                 "dropTableName": data.get("dropTableName"),
                 "encryptQueryResults": data.get("encryptQueryResults"),
@@ -201,27 +595,110 @@ class AthenaClient(TaskQueue):
 
         query = self.add_task(name=task_name,
                               priority=1,
-                              args=args)
+                              args=args,
+                              expected_seconds=expected_seconds,
+                              depends_on=depends_on)
+
+        scanned = [self.run_history.expected_scan_bytes(range_hour_job["hour"])
+                   for _, range_hour_job in hour_jobs]
+        if any(bytes_ is not None for bytes_ in scanned):
+            query.expected_bytes = sum(bytes_ or 0 for bytes_ in scanned)
+
+        if self.hedge_percentile is not None and not table_name:
+            percentiles = [self.run_history.runtime_percentile_seconds(range_hour_job["hour"], self.hedge_percentile)
+                           for _, range_hour_job in hour_jobs]
+            if None not in percentiles:
+                query.hedge_after = self.hedge_factor * sum(percentiles)
+
+        if table_name:
+            self._last_table_tasks[table_name] = query
+        if temp_table:
+            # the temp table is only needed to write the parquet files, drop it once they are written
+            self._add_drop_table_task(table_name, task_name)
 
         return query
 
-    def _add_drop_table_task(self, table_name, task_name, output_location):
-        self.interleaved_priority = True
-        self.add_task(name=task_name,
-                      priority=0,
-                      args={"sql": f"DROP TABLE IF EXISTS {table_name}",
-                            "output_location": "s3://aws-athena-query-results-462463595486-ap-southeast-2"})
+    def _mark_cached(self, hour_jobs, entry):
+        """Marks the hour jobs as succeeded with the query of a result cache entry"""
+        for date_string, hour_job in hour_jobs:
+            hour_job['queryid'] = entry['queryId']
+            hour_job['state'] = "SUCCEEDED"
+            hour_job['dataScannedInBytes'] = self._share(
+                entry.get('dataScannedInBytes'), len(hour_jobs))
+            hour_job['runTimeInMillis'] = self._share(
+                entry.get('runTimeInMillis'), len(hour_jobs))
+            self.checkpointer.mark_dirty(date_string, hour_job)
+
+    @staticmethod
+    def _output_location(data, date_string, hour_job):
+        return f"""{data['resultsLocation']}{date_string.split("-")[0]}/{date_string.split("-")[1]}/{date_string.split("-")[2]}/{str(hour_job["hour"]).zfill(2)}"""
+
+    @staticmethod
+    def _temp_table_name(task_name, date_string, hour_string):
+        return f"temp.parquet_{task_name.replace('-', '_')}_{date_string.replace('-', '')}_{hour_string.zfill(2)}"
 
+    @trace.traced("add drop table task")
+    def _add_drop_table_task(self, table_name, task_name, output_location=None, schedule_seconds=None):
+        """
+        Adds a DROP TABLE task that runs after the last task added for the same table, once it is done:
+        it runs whether that task succeeded or failed for good, so one failed hour does not fail the next ones.
+        Queries of the same table therefore run one after the other, while other tables run in parallel.
+        The output location of the next query on the table, if given, is cleaned up by cleanup_output_prefixes.
+        schedule_seconds is the expected run time of the query the drop comes before, so it is scheduled like it.
+        Returns the drop table task.
+        """
+        previous_task = self._last_table_tasks.get(table_name)
+        drop_task = self.add_task(name=task_name,
+                                  priority=1,
+                                  args=self._drop_table_args(table_name),
+                                  runs_after=[previous_task] if previous_task else None,
+                                  schedule_seconds=schedule_seconds)
+        self._last_table_tasks[table_name] = drop_task
+
+        if output_location is not None:
+            self._add_cleanup_prefix(output_location)
+
+        return drop_task
+
+    @staticmethod
+    def _drop_table_args(table_name):
+        return {"sql": f"DROP TABLE IF EXISTS {table_name}",
+                "output_location": "s3://aws-athena-query-results-462463595486-ap-southeast-2"}
+
+    def _add_cleanup_prefix(self, output_location):
         # need clean up the files in the destination if outputing in the same path
-        print(f"Output location is : {output_location}")
         prefix = "/".join(output_location.replace("s3://",
                                                   "").split("/")[1:-1])
+        logger.debug(f"Output location {output_location} is cleaned up under prefix {prefix}")
+        self._cleanup_prefixes.setdefault(prefix, None)
 
-        print(f"prefix is : {prefix}")
-        files = list(self.control_s3.list_objects(prefix))
-        for f in files:
-            print("Deleting file : " + str(f))
-            self.control_s3.delete(f)
+    @trace.traced("cleanup output prefixes")
+    def cleanup_output_prefixes(self):
+        """
+        Deletes the files under every output prefix collected by _add_drop_table_task, once per prefix.
+        Prefixes are listed in parallel and files are deleted with batched delete_objects calls.
+        Raises AthenaClientError if some files could not be deleted.
+        """
+        prefixes = list(self._cleanup_prefixes)
+        self._cleanup_prefixes = {}
+        if not prefixes:
+            return
+
+        logger.info(
+            f"Cleaning up {len(prefixes)} output prefixes: {prefixes}")
+        with ThreadPoolExecutor(max_workers=min(len(prefixes), CLEANUP_WORKERS)) as executor:
+            keys = set().union(
+                *executor.map(self.control_s3.list_objects, prefixes))
+
+        errors = self.control_s3.delete_many(
+            sorted(keys), max_workers=CLEANUP_WORKERS)
+        logger.info(
+            f"Deleted {len(keys) - len(errors)} of {len(keys)} files under the output prefixes")
+        if errors:
+            msg = "Could not delete {} files, first errors: {}".format(
+                len(errors), errors[:5])
+            logger.error(msg)
+            raise AthenaClientError(msg)
 
     def wait_for_completion(self):
         """
@@ -229,13 +706,41 @@ class AthenaClient(TaskQueue):
         else wait for completion of any queries and also any pending parquet conversions.
         Will automatically remove all pending and stop all active queries upon completion.
         """
+        super(AthenaClient, self).wait_for_completion()
+
+    async def wait_for_completion_async(self):
+        """
+        wait_for_completion from an event loop, see TaskQueue.wait_for_completion_async.
+        Active queries are also stopped when the coroutine is cancelled.
+        """
+        expected = [task.schedule_seconds for task in self.pending_tasks
+                    if task.arguments.get('hour_job')]
+        known = [seconds for seconds in expected if seconds is not None]
+        if self.scheduling_policy == LONGEST_FIRST:
+            known.sort(reverse=True)
+        predicted_makespan = predict_makespan(known, self.max_size)
+        start_time = self.clock.monotonic()
         try:
-            super(AthenaClient, self).wait_for_completion()
+            await self._submit(self.cleanup_output_prefixes)
+            await super(AthenaClient, self).wait_for_completion_async()
 
         except Exception as e:
             raise e
         finally:
-            self.stop_and_delete_all_tasks()
+            # off the event loop, which may be driving the queues of other steps
+            await self._submit(self._finish_run)
+            if expected:
+                logger.info("Makespan with {} scheduling: predicted {:.0f}s ({} of {} hour jobs without history), actual {:.0f}s".format(
+                    self.scheduling_policy, predicted_makespan, expected.count(None), len(expected), self.clock.monotonic() - start_time))
+
+    def _finish_run(self):
+        """Saves the control file and the result cache, then stops the queries still running"""
+        if self.resume:
+            self.detach_all_tasks()
+        self._write_control(force=True)
+        if self.result_cache is not None:
+            self.result_cache.save()
+        self.stop_and_delete_all_tasks()
 
     @staticmethod
     def _get_table_name(s3_target):
@@ -254,9 +759,30 @@ class AthenaClient(TaskQueue):
         """
         while self.active_queue:
             task = self.active_queue.pop()
+            self._deactivate(task)
+            if task.id is None:
+                # admitted but never started
+                continue
             logger.info("Response while stop_query_execution with following QueryExecutionId {}; {}"
                         .format(task.id, self.athena.stop_query_execution(QueryExecutionId=task.id)))
 
+    def detach_all_tasks(self):
+        """
+        Removes pending and active tasks without stopping the active queries, which keep running in athena
+        and are re-attached by the next run in resume mode
+        :return: None
+        """
+        self._empty_pending_queue()
+        if self.active_queue:
+            logger.info("Leaving {} queries running for the next run: {}".format(
+                len(self.active_queue), [task.id for task in self.active_queue if task.id]))
+        while self.active_queue:
+            task = self.active_queue.pop()
+            self._deactivate(task)
+            if task.hedge_of is not None and task.id:
+                # duplicates are not recorded in the control file, the next run cannot re-attach to them
+                self._discard_query(task.id, task.arguments["output_location"])
+
     def stop_and_delete_all_tasks(self):
         """
         stops active tasks and removes pending tasks for a given client
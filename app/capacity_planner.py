@@ -0,0 +1,233 @@
+import asyncio
+import concurrent.futures
+import logging
+
+import numpy as np
+
+from athena import LONGEST_FIRST
+from clock import VirtualClock
+from lib.log import setup_logger
+from metrics import PERCENTILES
+from poll_scheduler import PollScheduler
+from task_queue import TaskQueue
+
+logger = setup_logger(__name__)
+
+# the price of athena in USD per TB scanned, and the least data billed for a query
+PRICE_PER_TB = 5.0
+MIN_BILLED_BYTES = 10 * 1024 ** 2
+
+
+class HourHistory:
+    """
+    The run times and data scanned of the SUCCEEDED hour jobs of control date lists, as numpy arrays
+    sorted by hour of the day, from which the queries of simulated runs are drawn.
+    A run time and the data scanned are drawn together, from the same past run.
+    """
+
+    def __init__(self, date_lists, history_days=90):
+        """
+        :param date_lists: control date lists, oldest day first, of one or more steps running the same query
+        :param history_days: the number of most recent days of each date list to use
+        """
+        hours, runtimes, scanned = [], [], []
+        for date_list in date_lists:
+            hour_jobs = [hour_job for day in (date_list or [])[-int(history_days):] for hour_job in day["hourlist"]
+                         if hour_job["state"] == "SUCCEEDED" and hour_job["runTimeInMillis"] is not None]
+            hours.append(np.fromiter((int(hour_job["hour"]) for hour_job in hour_jobs),
+                                     dtype=np.int64, count=len(hour_jobs)))
+            runtimes.append(np.fromiter((hour_job["runTimeInMillis"] for hour_job in hour_jobs),
+                                        dtype=np.float64, count=len(hour_jobs)))
+            scanned.append(np.fromiter((hour_job["dataScannedInBytes"] if hour_job["dataScannedInBytes"] is not None
+                                        else np.nan for hour_job in hour_jobs),
+                                       dtype=np.float64, count=len(hour_jobs)))
+
+        hours = np.concatenate(hours) if hours else np.zeros(0, dtype=np.int64)
+        order = np.argsort(hours, kind="stable")
+        self.runtime_seconds = (np.concatenate(runtimes)[order] / 1000.0) if runtimes else np.zeros(0)
+        self.scanned_bytes = np.concatenate(scanned)[order] if scanned else np.zeros(0)
+        self.counts = np.bincount(hours, minlength=24)[:24]
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)[:-1]))
+
+        # what the runner expects of each hour, the median of its history like RunHistory
+        self.median_seconds = np.array([np.median(self.runtime_seconds[offset:offset + count]) if count else np.nan
+                                        for offset, count in zip(self.offsets, self.counts)])
+        self.median_bytes = np.array([np.nanmedian(self.scanned_bytes[offset:offset + count])
+                                      if count and not np.isnan(self.scanned_bytes[offset:offset + count]).all()
+                                      else np.nan for offset, count in zip(self.offsets, self.counts)])
+
+    def __len__(self):
+        return len(self.runtime_seconds)
+
+    def sample(self, hours, trials, rng):
+        """
+        Draws the run time and data scanned of the queries of many runs at once.
+        An hour that never succeeded is drawn from the history of all hours.
+        :param hours: the hour of the day of each query of a run
+        :param trials: the number of runs
+        :param rng: a numpy random Generator
+        :return: two (trials, len(hours)) arrays, run times in seconds and bytes scanned (nan if unknown)
+        """
+        if not len(self):
+            raise ValueError("There is no SUCCEEDED hour job with a runTimeInMillis to simulate from")
+        hours = np.asarray(hours, dtype=np.int64) % 24
+        counts, offsets = self.counts[hours], self.offsets[hours]
+        never = counts == 0
+        counts = np.where(never, len(self), counts)
+        offsets = np.where(never, 0, offsets)
+        index = offsets + (rng.random((int(trials), len(hours))) * counts).astype(np.int64)
+        return self.runtime_seconds[index], self.scanned_bytes[index]
+
+    def expected(self, hours):
+        """The expected run time and bytes scanned of each hour, falling back to the median of all hours"""
+        hours = np.asarray(hours, dtype=np.int64) % 24
+        seconds = self.median_seconds[hours]
+        seconds = np.where(np.isnan(seconds), np.median(self.runtime_seconds), seconds)
+        scanned = self.median_bytes[hours]
+        if not np.isnan(self.scanned_bytes).all():
+            scanned = np.where(np.isnan(scanned), np.nanmedian(self.scanned_bytes), scanned)
+        return seconds, scanned
+
+
+class _InlineExecutor(concurrent.futures.Executor):
+    """Runs the calls of a simulated queue at once, on the event loop thread, there is no aws call to wait for"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+class SimulatedQueue(TaskQueue):
+    """
+    A TaskQueue on a VirtualClock whose tasks are queries that complete args["runtime"] seconds after they start.
+    Slot filling, the order of pending tasks, the poll cadence and the scan budget are those of the real queue,
+    so a run of the same tasks takes the same (virtual) time as it would in athena with those run times.
+    """
+
+    def __init__(self, max_size, sleep_seconds, poll_scheduler=None, scheduling_policy=None, clock=None):
+        # the timeout is checked by the planner on the makespan, the queue runs every task to the end
+        super(SimulatedQueue, self).__init__(max_size, retry_limit=0, timeout_minutes=10 ** 9,
+                                             sleep_seconds=sleep_seconds, poll_scheduler=poll_scheduler)
+        self.scheduling_policy = scheduling_policy
+        self.clock = clock or VirtualClock()
+        self.executor = _InlineExecutor()
+
+    def _sort_key(self, task):
+        if self.scheduling_policy == LONGEST_FIRST:
+            return (task.priority, -(task.schedule_seconds or 0))
+        return (task.priority,)
+
+    def _trigger_task(self, task):
+        task.id = f"simulated-{task.sequence}"
+        task.arguments["completes_at"] = self.clock.monotonic() + task.arguments["runtime"]
+
+    def _update_task_status(self, task):
+        if self.clock.monotonic() >= task.arguments["completes_at"]:
+            task.is_complete = True
+
+
+class CapacityPlanner:
+    """
+    What-if runs of a config step: the queries of a run are drawn from its history (HourHistory) for many trials,
+    and each trial is run through a SimulatedQueue for every setting of maxQueries and the poll settings swept.
+    Reports the makespan percentiles, the probability of running past timeoutMinutes and the scan cost.
+    Failures and retries are not simulated, every query succeeds after a past successful run time.
+    """
+
+    def __init__(self, history, hours, trials=100, seed=0, scheduling_policy=None, scan_budget=None):
+        """
+        :param history: the HourHistory of the step
+        :param hours: the hour of the day of each query of a run, range(24) for a daily run
+        :param trials: the number of runs simulated per setting
+        :param seed: the seed of the random draws, the same draws are used for every setting
+        :param scheduling_policy: the schedulingPolicy of the step
+        :param scan_budget: a function of a clock returning the ScanBudget of a run, or None for no budget
+        """
+        self.hours = list(hours)
+        self.scheduling_policy = scheduling_policy
+        self.scan_budget = scan_budget
+        self.runtimes, self.scanned = history.sample(
+            self.hours, trials, np.random.default_rng(seed))
+        self.expected_seconds, self.expected_bytes = history.expected(self.hours)
+
+    def scan_cost(self):
+        """The mean GB scanned by a run and its cost in USD"""
+        scanned = np.nan_to_num(self.scanned, nan=0.0)
+        billed = np.maximum(scanned, MIN_BILLED_BYTES).sum(axis=1)
+        return float(scanned.sum(axis=1).mean()) / 1024 ** 3, float(billed.mean()) / 1024 ** 4 * PRICE_PER_TB
+
+    def _run(self, runtimes, max_queries, sleep_seconds, poll_scheduler):
+        clock = VirtualClock()
+        queue = SimulatedQueue(max_queries, sleep_seconds, poll_scheduler,
+                               self.scheduling_policy, clock)
+        if self.scan_budget is not None:
+            queue.scan_budget = self.scan_budget(clock)
+        for hour, runtime, expected_seconds, expected_bytes in zip(self.hours, runtimes, self.expected_seconds,
+                                                                   self.expected_bytes):
+            task = queue.add_task(str(hour), 1, {"runtime": float(runtime)},
+                                  expected_seconds=float(expected_seconds))
+            task.expected_bytes = None if np.isnan(expected_bytes) else float(expected_bytes)
+        asyncio.run(queue.wait_for_completion_async())
+        return clock.monotonic()
+
+    def simulate(self, max_queries, sleep_seconds, adaptive_polling=False, min_sleep_seconds=1, max_sleep_seconds=60,
+                 poll_backoff=2):
+        """
+        :return: the makespan in seconds of every trial
+        """
+        makespans = np.empty(len(self.runtimes))
+        # the queue logs every poll, thousands of simulated runs would drown the log.
+        # A stricter level set by the caller is kept, and restored as it was afterwards
+        previous_disable = logging.root.manager.disable
+        logging.disable(max(previous_disable, logging.INFO))
+        try:
+            for trial, runtimes in enumerate(self.runtimes):
+                poll_scheduler = PollScheduler(sleep_seconds, min_sleep_seconds, max_sleep_seconds, poll_backoff) \
+                    if adaptive_polling else None
+                makespans[trial] = self._run(
+                    runtimes, max_queries, sleep_seconds, poll_scheduler)
+        finally:
+            logging.disable(previous_disable)
+        return makespans
+
+    def sweep(self, max_queries_values, sleep_seconds_values, timeout_minutes, adaptive_polling_values=(False,),
+              min_sleep_seconds=1, max_sleep_seconds=60, poll_backoff=2):
+        """
+        Simulates every combination of the settings
+        :return: a row per setting, with the makespan percentiles in minutes and the probability of a timeout
+        """
+        scan_gb, scan_cost = self.scan_cost()
+        rows = []
+        for max_queries in max_queries_values:
+            for adaptive_polling in adaptive_polling_values:
+                for sleep_seconds in sleep_seconds_values:
+                    makespans = self.simulate(max_queries, sleep_seconds, adaptive_polling,
+                                              min_sleep_seconds, max_sleep_seconds, poll_backoff)
+                    row = {"maxQueries": max_queries,
+                           "sleepSeconds": sleep_seconds,
+                           "adaptivePolling": adaptive_polling}
+                    for p in PERCENTILES:
+                        row[f"makespanMinutes p{p}"] = round(
+                            float(np.percentile(makespans, p)) / 60, 1)
+                    row["P(timeout)"] = round(
+                        float(np.mean(makespans > float(timeout_minutes) * 60)), 3)
+                    row["scanGB"] = round(scan_gb, 1)
+                    row["scanCostUSD"] = round(scan_cost, 2)
+                    rows.append(row)
+                    logger.info(f"Simulated {row}")
+        return rows
+
+
+def format_rows(rows):
+    """The rows of CapacityPlanner.sweep as a text table"""
+    if not rows:
+        return ""
+    columns = list(rows[0])
+    widths = [max(len(column), *(len(str(row[column])) for row in rows)) for column in columns]
+    lines = ["  ".join(column.rjust(width) for column, width in zip(columns, widths))]
+    lines += ["  ".join(str(row[column]).rjust(width) for column, width in zip(columns, widths)) for row in rows]
+    return "\n".join(lines)
@@ -0,0 +1,104 @@
+from clock import SYSTEM_CLOCK
+from lib.log import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class ControlCheckpointer:
+    """
+    Write-behind persistence of the control data.
+    State changes only mark the control data dirty; flush() uploads it at most once
+    per min_interval_seconds, and flush(force=True) uploads any pending change right away.
+    The control data is serialized compactly and uploaded from memory.
+    With a SegmentedControlStore, only the changed hour jobs are appended to its journal,
+    and the store is compacted when the journal is long enough and on the forced flush.
+    """
+
+    def __init__(self, control_data, control_s3, control_key, min_interval_seconds=0, store=None, clock=SYSTEM_CLOCK):
+        """
+        :param control_data: the ControlData to persist
+        :param control_s3: the S3 object of the control bucket
+        :param control_key: the key of the control file
+        :param min_interval_seconds: the minimum number of seconds between two uploads
+        :param store: the SegmentedControlStore the control data was loaded from, if any
+        :param clock: where the time between uploads is read from
+        """
+        self.control_data = control_data
+        self.control_s3 = control_s3
+        self.control_key = control_key
+        self.min_interval_seconds = float(min_interval_seconds or 0)
+        self.store = store
+        self.clock = clock
+        self.dirty = False
+        self.uploads = 0
+        self._last_upload = None
+        self._changes = {}
+        # the days and hours appended to the control data are journaled like any other change
+        for date_string, hour_job in getattr(control_data, "appended_hour_jobs", None) or []:
+            self.mark_dirty(date_string, hour_job)
+
+    def mark_dirty(self, date_string=None, hour_job=None):
+        """
+        :param date_string: the date of the changed hour job
+        :param hour_job: the changed hour job, recorded for the journal of a segmented store
+        """
+        self.dirty = True
+        if hour_job is not None:
+            self._changes[self._change_key(date_string, hour_job)] = (
+                date_string, hour_job)
+
+    @staticmethod
+    def _change_key(date_string, hour_job):
+        # an hour that is in the control file twice is journaled once per copy
+        return (date_string, hour_job["hour"], getattr(hour_job, "occurrence", 0))
+
+    def flush(self, force=False):
+        """
+        Uploads the control data if it changed since the last upload.
+        :param force: upload even if the last upload was less than min_interval_seconds ago
+        :return: True if the control data was uploaded
+        """
+        if self.control_data is None:
+            return False
+        if not self.dirty and not (force and self.store is not None and
+                                   (self.store.needs_compaction or self.store.journal_keys)):
+            return False
+
+        now = self.clock.monotonic()
+        if not force and self._last_upload is not None and now - self._last_upload < self.min_interval_seconds:
+            return False
+
+        # clear the flag first so changes made during the upload are picked up by the next flush
+        self.dirty = False
+        if self.store is not None:
+            uploaded = self._flush_store(force)
+        else:
+            body = self.control_data.to_json().encode("utf-8")
+            uploaded = self.control_s3.put_bytes(body, self.control_key)
+            if uploaded:
+                logger.info(
+                    f"Checkpointed control file {self.control_key} ({len(body)} bytes)")
+
+        if not uploaded:
+            self.dirty = True
+            return False
+
+        self._last_upload = now
+        self.uploads += 1
+        return True
+
+    def _flush_store(self, force):
+        changes, self._changes = list(self._changes.values()), {}
+        try:
+            if force or self.store.compaction_due:
+                self.store.compact(self.control_data.date_list)
+            else:
+                self.store.append_journal(changes)
+        except Exception as e:
+            logger.info(
+                f"Could not checkpoint control store {self.control_key} due to {e}")
+            for date_string, hour_job in changes:
+                self._changes.setdefault(
+                    self._change_key(date_string, hour_job), (date_string, hour_job))
+            return False
+        return True
@@ -0,0 +1,38 @@
+import asyncio
+import time
+
+
+class SystemClock:
+    """The real time, time.monotonic and asyncio.sleep"""
+
+    @staticmethod
+    def monotonic():
+        return time.monotonic()
+
+    @staticmethod
+    async def sleep(seconds):
+        await asyncio.sleep(seconds)
+
+
+class VirtualClock:
+    """
+    A clock that only moves when it is slept on or advanced, so a simulated run of hours takes no real time.
+    Meant for a single task queue at a time: every sleep moves the clock for everyone using it.
+    """
+
+    def __init__(self, start=0.0):
+        self.now = float(start)
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += max(float(seconds), 0.0)
+
+    async def sleep(self, seconds):
+        self.advance(seconds)
+        # still give the event loop a turn, like a real sleep
+        await asyncio.sleep(0)
+
+
+SYSTEM_CLOCK = SystemClock()
@@ -3,6 +3,16 @@ import os
 from lib.log import setup_logger
 
 
+def flag(data, key):
+    """
+    Whether an optional "true"/"false" string setting is switched on in a config step
+    """
+    value = data.get(key)
+    if isinstance(value, str):
+        return value.lower() not in ("", "false")
+    return bool(value)
+
+
 class Config(object):
     def __init__(self, configPath):
         self.logger = setup_logger(__name__)
@@ -1,6 +1,8 @@
 
 from lib.log import setup_logger
 from lib.notification import SlackNotification
+from hour_job import HourJob, HourJobIndex, to_json_default
+from collections import Counter
 import datetime
 
 import json
@@ -18,11 +20,84 @@ class ControlData:
 
         self.slackBot = SlackNotification(__name__)
 
+        # the hour jobs read from the control file, to tell the ones appended below apart
+        # counted, as a controlDisabled run appends the current hour again when it is already in the file
+        loaded = Counter((self.date_string(day), int(hour_job["hour"]))
+                         for day in (control_dict or {}).get("datelist") or [] for hour_job in day["hourlist"])
+
         if config_data.get("controlDisabled"):
             self._append_control_date_with_control_disable_config()
         else:
             self._append_control_date_with_control_enable_config()
 
+        self._index_hour_jobs()
+        # (date string, hour job) of every hour job this run added, persisted with the first checkpoint
+        self.appended_hour_jobs = []
+        for day in getattr(self, "date_list", []):
+            for hour_job in day["hourlist"]:
+                key = (self.date_string(day), int(hour_job["hour"]))
+                if loaded[key] > 0:
+                    loaded[key] -= 1
+                else:
+                    self.appended_hour_jobs.append((key[0], hour_job))
+
+    def _index_hour_jobs(self):
+        # replace the hour job dicts with HourJob objects and index them
+        self.index = HourJobIndex()
+        for day in getattr(self, "date_list", []):
+            date_string = self.date_string(day)
+            day["hourlist"] = [hour_job if isinstance(hour_job, HourJob) else HourJob.from_dict(date_string, hour_job)
+                               for hour_job in day["hourlist"]]
+            for hour_job in day["hourlist"]:
+                self.index.add(hour_job)
+
+    @staticmethod
+    def date_string(day):
+        return f"{day['year']}-{day['month']}-{day['day']}"
+
+    def hour_job(self, date_string, hour):
+        """The last hour job of the given date and hour, or None"""
+        return self.index.get(date_string, hour)
+
+    def pending_hour_jobs(self):
+        """
+        (date string, hour job) tuples of every hour job that has not succeeded, in calendar order
+        """
+        hour_jobs = sorted(self.index.not_in_state("SUCCEEDED"),
+                           key=lambda hour_job: (tuple(int(part) for part in hour_job.date.split("-")), int(hour_job.hour),
+                                                 hour_job.occurrence))
+        return [(hour_job.date, hour_job) for hour_job in hour_jobs]
+
+    @staticmethod
+    def in_flight(hour_job):
+        """Whether the query of the hour job was still queued or running when the control file was written"""
+        return hour_job["state"] in ("QUEUED", "RUNNING") and bool(hour_job.get("queryid"))
+
+    def pending_hour_ranges(self, max_hours=24, keep_in_flight=False):
+        """
+        The pending hour jobs grouped into runs of consecutive hours, in calendar order.
+        A run ends at a gap of more than one hour or after max_hours hour jobs.
+        :param keep_in_flight: keep the in-flight hour jobs of one query together, in a run of their own
+        :return: a list of lists of (date string, hour job) tuples
+        """
+        max_hours = max(int(max_hours), 1)
+        ranges = []
+        previous = None
+        for date_string, hour_job in self.pending_hour_jobs():
+            year, month, day = (int(part) for part in date_string.split("-"))
+            start = datetime.datetime(year, month, day) + \
+                datetime.timedelta(hours=int(hour_job["hour"]))
+            if keep_in_flight and ranges and (self.in_flight(hour_job) or self.in_flight(ranges[-1][-1][1])):
+                joins = self.in_flight(hour_job) and ranges[-1][-1][1]["queryid"] == hour_job["queryid"]
+            else:
+                joins = ranges and len(ranges[-1]) < max_hours and start - previous == datetime.timedelta(hours=1)
+            if joins:
+                ranges[-1].append((date_string, hour_job))
+            else:
+                ranges.append([(date_string, hour_job)])
+            previous = start
+        return ranges
+
     def _append_control_date_with_control_disable_config(self):
         # check if the control_dict is None (e.g. no control.json file exist in s3 bucket)
         # if no control.json file , return a new controlData object with a new date list and then append today's date to it
@@ -105,5 +180,9 @@ class ControlData:
             "hourlist": hourlist
         }
 
+    def to_json(self):
+        """Compact serialization used when persisting the control file"""
+        return json.dumps({"datelist": self.date_list}, separators=(",", ":"), default=to_json_default)
+
     def __str__(self):
-        return json.dumps({"datelist": self.date_list}, indent=4)
+        return json.dumps({"datelist": self.date_list}, indent=4, default=to_json_default)
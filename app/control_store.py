@@ -0,0 +1,191 @@
+import json
+
+from hour_job import to_json_default
+
+from lib.log import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class SegmentedControlStore:
+    """
+    Stores a control file as per-month segments plus an append-only journal, under the
+    control key without its .json extension:
+    index.json          - the list of segments, the segments that still have unfinished hour jobs
+                          ("open" segments) and the last journal sequence folded into the segments
+    segments/YYYY-MM.json - the datelist of one month
+    journal/NNNNNNNNNNNN.json - the hour jobs changed by one checkpoint
+    Loading only reads the open segments, the latest segment and the journal, so the cost of a run
+    depends on the pending work and not on the length of the history.
+    Compaction rewrites the loaded segments and the index, then deletes the journal.
+    """
+
+    def __init__(self, control_s3, control_key, compact_every=20):
+        """
+        :param control_s3: the S3 object of the control bucket
+        :param control_key: the key of the legacy control file, the store lives next to it
+        :param compact_every: the number of journal entries that triggers a compaction
+        :type compact_every int
+        """
+        self.control_s3 = control_s3
+        self.control_key = control_key
+        self.base = (control_key[:-len(".json")]
+                     if control_key.endswith(".json") else control_key).rstrip("/") + "/"
+        self.compact_every = int(compact_every)
+        self.index = {"version": 1, "segments": [],
+                      "openSegments": [], "journalSeq": 0}
+        self.last_seq = 0
+        self.journal_keys = []
+        self.needs_compaction = False
+
+    @staticmethod
+    def segment_of(day):
+        return f"{int(day['year']):04d}-{int(day['month']):02d}"
+
+    @staticmethod
+    def date_of(day):
+        return f"{day['year']}-{day['month']}-{day['day']}"
+
+    def _index_key(self):
+        return self.base + "index.json"
+
+    def _segment_key(self, segment):
+        return self.base + "segments/" + segment + ".json"
+
+    def _journal_prefix(self):
+        return self.base + "journal/"
+
+    def _get_json(self, key):
+        body = self.control_s3.get_bytes(key)
+        if body is None:
+            return None
+        return json.loads(body)
+
+    def _put_json(self, key, data):
+        if not self.control_s3.put_bytes(json.dumps(data, separators=(",", ":"), default=to_json_default).encode("utf-8"), key):
+            raise IOError(f"Could not write s3://{self.control_s3.bucket}/{key}")
+
+    def load(self):
+        """
+        Reads the open segments and replays the journal.
+        Falls back to the legacy control file when the store does not exist yet.
+        :return: a control dict with the datelist of the loaded segments, oldest day first
+        """
+        index = self._get_json(self._index_key())
+        if index is None:
+            legacy = self._get_json(self.control_key)
+            date_list = (legacy.get("datelist") or []) if legacy else []
+            logger.info(
+                f"No segmented control store at {self.base}, starting from the legacy control file ({len(date_list)} days)")
+            self.needs_compaction = True
+            return {"datelist": date_list}
+
+        self.index = index
+        self.last_seq = index["journalSeq"]
+        segments = set(index["openSegments"])
+        if index["segments"]:
+            segments.add(index["segments"][-1])
+
+        days = {}
+        for segment in sorted(segments):
+            self._load_segment(segment, days)
+
+        self._replay_journal(days)
+        # a journal left behind by an interrupted run is folded in at the end of this run
+        self.needs_compaction = bool(self.journal_keys)
+
+        logger.info(
+            f"Loaded {len(segments)} of {len(index['segments'])} control segments and {len(self.journal_keys)} journal entries")
+        return {"datelist": [days[date] for date in sorted(days, key=self._date_sort_key)]}
+
+    @staticmethod
+    def _date_sort_key(date_string):
+        return tuple(int(part) for part in date_string.split("-"))
+
+    def _load_segment(self, segment, days):
+        data = self._get_json(self._segment_key(segment)) or {"datelist": []}
+        for day in data["datelist"]:
+            days[self.date_of(day)] = day
+
+    def _replay_journal(self, days):
+        loaded_segments = set(self.segment_of(day) for day in days.values())
+        for key in sorted(self.control_s3.list_objects(self._journal_prefix())):
+            seq = int(key.split("/")[-1].split(".")[0])
+            if seq <= self.index["journalSeq"]:
+                # already folded into the segments by a compaction that could not delete it
+                continue
+            self.journal_keys.append(key)
+            self.last_seq = max(self.last_seq, seq)
+
+            for change in (self._get_json(key) or {}).get("changes", []):
+                year, month, day_of_month = change["date"].split("-")
+                day_job = {"year": year, "month": month, "day": day_of_month}
+                segment = self.segment_of(day_job)
+                if segment not in loaded_segments and segment in self.index["segments"]:
+                    self._load_segment(segment, days)
+                    loaded_segments.add(segment)
+
+                day = days.setdefault(self.date_of(day_job), dict(
+                    day_job, hourlist=[]))
+                hour_jobs = [hour_job for hour_job in day["hourlist"]
+                             if int(hour_job["hour"]) == int(change["job"]["hour"])]
+                occurrence = change.get("occurrence", 0)
+                if occurrence < len(hour_jobs):
+                    hour_jobs[occurrence].update(change["job"])
+                else:
+                    day["hourlist"].append(dict(change["job"]))
+
+    def append_journal(self, changes):
+        """
+        Writes the changed hour jobs as the next journal entry.
+        An hour job that is not the first of its date and hour in the control file is written with its occurrence.
+        :param changes: a list of (date string, hour job dict) tuples
+        """
+        if not changes:
+            return
+        seq = self.last_seq + 1
+        key = self._journal_prefix() + f"{seq:012d}.json"
+        self._put_json(key, {"changes": [self._change(date_string, hour_job) for date_string, hour_job in changes]})
+        self.last_seq = seq
+        self.journal_keys.append(key)
+        logger.info(
+            f"Appended {len(changes)} hour jobs to control journal entry {seq}")
+
+    @staticmethod
+    def _change(date_string, hour_job):
+        change = {"date": date_string, "job": hour_job}
+        occurrence = getattr(hour_job, "occurrence", 0)
+        if occurrence:
+            change["occurrence"] = occurrence
+        return change
+
+    @property
+    def compaction_due(self):
+        return self.needs_compaction or len(self.journal_keys) >= self.compact_every
+
+    def compact(self, date_list):
+        """
+        Rewrites the segments of the loaded days and the index, then deletes the journal entries.
+        :param date_list: the control date list loaded from this store, with its changes applied
+        """
+        segments = {}
+        for day in date_list:
+            segments.setdefault(self.segment_of(day), []).append(day)
+
+        for segment, days in segments.items():
+            self._put_json(self._segment_key(segment), {"datelist": days})
+
+        self.index["segments"] = sorted(
+            set(self.index["segments"]) | set(segments))
+        self.index["openSegments"] = sorted(
+            segment for segment, days in segments.items()
+            if any(hour_job["state"] != "SUCCEEDED" for day in days for hour_job in day["hourlist"]))
+        self.index["journalSeq"] = self.last_seq
+        self._put_json(self._index_key(), self.index)
+
+        for key in self.journal_keys:
+            self.control_s3.delete(key)
+        logger.info(
+            f"Compacted control store {self.base}: {len(segments)} segments written, {len(self.journal_keys)} journal entries removed, open segments {self.index['openSegments']}")
+        self.journal_keys = []
+        self.needs_compaction = False
@@ -0,0 +1,77 @@
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+from lib.log import setup_logger
+from lib.notification import SlackNotification
+from query_slots import FairQuerySlots
+
+logger = setup_logger(__name__)
+slackBot = SlackNotification(__name__)
+
+
+class FleetError(Exception):
+    pass
+
+
+class Fleet:
+    """
+    Runs many configs in one process, under one budget of concurrent athena queries.
+    Slots are shared weighted-fair between the configs: "fleetWeight" in a config (default 1) is its share,
+    and "fleetMaxQueries" caps the queries of that config whatever the free slots. maxQueries of each
+    step still caps the step. A config that fails does not stop the others, the failures are raised at the end.
+    """
+
+    def __init__(self, config_paths, max_queries, waiting_seconds=60):
+        """
+        :param config_paths: the config files to run
+        :param max_queries: the number of athena queries run at the same time across all configs
+        :param waiting_seconds: how long a config refused a slot keeps priority for the next free one
+        """
+        self.config_paths = list(config_paths)
+        self.slots = FairQuerySlots(max_queries, waiting_seconds)
+
+    @staticmethod
+    def find_configs(configs_dir, name="prod.json"):
+        """The config files called name in configs_dir and its sub directories"""
+        return sorted(glob.glob(os.path.join(configs_dir, "**", name), recursive=True))
+
+    def run_one(self, path):
+        data = Config(path).data
+        if "steps" not in data:
+            # a single step config
+            data = {"steps": [data]}
+        account = self.slots.account(path, weight=data.get("fleetWeight", 1),
+                                     max_queries=data.get("fleetMaxQueries"))
+        logger.info(f"Starting config {path}, weight {account.weight}, "
+                    f"max queries {account.max_queries or 'unlimited'}")
+
+        # imported here, run imports this module for its fleet mode
+        from run import run_config
+        try:
+            run_config(data, account)
+        finally:
+            account.done()
+
+    def run(self):
+        if not self.config_paths:
+            logger.info("No configs to run")
+            return
+
+        logger.info(f"Running {len(self.config_paths)} configs, "
+                    f"{self.slots.max_queries} queries at a time")
+        failed = []
+        with ThreadPoolExecutor(max_workers=len(self.config_paths)) as executor:
+            futures = {path: executor.submit(self.run_one, path) for path in self.config_paths}
+            for path, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.exception(f"Config {path} failed: {e}")
+                    slackBot.warn(f"Config {path} failed: {e}")
+                    failed.append(path)
+
+        if failed:
+            raise FleetError(f"{len(failed)} of {len(self.config_paths)} configs failed: {', '.join(failed)}")
+        logger.info(f"All {len(self.config_paths)} configs finished")
@@ -0,0 +1,177 @@
+from lib.log import setup_logger
+
+logger = setup_logger(__name__)
+
+# the athena query states, plus "" for hour jobs that never ran. The position is the state code.
+STATES = ["", "QUEUED", "RUNNING", "SUCCEEDED", "FAILED", "CANCELLED"]
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
+SUCCEEDED = STATE_CODES["SUCCEEDED"]
+
+# the keys of an hour job in the control file, in the order they are written
+FIELDS = ("hour", "queryid", "state", "dataScannedInBytes",
+          "runTimeInMillis", "startTime", "workgroup")
+_ATTRIBUTES = {"hour": "hour", "queryid": "queryid", "dataScannedInBytes": "data_scanned_in_bytes",
+               "runTimeInMillis": "run_time_in_millis", "startTime": "start_time", "workgroup": "workgroup"}
+
+
+def state_code(state):
+    """The small int code of a state, unknown states get the next free code"""
+    code = STATE_CODES.get(state)
+    if code is None:
+        code = STATE_CODES[state] = len(STATES)
+        STATES.append(state)
+    return code
+
+
+class HourJob:
+    """
+    One hour job of the control file.
+    Reads and writes like the control file dict (job["state"], job.get("queryid")) but stores
+    its fields in slots and its state as a small int, and keeps its HourJobIndex up to date.
+    Keys that are not in FIELDS are kept as they are so the control file round-trips unchanged.
+    """
+    __slots__ = ("date", "hour", "queryid", "state_code", "data_scanned_in_bytes", "run_time_in_millis",
+                 "start_time", "workgroup", "_extra", "_index")
+
+    def __init__(self, date, hour, queryid="", state="", data_scanned_in_bytes=None, run_time_in_millis=None,
+                 start_time=None, workgroup=None):
+        self.date = date
+        self.hour = hour
+        self.queryid = queryid
+        self.state_code = state_code(state)
+        self.data_scanned_in_bytes = data_scanned_in_bytes
+        self.run_time_in_millis = run_time_in_millis
+        self.start_time = start_time
+        self.workgroup = workgroup
+        self._extra = None
+        self._index = None
+
+    @classmethod
+    def from_dict(cls, date, job):
+        hour_job = cls(date, job["hour"], job.get("queryid", ""), job.get("state") or "",
+                       job.get("dataScannedInBytes"), job.get("runTimeInMillis"),
+                       job.get("startTime"), job.get("workgroup"))
+        extra = {key: value for key, value in job.items() if key not in FIELDS}
+        if extra:
+            hour_job._extra = extra
+        return hour_job
+
+    def to_dict(self):
+        job = {"hour": self.hour,
+               "queryid": self.queryid,
+               "state": STATES[self.state_code],
+               "dataScannedInBytes": self.data_scanned_in_bytes,
+               "runTimeInMillis": self.run_time_in_millis,
+               "startTime": self.start_time,
+               "workgroup": self.workgroup}
+        if self._extra:
+            job.update(self._extra)
+        return job
+
+    @property
+    def state(self):
+        return STATES[self.state_code]
+
+    @property
+    def occurrence(self):
+        """The position of this hour job among the hour jobs of the same date and hour, 0 unless duplicated"""
+        return self._index.occurrence(self) if self._index is not None else 0
+
+    @state.setter
+    def state(self, state):
+        code = state_code(state or "")
+        if code != self.state_code:
+            if self._index is not None:
+                self._index.move(self, self.state_code, code)
+            self.state_code = code
+
+    def __getitem__(self, key):
+        if key == "state":
+            return self.state
+        if key in _ATTRIBUTES:
+            return getattr(self, _ATTRIBUTES[key])
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == "state":
+            self.state = value
+        elif key in _ATTRIBUTES:
+            setattr(self, _ATTRIBUTES[key], value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __contains__(self, key):
+        return key in FIELDS or bool(self._extra and key in self._extra)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, job):
+        for key, value in job.items():
+            self[key] = value
+
+    def __repr__(self):
+        return "HourJob({}, {}, {})".format(self.date, self.hour, self.state)
+
+
+class HourJobIndex:
+    """
+    Index of the hour jobs of a control file by (date, hour) and by state code.
+    A control file can hold the same (date, hour) more than once (with controlDisabled, every run in
+    the same hour appends the hour again); all of them are indexed, in the order they were added.
+    """
+
+    def __init__(self):
+        self.by_key = {}
+        self.by_state = {}
+
+    @staticmethod
+    def key(date, hour):
+        return (date, int(hour))
+
+    def add(self, hour_job):
+        if hour_job._index is self:
+            return
+        self.by_key.setdefault(self.key(hour_job.date, hour_job.hour), []).append(hour_job)
+        self.by_state.setdefault(hour_job.state_code, set()).add(hour_job)
+        hour_job._index = self
+
+    def move(self, hour_job, old_code, new_code):
+        self.by_state[old_code].discard(hour_job)
+        self.by_state.setdefault(new_code, set()).add(hour_job)
+
+    def get(self, date, hour):
+        """The last hour job added for the date and hour, or None"""
+        hour_jobs = self.by_key.get(self.key(date, hour))
+        return hour_jobs[-1] if hour_jobs else None
+
+    def get_all(self, date, hour):
+        """Every hour job of the date and hour, in the order they were added"""
+        return list(self.by_key.get(self.key(date, hour), []))
+
+    def occurrence(self, hour_job):
+        """The position of the hour job among the hour jobs of its date and hour"""
+        return self.by_key[self.key(hour_job.date, hour_job.hour)].index(hour_job)
+
+    def in_state(self, state):
+        return self.by_state.get(STATE_CODES.get(state), set())
+
+    def not_in_state(self, state):
+        code = STATE_CODES.get(state)
+        return [hour_job for other_code, hour_jobs in self.by_state.items() if other_code != code
+                for hour_job in hour_jobs]
+
+
+def to_json_default(value):
+    """json.dumps default hook that writes hour jobs as control file dicts"""
+    if isinstance(value, HourJob):
+        return value.to_dict()
+    raise TypeError("Object of type {} is not JSON serializable".format(
+        type(value).__name__))
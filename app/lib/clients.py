@@ -0,0 +1,67 @@
+import threading
+
+from lib import trace
+
+# clients are shared by every S3 and AthenaClient object of the process, so their connection pools are reused
+MAX_POOL_CONNECTIONS = 50
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+
+
+def get_client(service_name, region_name, aws_access_key_id=None, aws_secret_access_key=None):
+    """
+    Returns the process-wide boto3 client for the service, region and credentials, creating it on first use.
+    boto3 is only imported when the first client is created.
+    """
+    key = (service_name, region_name, aws_access_key_id)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = _create_client(
+                service_name, region_name, aws_access_key_id, aws_secret_access_key)
+        return client
+
+
+def _count_api_call(model, **kwargs):
+    trace.api_call(model.service_model.service_name, model.name)
+
+
+def _create_client(service_name, region_name, aws_access_key_id, aws_secret_access_key):
+    client = _new_client(service_name, region_name,
+                         aws_access_key_id, aws_secret_access_key)
+    client.meta.events.register("before-call", _count_api_call)
+    return client
+
+
+def _new_client(service_name, region_name, aws_access_key_id, aws_secret_access_key):
+    global _session
+    import boto3
+    from botocore.config import Config
+
+    config = Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+    if aws_access_key_id:
+        # explicit credentials get their own session
+        return boto3.session.Session(aws_access_key_id=aws_access_key_id,
+                                     aws_secret_access_key=aws_secret_access_key).client(
+            service_name, region_name=region_name, config=config)
+
+    # boto3 sessions are not thread safe, clients are only created under _lock
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session.client(service_name, region_name=region_name, config=config)
+
+
+def register_client(service_name, region_name, client, aws_access_key_id=None):
+    """Makes get_client return the given client, e.g. a fake one"""
+    with _lock:
+        _clients[(service_name, region_name, aws_access_key_id)] = client
+
+
+def clear_clients():
+    """Forgets every client, the next get_client creates new ones"""
+    global _session
+    with _lock:
+        _clients.clear()
+        _session = None
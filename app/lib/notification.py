@@ -1,4 +1,3 @@
-import requests
 import json
 
 
@@ -17,6 +16,7 @@ class SlackNotification(object):
         infoMessage = {}
         infoMessage['text'] = self.infoTemplateMessage['text'].format(
             str(message), self.module)
+        import requests
         resp = requests.post(self.base_uri, headers=self.headers,
                              data=json.dumps(infoMessage))
 
@@ -28,6 +28,7 @@ class SlackNotification(object):
         warningMessage['text'] = self.warningTemplateMessage['text'].format(
             str(message), self.module)
 
+        import requests
         resp = requests.post(self.base_uri, headers=self.headers,
                              data=json.dumps(warningMessage))
         return resp
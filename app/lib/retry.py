@@ -0,0 +1,19 @@
+import functools
+
+
+def aws_backoff(**backoff_kwargs):
+    """
+    Same as awsretry AWSRetry.backoff, but awsretry (and botocore) are only imported
+    the first time the decorated function is called.
+    """
+    def decorator(f):
+        retrying = []
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not retrying:
+                from awsretry import AWSRetry
+                retrying.append(AWSRetry.backoff(**backoff_kwargs)(f))
+            return retrying[0](*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,148 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+from lib.log import setup_logger
+
+logger = setup_logger(__name__)
+
+# the process-wide tracer, None when tracing is off
+_tracer = None
+
+
+class Tracer:
+    """
+    Collects Chrome trace events, to be opened in chrome://tracing or ui.perfetto.dev:
+    a span per phase of the runner on the thread that ran it, a track per query slot of every task queue
+    showing which query held the slot and when, and an instant event per boto3 api call.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self.api_calls = Counter()
+        self._start = time.perf_counter()
+        self._threads = {}
+        self._owners = {}
+        self._slots = {}
+        self._slot_tracks = set()
+        self._lock = threading.Lock()
+
+    def now(self):
+        """Microseconds since the tracer started"""
+        return (time.perf_counter() - self._start) * 1e6
+
+    def _thread_id(self):
+        ident = threading.get_ident()
+        tid = self._threads.get(ident)
+        if tid is None:
+            tid = self._threads[ident] = len(self._threads) + 1
+            self.events.append({"name": "thread_name", "ph": "M", "pid": 0, "tid": tid,
+                                "args": {"name": threading.current_thread().name}})
+        return tid
+
+    def complete(self, name, category, start, args):
+        with self._lock:
+            self.events.append({"name": name, "cat": category, "ph": "X", "ts": start, "dur": self.now() - start,
+                                "pid": 0, "tid": self._thread_id(), "args": args})
+
+    def instant(self, name, category, args):
+        with self._lock:
+            self.events.append({"name": name, "cat": category, "ph": "i", "s": "t", "ts": self.now(),
+                                "pid": 0, "tid": self._thread_id(), "args": args})
+
+    def _owner_pid(self, owner):
+        pid = self._owners.get(owner)
+        if pid is None:
+            pid = self._owners[owner] = len(self._owners) + 1
+            self.events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"slots {owner}"}})
+        return pid
+
+    def slot_acquired(self, owner, task):
+        with self._lock:
+            pid = self._owner_pid(owner)
+            held = self._slots.setdefault(owner, {})
+            used = set(slot for slot, _ in held.values())
+            slot = next(slot for slot in range(1, len(held) + 2) if slot not in used)
+            held[task] = (slot, self.now())
+            if (pid, slot) not in self._slot_tracks:
+                self._slot_tracks.add((pid, slot))
+                self.events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": slot,
+                                    "args": {"name": f"slot {slot}"}})
+
+    def slot_released(self, owner, task):
+        with self._lock:
+            slot, start = self._slots.get(owner, {}).pop(task, (None, None))
+            if slot is None:
+                return
+            self.events.append({"name": task.name, "cat": "slot", "ph": "X", "ts": start, "dur": self.now() - start,
+                                "pid": self._owners[owner], "tid": slot,
+                                "args": {"id": task.id, "retries": task.retries, "error": task.error}})
+
+    def write(self):
+        with self._lock:
+            document = {"traceEvents": list(self.events), "displayTimeUnit": "ms",
+                        "otherData": {"apiCalls": dict(self.api_calls)}}
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(document, f)
+        logger.info(f"Trace written to {self.path}, api calls: {dict(self.api_calls)}")
+
+
+def enable(path):
+    """Starts tracing the process, the trace is written to path by write()"""
+    global _tracer
+    _tracer = Tracer(path)
+    return _tracer
+
+
+def write():
+    if _tracer is not None:
+        _tracer.write()
+
+
+@contextlib.contextmanager
+def span(name, category="runner", **args):
+    """Records the time spent in the with block as a span of the current thread"""
+    if _tracer is None:
+        yield
+        return
+    start = _tracer.now()
+    try:
+        yield
+    finally:
+        _tracer.complete(name, category, start, args)
+
+
+def traced(name):
+    """Decorator recording every call of the function as a span"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def slot_acquired(owner, task):
+    if _tracer is not None:
+        _tracer.slot_acquired(owner, task)
+
+
+def slot_released(owner, task):
+    if _tracer is not None:
+        _tracer.slot_released(owner, task)
+
+
+def api_call(service_name, operation_name):
+    """Counts a boto3 api call, see lib.clients"""
+    if _tracer is not None:
+        name = f"{service_name}.{operation_name}"
+        with _tracer._lock:
+            _tracer.api_calls[name] += 1
+        _tracer.instant(name, "api", {})
@@ -0,0 +1,194 @@
+import datetime
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+
+from clock import SYSTEM_CLOCK
+from lib.log import setup_logger
+
+logger = setup_logger(__name__)
+
+# the Statistics of a QueryExecution kept for every query, in milliseconds except DataScannedInBytes
+STATISTICS = ("EngineExecutionTimeInMillis", "DataScannedInBytes", "QueryQueueTimeInMillis",
+              "QueryPlanningTimeInMillis", "ServiceProcessingTimeInMillis", "TotalExecutionTimeInMillis")
+
+# the per query figures summarized with percentiles
+SUMMARIZED = STATISTICS + ("waitMillis", "submitToStartMillis", "detectionLagMillis")
+
+PERCENTILES = (50, 95, 99)
+
+PROMETHEUS_NAMES = {"EngineExecutionTimeInMillis": "engine_execution_milliseconds",
+                    "DataScannedInBytes": "data_scanned_bytes",
+                    "QueryQueueTimeInMillis": "queue_milliseconds",
+                    "QueryPlanningTimeInMillis": "planning_milliseconds",
+                    "ServiceProcessingTimeInMillis": "service_processing_milliseconds",
+                    "TotalExecutionTimeInMillis": "total_execution_milliseconds",
+                    "waitMillis": "wait_milliseconds",
+                    "submitToStartMillis": "submit_to_start_milliseconds",
+                    "detectionLagMillis": "detection_lag_milliseconds"}
+
+
+def percentile(values, p):
+    """The p-th percentile (nearest rank) of values, None if there are none"""
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    rank = math.ceil(float(p) / 100 * len(values))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class RunMetrics:
+    """
+    Latency and cost figures of the queries of one run of a config step, written as a run report:
+    one json line per query and a summary with p50/p95/p99 of each figure, and optionally a Prometheus textfile.
+    Besides the Statistics of athena, each query records
+        waitMillis - from the task being queued to its query being started, the time spent waiting for a slot
+        submitToStartMillis - athena queue and planning time, from submission to the engine starting
+        detectionLagMillis - from athena completing the query to the runner noticing it
+        retries - the number of times the task was retried before this query
+    Slot occupancy is the share of the max_queries slots in use, averaged over the run.
+    """
+
+    def __init__(self, step, clock=SYSTEM_CLOCK):
+        """
+        :param step: the controlKey of the config step, its step label. The config label is its first folder,
+                     and the file names are made of the whole key so the steps of a config do not overwrite each other.
+        :param clock: where the time is read from, the clock of the task queue
+        """
+        self.step = step
+        self.config = step.split("/")[0]
+        self.name = re.sub(r"[^A-Za-z0-9_.-]+", "_", re.sub(r"\.json$", "", step)).strip("_")
+        self.clock = clock
+        self.queries = {}
+        self.started = clock.monotonic()
+        self._last_poll = None
+        self._slot_seconds = 0.0
+        self._capacity_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record_query(self, task, execution_result, kind="query"):
+        """
+        Records a query that reached a final state
+        :param task: the task of the query
+        :param execution_result: the QueryExecution returned by athena
+        :param kind: query or drop
+        """
+        status = execution_result["Status"]
+        statistics = execution_result.get("Statistics", {})
+        record = {"config": self.config,
+                  "step": self.step,
+                  "queryId": execution_result["QueryExecutionId"],
+                  "kind": kind,
+                  "state": status["State"],
+                  "retries": task.retries}
+        if task.arguments.get("hour_jobs"):
+            record["hours"] = [f"{date_string} {str(hour_job['hour']).zfill(2)}"
+                               for date_string, hour_job in task.arguments["hour_jobs"]]
+        for key in STATISTICS:
+            record[key] = statistics.get(key)
+
+        if task.added_at is not None and task.started_at is not None:
+            record["waitMillis"] = round((task.started_at - task.added_at) * 1000)
+        queue, planning = statistics.get("QueryQueueTimeInMillis"), statistics.get("QueryPlanningTimeInMillis")
+        record["submitToStartMillis"] = (queue or 0) + (planning or 0) \
+            if queue is not None or planning is not None else None
+
+        completed = status.get("CompletionDateTime")
+        record["detectionLagMillis"] = None
+        if isinstance(completed, datetime.datetime):
+            now = datetime.datetime.now(completed.tzinfo)
+            record["detectionLagMillis"] = max(round((now - completed).total_seconds() * 1000), 0)
+
+        with self._lock:
+            # a query recorded twice keeps its last record
+            self.queries[record["queryId"]] = record
+
+    def record_poll(self, active, max_size):
+        """Records the number of slots in use since the previous poll"""
+        now = self.clock.monotonic()
+        with self._lock:
+            if self._last_poll is not None:
+                elapsed = now - self._last_poll[0]
+                self._slot_seconds += elapsed * self._last_poll[1]
+                self._capacity_seconds += elapsed * max_size
+            self._last_poll = (now, active)
+
+    def summary(self):
+        with self._lock:
+            records = list(self.queries.values())
+        summary = {"config": self.config,
+                   "step": self.step,
+                   "queries": len(records),
+                   "succeeded": sum(record["state"] == "SUCCEEDED" for record in records),
+                   "retries": sum(record["retries"] for record in records if record["state"] == "SUCCEEDED"),
+                   "durationSeconds": round(self.clock.monotonic() - self.started, 3),
+                   "slotOccupancy": round(self._slot_seconds / self._capacity_seconds, 4) if self._capacity_seconds else None}
+        for key in SUMMARIZED:
+            values = [record.get(key) for record in records]
+            summary[key] = {f"p{p}": percentile(values, p) for p in PERCENTILES}
+        summary["DataScannedInBytes"]["total"] = sum(record.get("DataScannedInBytes") or 0 for record in records)
+        return summary
+
+    @staticmethod
+    def _write(path, text):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # write then rename, so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def write_report(self, directory):
+        """
+        Writes <name>-<timestamp>-<pid>.jsonl, one line per query, and <name>-<timestamp>-<pid>-summary.json in directory.
+        The timestamp is to the microsecond and the pid tells processes apart, so two runs never share a report.
+        :return: the path of the summary
+        """
+        stamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f")
+        base = os.path.join(directory, f"{self.name}-{stamp}-{os.getpid()}")
+        with self._lock:
+            records = list(self.queries.values())
+        self._write(base + ".jsonl", "".join(json.dumps(record) + "\n" for record in records))
+        summary = self.summary()
+        self._write(base + "-summary.json", json.dumps(summary, indent=4))
+        logger.info(f"Run report written to {base}.jsonl: {json.dumps(summary)}")
+        return base + "-summary.json"
+
+    @staticmethod
+    def _escape(value):
+        """A prometheus label value"""
+        return value.replace("\\", "\\\\").replace('"', '\\"')
+
+    def write_prometheus(self, directory):
+        """
+        Writes athena_runner_<name>.prom in directory, for the textfile collector of the node exporter
+        :return: the path of the file
+        """
+        summary = self.summary()
+        label = f'config="{self._escape(self.config)}",step="{self._escape(self.step)}"'
+        lines = ["# TYPE athena_runner_queries gauge",
+                 f"athena_runner_queries{{{label}}} {summary['queries']}",
+                 "# TYPE athena_runner_queries_succeeded gauge",
+                 f"athena_runner_queries_succeeded{{{label}}} {summary['succeeded']}",
+                 "# TYPE athena_runner_retries gauge",
+                 f"athena_runner_retries{{{label}}} {summary['retries']}",
+                 "# TYPE athena_runner_run_duration_seconds gauge",
+                 f"athena_runner_run_duration_seconds{{{label}}} {summary['durationSeconds']}",
+                 "# TYPE athena_runner_data_scanned_bytes gauge",
+                 f"athena_runner_data_scanned_bytes{{{label}}} {summary['DataScannedInBytes']['total']}"]
+        if summary["slotOccupancy"] is not None:
+            lines += ["# TYPE athena_runner_slot_occupancy gauge",
+                      f"athena_runner_slot_occupancy{{{label}}} {summary['slotOccupancy']}"]
+        for key in SUMMARIZED:
+            metric = "athena_runner_query_" + PROMETHEUS_NAMES[key]
+            lines.append(f"# TYPE {metric} gauge")
+            for p in PERCENTILES:
+                value = summary[key][f"p{p}"]
+                if value is not None:
+                    lines.append(f'{metric}{{{label},quantile="{p / 100}"}} {value}')
+        path = os.path.join(directory, f"athena_runner_{self.name}.prom")
+        self._write(path, "\n".join(lines) + "\n")
+        return path
@@ -0,0 +1,82 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+from lib.log import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class ObjectCache:
+    """
+    Reads s3 objects into memory through a local cache.
+    Object bodies are stored under a hash of bucket/key/ETag, next to a small file per bucket/key
+    holding the last ETag seen. Each fetch is a conditional GET with that ETag, so an unchanged
+    object costs one request and no download.
+    """
+
+    def __init__(self, cache_dir=None):
+        """
+        :param cache_dir: where cached objects are stored, defaults to $ATHENA_RUNNER_CACHE_DIR
+                          or athena-runner-cache in the temp directory
+        """
+        self.cache_dir = cache_dir or os.environ.get("ATHENA_RUNNER_CACHE_DIR") or \
+            os.path.join(tempfile.gettempdir(), "athena-runner-cache")
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(*parts):
+        return hashlib.sha256("/".join(parts).encode("utf-8")).hexdigest()
+
+    def _etag_path(self, bucket, key):
+        return os.path.join(self.cache_dir, "etags", self._digest(bucket, key))
+
+    def _body_path(self, bucket, key, etag):
+        return os.path.join(self.cache_dir, "objects", self._digest(bucket, key, etag))
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    @staticmethod
+    def _write(path, body):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, so concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+
+    def fetch(self, s3, key):
+        """
+        Returns the body of s3://<s3.bucket>/key as bytes, or None if it cannot be read.
+        :param s3: the S3 object of the bucket
+        """
+        etag_bytes = self._read(self._etag_path(s3.bucket, key))
+        cached_etag = etag_bytes.decode("utf-8") if etag_bytes else None
+        cached_body = self._read(self._body_path(
+            s3.bucket, key, cached_etag)) if cached_etag else None
+
+        body, etag = s3.get_bytes_if_changed(
+            key, cached_etag if cached_body is not None else None)
+        if body is None and etag is not None and etag == cached_etag:
+            with self._lock:
+                self.hits += 1
+            logger.info(f"s3://{s3.bucket}/{key} not modified, using cached copy")
+            return cached_body
+        if body is None:
+            return None
+
+        with self._lock:
+            self.misses += 1
+        if etag:
+            self._write(self._body_path(s3.bucket, key, etag), body)
+            self._write(self._etag_path(s3.bucket, key), etag.encode("utf-8"))
+        return body
@@ -0,0 +1,60 @@
+from lib.log import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class PollScheduler:
+    """
+    Decides how long the task queue sleeps before the next status poll.
+    Each active task asks to be polled when its expected run time is reached, or after default_seconds if that
+    comes first, so a query finishing early is seen no later than with a fixed poll and a slot is refilled as soon
+    as it is likely to be free. Once a task runs past its expected run time, and no task waits for a slot, it is polled
+    with an exponential back off starting at default_seconds and growing by backoff up to max_seconds: fewer api calls
+    for long running queries, but the last queries of a run are noticed later. While tasks wait for a slot, late
+    tasks are polled every default_seconds. A backoff of 1 polls late tasks every default_seconds.
+    Tasks without an expected run time are polled every default_seconds.
+    The queue sleeps until the earliest of these, clamped to [min_seconds, max_seconds].
+    """
+
+    def __init__(self, default_seconds=10, min_seconds=1, max_seconds=60, backoff=2):
+        """
+        :param default_seconds: the poll interval for tasks without an expected run time
+        :param min_seconds: the shortest sleep between polls
+        :param max_seconds: the longest sleep between polls
+        :param backoff: the factor the poll interval grows by for tasks running past their expected run time
+        """
+        self.default_seconds = float(default_seconds)
+        self.min_seconds = float(min_seconds)
+        self.max_seconds = max(float(max_seconds), self.min_seconds)
+        self.backoff = max(float(backoff), 1.0)
+
+    def _task_wait(self, task, now, waiting):
+        if task.expected_seconds is None or task.started_at is None:
+            return self.default_seconds
+
+        remaining = task.started_at + task.expected_seconds - now
+        if remaining > 0:
+            return min(remaining, self.default_seconds)
+
+        if waiting:
+            # the task is late and its slot is wanted
+            return self.default_seconds
+
+        # the task is late, back off exponentially up to max_seconds
+        wait = min(self.default_seconds * (self.backoff ** task.late_polls), self.max_seconds)
+        if wait < self.max_seconds:
+            task.late_polls += 1
+        return wait
+
+    def next_sleep(self, active_tasks, now, waiting=False):
+        """
+        :param active_tasks: the tasks currently in the active queue
+        :param now: the current monotonic time in seconds
+        :param waiting: whether tasks are ready to start as soon as a slot is free
+        :return: the number of seconds to sleep before the next poll
+        """
+        if not active_tasks:
+            return self.min_seconds
+
+        wait = min(self._task_wait(task, now, waiting) for task in active_tasks)
+        return min(max(wait, self.min_seconds), self.max_seconds)
@@ -0,0 +1,127 @@
+import threading
+import time
+
+from lib.log import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class QuerySlots:
+    """
+    A budget of concurrent athena queries shared by several AthenaClients running in the same process.
+    A client takes a slot before it starts a query and gives it back when the query leaves its active queue,
+    on top of its own max_queries limit.
+    """
+
+    def __init__(self, max_queries):
+        """
+        :param max_queries: the maximum number of queries running at any one time across all clients
+        :type max_queries int
+        """
+        self.max_queries = int(max_queries)
+        self.in_use = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, owner):
+        """Takes a slot for owner if one is free, returns whether it did"""
+        with self._lock:
+            if self.in_use >= self.max_queries:
+                return False
+            self.in_use += 1
+            return True
+
+    def release(self, owner):
+        with self._lock:
+            self.in_use = max(self.in_use - 1, 0)
+
+
+class FairQuerySlots:
+    """
+    A budget of concurrent queries shared by several configs, handed out weighted-fair.
+    Each config takes its slots through its own SlotAccount, which also enforces a per-config limit.
+    When all slots are busy, a config that asked for a slot and was refused is "waiting"; the next free slot
+    goes to the waiting config with the fewest slots per unit of weight. A config refused by its own limit is
+    not waiting, it cannot take a free slot anyway. A config stops counting as waiting
+    waiting_seconds after its last refused request, so configs that went idle do not hold others back.
+    """
+
+    def __init__(self, max_queries, waiting_seconds=60):
+        """
+        :param max_queries: the maximum number of queries running at any one time across all configs
+        :param waiting_seconds: how long a refused config keeps priority for the next free slot
+        """
+        self.max_queries = int(max_queries)
+        self.waiting_seconds = float(waiting_seconds)
+        self.in_use = 0
+        self._waiting_since = {}
+        self._lock = threading.Lock()
+
+    def account(self, name, weight=1, max_queries=None):
+        """
+        :param name: the name of the config, for logs
+        :param weight: the share of the slots the config gets relative to other configs
+        :param max_queries: the maximum number of queries of this config at any one time, unlimited if None
+        """
+        return SlotAccount(self, name, weight, max_queries)
+
+    def _try_acquire(self, account):
+        with self._lock:
+            now = time.monotonic()
+            for waiting, since in list(self._waiting_since.items()):
+                if now - since > self.waiting_seconds:
+                    del self._waiting_since[waiting]
+
+            if account.at_limit:
+                # refused by its own limit, not by the shared budget: it does not wait for a shared slot
+                self._waiting_since.pop(account, None)
+                return False
+            if self.in_use >= self.max_queries:
+                self._waiting_since[account] = now
+                return False
+
+            share = account.in_use / account.weight
+            if any(other.in_use / other.weight < share for other in self._waiting_since
+                   if other is not account and not other.at_limit):
+                self._waiting_since[account] = now
+                return False
+
+            self._waiting_since.pop(account, None)
+            self.in_use += 1
+            account.in_use += 1
+            return True
+
+    def _release(self, account):
+        with self._lock:
+            self.in_use = max(self.in_use - 1, 0)
+            account.in_use = max(account.in_use - 1, 0)
+
+    def _forget(self, account):
+        with self._lock:
+            self._waiting_since.pop(account, None)
+
+
+class SlotAccount:
+    """
+    The view of FairQuerySlots given to the task queues of one config, used like QuerySlots
+    """
+
+    def __init__(self, slots, name, weight=1, max_queries=None):
+        self.slots = slots
+        self.name = name
+        self.weight = float(weight) if weight and float(weight) > 0 else 1.0
+        self.max_queries = int(max_queries) if max_queries else None
+        self.in_use = 0
+
+    @property
+    def at_limit(self):
+        return self.max_queries is not None and self.in_use >= self.max_queries
+
+    def try_acquire(self, owner):
+        return self.slots._try_acquire(self)
+
+    def release(self, owner):
+        self.slots._release(self)
+
+    def done(self):
+        """Called when the config has no more queries to run"""
+        self.slots._forget(self)
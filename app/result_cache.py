@@ -0,0 +1,123 @@
+import hashlib
+import json
+import threading
+import time
+
+from s3 import S3
+from lib.log import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class ResultCache:
+    """
+    Remembers the queries that succeeded, by a hash of their rendered sql, database, workgroup and output location,
+    in a json document on s3 so it is shared by runs and by the configs pointing at the same key.
+    An entry keeps the QueryExecutionId, the output and manifest locations and the statistics of the query.
+    Entries older than ttl_seconds are dropped, and only the max_entries most recent ones are kept.
+    """
+
+    def __init__(self, s3, key, ttl_seconds=86400, max_entries=10000):
+        """
+        :param s3: the S3 object of the bucket the cache document is kept in
+        :param key: the key of the cache document
+        :param ttl_seconds: how long a succeeded query can be reused
+        :param max_entries: the most entries kept in the cache document
+        """
+        self.s3 = s3
+        self.key = key
+        self.ttl_seconds = float(ttl_seconds)
+        self.max_entries = int(max_entries)
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._added = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(sql, database, workgroup, output_location):
+        return hashlib.sha256(json.dumps([sql, database, workgroup, output_location]).encode("utf-8")).hexdigest()
+
+    def _read(self):
+        body = self.s3.get_bytes(self.key)
+        if body is None:
+            return {}
+        try:
+            return json.loads(body).get("entries", {})
+        except ValueError as e:
+            logger.info(f"Ignoring unreadable result cache {self.key}: {e}")
+            return {}
+
+    def _evict(self, entries):
+        now = time.time()
+        fresh = sorted(((cache_key, entry) for cache_key, entry in entries.items()
+                        if now - entry["succeededAt"] <= self.ttl_seconds),
+                       key=lambda item: -item[1]["succeededAt"])
+        return dict(fresh[:self.max_entries])
+
+    def load(self):
+        self.entries = self._evict(self._read())
+        logger.info(
+            f"Loaded {len(self.entries)} entries from result cache {self.key}")
+        return self
+
+    def lookup(self, cache_key):
+        """
+        The entry of a query that succeeded within ttl_seconds and whose output is still on s3, or None
+        """
+        entry = self.entries.get(cache_key)
+        if entry is not None and (time.time() - entry["succeededAt"] > self.ttl_seconds or not self._output_exists(entry)):
+            entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    @staticmethod
+    def _output_exists(entry):
+        location = entry.get("manifestLocation") or entry.get("outputLocation")
+        if not location:
+            return False
+        bucket, _, key = location.replace("s3://", "").partition("/")
+        return key in S3(bucket=bucket).list_objects(key)
+
+    def record(self, cache_key, execution_result):
+        """
+        Adds a succeeded query to the cache
+        :param execution_result: the QueryExecution returned by athena
+        """
+        statistics = execution_result.get("Statistics", {})
+        entry = {"queryId": execution_result["QueryExecutionId"],
+                 "outputLocation": execution_result.get("ResultConfiguration", {}).get("OutputLocation"),
+                 "manifestLocation": statistics.get("DataManifestLocation"),
+                 "dataScannedInBytes": statistics.get("DataScannedInBytes"),
+                 "runTimeInMillis": statistics.get("EngineExecutionTimeInMillis"),
+                 "succeededAt": time.time()}
+        with self._lock:
+            self.entries[cache_key] = entry
+            self._added[cache_key] = entry
+
+    def save(self):
+        """
+        Uploads the entries added since the last save, merged into the latest cache document
+        so entries added by other runs in the meantime are kept. Returns True if it was uploaded.
+        """
+        with self._lock:
+            added, self._added = self._added, {}
+        if not added:
+            return False
+
+        entries = self._read()
+        entries.update(added)
+        self.entries = self._evict(entries)
+        body = json.dumps({"entries": self.entries},
+                          separators=(",", ":")).encode("utf-8")
+        if not self.s3.put_bytes(body, self.key):
+            with self._lock:
+                self._added = dict(added, **self._added)
+            return False
+        logger.info(
+            f"Saved {len(added)} new entries to result cache {self.key}, {len(self.entries)} in total")
+        return True
@@ -1,71 +1,281 @@
 # from dotenv import load_dotenv
+import argparse
 import os
+import signal
 from s3 import S3
+from object_cache import ObjectCache
 
 from lib.log import setup_logger
 from lib.notification import SlackNotification
-from config import Config
+from lib import trace
+from config import Config, flag
 from control_data import ControlData
+from control_store import SegmentedControlStore
+from result_cache import ResultCache
+from scan_budget import ScanBudget
+from metrics import RunMetrics
+from clock import SYSTEM_CLOCK
 import json
-from itertools import chain
 from functools import partial
-from athena import AthenaClient
+from athena import AthenaClient, range_batching_error
+from step_scheduler import StepScheduler
+from task_queue import request_shutdown
 
 # load_dotenv()
 logger = setup_logger(__name__)
 slackBot = SlackNotification(__name__)
+object_cache = ObjectCache()
 
 
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Athena runner")
+    subparsers = parser.add_subparsers(dest="mode")
+    serve_parser = subparsers.add_parser(
+        "serve", help="stay resident and run the jobs dropped in a spool directory")
+    serve_parser.add_argument("--spool", required=True,
+                              help="spool directory, job descriptors are read from its incoming/ directory")
+    serve_parser.add_argument("--max-jobs", type=int, default=4,
+                              help="the number of jobs run at the same time")
+    serve_parser.add_argument("--max-queries", type=int, default=None,
+                              help="the number of athena queries run at the same time across all jobs")
+    serve_parser.add_argument("--poll-seconds", type=float, default=5,
+                              help="how often the spool directory is checked for new jobs")
+    fleet_parser = subparsers.add_parser(
+        "fleet", help="run many configs in one process under one budget of concurrent queries")
+    fleet_parser.add_argument("--configs-dir", default="../configs",
+                              help="every prod.json under this directory is run")
+    fleet_parser.add_argument("--config", action="append", default=None,
+                              help="a config file to run instead of the configs directory, can be repeated")
+    fleet_parser.add_argument("--max-queries", type=int, required=True,
+                              help="the number of athena queries run at the same time across all configs")
+    plan_parser = subparsers.add_parser(
+        "plan", help="what-if runs of the steps of a config with other maxQueries and poll settings, replayed from their control files")
+    plan_parser.add_argument("--config", default=os.environ.get('CONTROLCONFIGPATH'),
+                             help="the config whose steps are planned, defaults to $CONTROLCONFIGPATH")
+    plan_parser.add_argument("--control-file", action="append", default=None,
+                             help="a local control file to replay instead of the control files of the steps, can be repeated")
+    plan_parser.add_argument("--max-queries", type=int, nargs="+", default=[1, 2, 5, 10, 20],
+                             help="the maxQueries values simulated")
+    plan_parser.add_argument("--sleep-seconds", type=int, nargs="+", default=[5, 10, 30],
+                             help="the sleepSeconds values simulated")
+    plan_parser.add_argument("--adaptive-polling", action="store_true",
+                             help="also simulate every setting with adaptivePolling on")
+    plan_parser.add_argument("--timeout-minutes", type=float, default=None,
+                             help="the timeout the runs are checked against, defaults to timeoutMinutes of each step")
+    plan_parser.add_argument("--hours", type=int, default=24,
+                             help="the number of hour jobs of a simulated run, 24 for a daily run")
+    plan_parser.add_argument("--trials", type=int, default=100,
+                             help="the number of runs simulated per setting")
+    plan_parser.add_argument("--history-days", type=int, default=90,
+                             help="the number of most recent days of the control files the run times are drawn from")
+    plan_parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", default=os.environ.get("ATHENA_RUNNER_TRACE"),
+                        help="write a Chrome trace of the run to this file, defaults to $ATHENA_RUNNER_TRACE")
+    args = parser.parse_args(argv)
+    if args.trace:
+        trace.enable(args.trace)
+    try:
+        run_mode(args)
+    finally:
+        trace.write()
+
+
+def run_mode(args):
+    if args.mode == "serve":
+        from serve import SpoolServer
+        SpoolServer(args.spool, max_jobs=args.max_jobs, max_queries=args.max_queries,
+                    poll_seconds=args.poll_seconds).serve_forever()
+        return
+
+    if args.mode == "plan":
+        plan(args)
+        return
+
+    # stop polling and checkpoint the control files instead of dying mid-run
+    signal.signal(signal.SIGTERM, request_shutdown)
+
+    if args.mode == "fleet":
+        from fleet import Fleet
+        Fleet(args.config or Fleet.find_configs(args.configs_dir),
+              max_queries=args.max_queries).run()
+        return
+
     logger.info("Read config file for task list... ")
     # os.environ['CONTROLCONFIGPATH'] export "../configs/prod.json" to os.environ['CONTROLCONFIGPATH']
     data = Config(os.environ['CONTROLCONFIGPATH']).data
+    run_config(data)
+
+
+def run_config(data, shared_slots=None):
+    """
+    Runs every step of a config
+    :param data: the config data, with its list of steps
+    :param shared_slots: a QuerySlots budget (or a SlotAccount of FairQuerySlots) of concurrent queries
+                         shared with other configs of the process
+    """
+    sqls = [get_query_from_s3(step['queryBucket'], step['queryKey'])
+            for step in data['steps']]
 
-    list(map(process_each_config, data['steps']))
+    scheduler = StepScheduler(data['steps'], sqls,
+                              max_concurrent_steps=data.get('maxConcurrentSteps', 1))
+    scheduler.run(lambda step, index: process_each_config(
+        step, sqls[index], shared_slots))
 
 
-def process_each_config(data):
+def process_each_config(data, sql=None, shared_slots=None):
 
     logger.info(" [Athena Runner Step 1/5] read config file... ")
 
-    control_s3 = S3(bucket=data['controlBucket'])
+    with trace.span("step 1/5 read config", step=data['controlKey']):
+        control_s3 = S3(bucket=data['controlBucket'])
 
     logger.info(" [Athena Runner Step 2/5] read control file... ")
-    control_dict = read_control(control_s3, data["controlKey"])
+    with trace.span("step 2/5 read control file", step=data['controlKey']):
+        control_store = None
+        if data.get("controlStorage") == "segmented":
+            control_store = SegmentedControlStore(
+                control_s3, data["controlKey"], data.get("controlCompactEvery", 20))
+            control_dict = control_store.load()
+        else:
+            control_dict = read_control(control_s3, data["controlKey"])
 
     logger.info(" [Athena Runner Step 3/5] append control file... ")
-    control_data = ControlData(control_dict, data)
+    with trace.span("step 3/5 append control file", step=data['controlKey']):
+        control_data = ControlData(control_dict, data)
 
-    # filter the controlData to get all hour job that has state not equal to SUCCEEDED
-    day_hour_tuple_list_of_list = list(map(lambda day: zip(
-        [f"{day['year']}-{day['month']}-{day['day']}"]*len(day["hourlist"]), day["hourlist"]), control_data.date_list))
-    day_hour_tuple_list_flaterned = list(chain.from_iterable(
-        day_hour_tuple_list_of_list))  # [ day_hour_tuple for sublist in day_hour_tuple_list_of_list for day_hour_tuple in sublist]
+    # all hour jobs that have state not equal to SUCCEEDED, in calendar order
+    hour_jobs_to_process = control_data.pending_hour_jobs()
 
-    hour_jobs_to_process = list(filter(lambda x: x[1]["state"] != "SUCCEEDED",
-                                       day_hour_tuple_list_flaterned))
+    metrics = None
+    if data.get('metricsDir') or data.get('prometheusTextfileDir'):
+        metrics = RunMetrics(data['controlKey'])
 
     # create athena client with config
     athena = AthenaClient(db=data['database'], max_queries=data['maxQueries'],
-                          timeout_minutes=data['timeoutMinutes'], sleep_seconds=data['sleepSeconds'], workgroup=data['workgroup'], control_s3=control_s3, control_key=data['controlKey'], parquet=data.get("parquet"), control_data=control_data)
+                          timeout_minutes=data['timeoutMinutes'], sleep_seconds=data['sleepSeconds'], workgroup=data['workgroup'], control_s3=control_s3, control_key=data['controlKey'], parquet=data.get("parquet"), control_data=control_data,
+                          adaptive_polling=flag(data, 'adaptivePolling'), min_sleep_seconds=data.get('minSleepSeconds', 1), max_sleep_seconds=data.get('maxSleepSeconds', 60),
+                          poll_backoff=data.get('pollBackoff', 2), control_flush_seconds=data.get('controlFlushSeconds', 0), control_store=control_store,
+                          scheduling_policy=data.get('schedulingPolicy') or 'fifo', shared_slots=shared_slots,
+                          result_cache=load_result_cache(data, control_s3), resume=flag(data, 'resumeQueries'),
+                          hedge_percentile=data.get('hedgePercentile', 90) if flag(data, 'hedgeStragglers') else None,
+                          hedge_factor=data.get('hedgeFactor', 2), scan_budget=scan_budget(data), metrics=metrics,
+                          max_retries=data.get('maxRetries', 3), retry_base_seconds=data.get('retryBaseSeconds', 5),
+                          retry_max_seconds=data.get('retryMaxSeconds', 300))
 
     add_query_with_config = partial(athena.add_query, data)
 
-    sql = get_query_from_s3(data['queryBucket'], data['queryKey'])
+    if sql is None:
+        sql = get_query_from_s3(data['queryBucket'], data['queryKey'])
 
     add_query_with_config_and_sql = partial(add_query_with_config, sql)
 
-    list(map(add_query_with_config_and_sql, hour_jobs_to_process))
+    resume = flag(data, 'resumeQueries')
+    range_batching = flag(data, 'rangeBatching')
+    if range_batching:
+        batching_error = range_batching_error(data, sql)
+        if batching_error:
+            logger.info(
+                f"Not batching {data['controlKey']}, running one query per hour job: {batching_error}")
+            range_batching = False
+    with trace.span("add queries", step=data['controlKey'], hour_jobs=len(hour_jobs_to_process)):
+        if range_batching or resume:
+            # one query per run of consecutive pending hours, and the queries still running from the last run re-attached
+            hour_ranges = control_data.pending_hour_ranges(
+                data.get('maxBatchHours', 24) if range_batching else 1, keep_in_flight=resume)
+            logger.info(
+                f"Batching {len(hour_jobs_to_process)} hour jobs into {len(hour_ranges)} range queries")
+            for hour_range in hour_ranges:
+                athena.add_range_query(data, sql, hour_range,
+                                       attach=resume and control_data.in_flight(hour_range[0][1]))
+        else:
+            list(map(add_query_with_config_and_sql, hour_jobs_to_process))
+
+    try:
+        with trace.span("step 4/5 run queries", step=data['controlKey']):
+            athena.wait_for_completion()
+    finally:
+        if metrics is not None:
+            write_metrics(data, metrics)
+
+
+def plan(args):
+    """
+    Replays the history of each step of a config (or of local control files) through a simulated task queue
+    for every maxQueries and poll setting of args, and prints the expected makespan, P(timeout) and scan cost
+    """
+    from capacity_planner import CapacityPlanner, HourHistory, format_rows
+
+    data = Config(args.config).data if args.config else {}
+    steps = data.get('steps') or ([data] if data else [{}])
+    for step in steps:
+        if args.control_file:
+            date_lists = []
+            for path in args.control_file:
+                with open(path) as f:
+                    date_lists.append(json.load(f)["datelist"])
+            name = ", ".join(args.control_file)
+        else:
+            control_s3 = S3(bucket=step['controlBucket'])
+            if step.get("controlStorage") == "segmented":
+                control_dict = SegmentedControlStore(control_s3, step["controlKey"]).load()
+            else:
+                control_dict = read_control(control_s3, step["controlKey"])
+            date_lists = [(control_dict or {}).get("datelist", [])]
+            name = step['controlKey']
+
+        history = HourHistory(date_lists, history_days=args.history_days)
+        timeout_minutes = args.timeout_minutes or float(step.get('timeoutMinutes', 10))
+        logger.info(f"Planning {name} from {len(history)} past runs")
+        planner = CapacityPlanner(history, [hour % 24 for hour in range(args.hours)], trials=args.trials,
+                                  seed=args.seed, scheduling_policy=step.get('schedulingPolicy'),
+                                  scan_budget=partial(scan_budget, step) if scan_budget(step) else None)
+        rows = planner.sweep(args.max_queries, args.sleep_seconds, timeout_minutes,
+                             adaptive_polling_values=(False, True) if args.adaptive_polling else (False,),
+                             min_sleep_seconds=step.get('minSleepSeconds', 1),
+                             max_sleep_seconds=step.get('maxSleepSeconds', 60),
+                             poll_backoff=step.get('pollBackoff', 2))
+        print(f"{name}: {args.hours} hour jobs per run, timeout {timeout_minutes:g} minutes, "
+              f"{args.trials} runs per setting drawn from {len(history)} past runs")
+        print(format_rows(rows))
+        print()
+
+
+def write_metrics(data, metrics):
+    """Writes the run report to "metricsDir" and the Prometheus textfile to "prometheusTextfileDir" of a step"""
+    try:
+        if data.get('metricsDir'):
+            metrics.write_report(data['metricsDir'])
+        if data.get('prometheusTextfileDir'):
+            metrics.write_prometheus(data['prometheusTextfileDir'])
+    except OSError as e:
+        logger.exception(f"Could not write the run metrics: {e}")
+
+
+def scan_budget(data, clock=SYSTEM_CLOCK):
+    """The ScanBudget of a step with "maxScanGBInFlight" or "maxScanGBPerWindow" set"""
+    if not (data.get('maxScanGBInFlight') or data.get('maxScanGBPerWindow')):
+        return None
+    return ScanBudget(max_bytes_in_flight=float(data.get('maxScanGBInFlight') or 0) * 1024 ** 3,
+                      max_bytes_per_window=float(
+                          data.get('maxScanGBPerWindow') or 0) * 1024 ** 3,
+                      window_seconds=float(data.get('scanWindowMinutes', 60)) * 60, clock=clock)
+
 
-    athena.wait_for_completion()
+def load_result_cache(data, control_s3):
+    """The ResultCache of a step with "resultCache" on, kept next to its control file by default"""
+    if not flag(data, 'resultCache'):
+        return None
+    key = data.get('resultCacheKey') or f"{data['controlKey'].split('/')[0]}/result-cache.json"
+    return ResultCache(control_s3, key, ttl_seconds=float(data.get('resultCacheTtlHours', 24)) * 3600,
+                       max_entries=data.get('resultCacheMaxEntries', 10000)).load()
 
 
 def get_query_from_s3(queryBucket, queryKey):
     query_s3 = S3(bucket=queryBucket)
-    query_s3.get(queryKey, "query.sql")
-    with open("query.sql") as f:
-        query = f.read()
-    return query
+    query = object_cache.fetch(query_s3, queryKey)
+    if query is None:
+        raise IOError(f"Could not read query s3://{queryBucket}/{queryKey}")
+    return query.decode("utf-8")
 
 
 def pretty_print(d):
@@ -73,11 +283,9 @@ def pretty_print(d):
 
 
 def read_control(s3, key):
-    s3.get(key, "control.json")
-    if os.path.isfile("control.json"):
-        with open("control.json") as f:
-            controlData = json.load(f)
-        return controlData
+    body = object_cache.fetch(s3, key)
+    if body is not None:
+        return json.loads(body)
     return None
 
 
@@ -0,0 +1,94 @@
+import heapq
+import math
+import statistics
+
+from lib.log import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class RunHistory:
+    """
+    Summary of the past runs recorded in a control date list.
+    Only SUCCEEDED hour jobs with a recorded runTimeInMillis (or dataScannedInBytes) are used.
+    """
+
+    def __init__(self, date_list, recent_days=7):
+        """
+        :param date_list: the control date list, oldest day first
+        :param recent_days: the number of most recent runs of an hour to look at
+        :type recent_days int
+        """
+        self.recent_days = recent_days
+        self._runtimes_by_hour = {}
+        self._scanned_by_hour = {}
+
+        for day in date_list or []:
+            for hour_job in day["hourlist"]:
+                if hour_job["state"] != "SUCCEEDED":
+                    continue
+                if hour_job["runTimeInMillis"] is not None:
+                    self._runtimes_by_hour.setdefault(int(hour_job["hour"]), []).append(
+                        hour_job["runTimeInMillis"] / 1000.0)
+                if hour_job["dataScannedInBytes"] is not None:
+                    self._scanned_by_hour.setdefault(int(hour_job["hour"]), []).append(
+                        hour_job["dataScannedInBytes"])
+
+        self._all_runtimes = [runtime for runtimes in self._runtimes_by_hour.values()
+                              for runtime in runtimes[-recent_days:]]
+        self._all_scanned = [scanned for hour_scanned in self._scanned_by_hour.values()
+                             for scanned in hour_scanned[-recent_days:]]
+
+    def expected_runtime_seconds(self, hour):
+        """
+        The median run time of the most recent runs of the same hour,
+        or of all recent runs when that hour has never succeeded.
+        Returns None when there is no history at all.
+        """
+        runtimes = self._runtimes_by_hour.get(int(hour))
+        if runtimes:
+            return statistics.median(runtimes[-self.recent_days:])
+        if self._all_runtimes:
+            return statistics.median(self._all_runtimes)
+        return None
+
+    def expected_scan_bytes(self, hour):
+        """
+        The median data scanned by the most recent runs of the same hour,
+        or by all recent runs when that hour has never succeeded.
+        Returns None when there is no history at all.
+        """
+        scanned = self._scanned_by_hour.get(int(hour))
+        if scanned:
+            return statistics.median(scanned[-self.recent_days:])
+        if self._all_scanned:
+            return statistics.median(self._all_scanned)
+        return None
+
+    def runtime_percentile_seconds(self, hour, percentile):
+        """
+        The given percentile (nearest rank) of the run times of the most recent runs of the same hour,
+        or of all recent runs when that hour has never succeeded.
+        Returns None when there is no history at all.
+        """
+        runtimes = self._runtimes_by_hour.get(int(hour))
+        runtimes = sorted(runtimes[-self.recent_days:] if runtimes else self._all_runtimes)
+        if not runtimes:
+            return None
+        rank = math.ceil(float(percentile) / 100 * len(runtimes))
+        return runtimes[min(max(rank, 1), len(runtimes)) - 1]
+
+
+def predict_makespan(durations, slots):
+    """
+    The time to run the given durations, in the given order, on the given number of slots,
+    each one starting on the first slot to become free.
+    :param durations: run times in seconds, in dispatch order
+    :param slots: the number of queries that can run at the same time
+    """
+    if not durations:
+        return 0.0
+    slot_free_at = [0.0] * max(int(slots), 1)
+    for duration in durations:
+        heapq.heappush(slot_free_at, heapq.heappop(slot_free_at) + duration)
+    return max(slot_free_at)
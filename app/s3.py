@@ -1,19 +1,24 @@
 import threading
-import boto3
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 import sys
 import os
 
-from boto3.s3.transfer import S3Transfer, TransferConfig
 import re
+from lib.clients import get_client
 from lib.log import setup_logger
 from lib.notification import SlackNotification
 
 
+# maximum number of keys accepted by delete_objects
+DELETE_BATCH_SIZE = 1000
+
+
 class S3(object):
 
     def __init__(self, bucket, prefix=None, access_key=None, secret_access=None):
         self._s3 = None
-        self._s3_wormhole = None
+        self._wormhole = None
         self.bucket = bucket
         self._logger = setup_logger(__name__)
         self.slackBot = SlackNotification(__name__)
@@ -34,19 +39,22 @@ class S3(object):
             self.access_key = None
             self.secret_access = None
 
-        if all([self.access_key, self.secret_access]):
-            self._s3 = boto3.client('s3', region_name=self._region, aws_access_key_id=self.access_key,
-                                    aws_secret_access_key=self.secret_access)
-        else:
-            self._s3 = boto3.client('s3', region_name=self._region)
+        # the client is shared with every other S3 object of the same region and credentials
+        self._s3 = get_client('s3', self._region, self.access_key,
+                              self.secret_access)
 
+    @property
+    def _s3_wormhole(self):
         # Warmhole to support multipart transfers with following config
-
-        self._s3_wormhole = S3Transfer(self._s3,  config=TransferConfig(
-            multipart_threshold=8 * 1024 * 1024,
-            max_concurrency=10,
-            num_download_attempts=10,
-        ))
+        # created on first use, only file transfers need it
+        if self._wormhole is None:
+            from boto3.s3.transfer import S3Transfer, TransferConfig
+            self._wormhole = S3Transfer(self._s3,  config=TransferConfig(
+                multipart_threshold=8 * 1024 * 1024,
+                max_concurrency=10,
+                num_download_attempts=10,
+            ))
+        return self._wormhole
 
     def get(self, key, local_path):
         """Download s3://bucket/key to local_path'."""
@@ -61,6 +69,41 @@ class S3(object):
             self._logger.info("Successfully get {} from S3".format(key))
         return key
 
+    def get_bytes(self, key):
+        """Read s3://bucket/key into memory. Returns None if it cannot be read."""
+        try:
+            body = self._s3.get_object(Bucket=self.bucket,
+                                       Key="{}/{}".format(self.prefix, key) if self.prefix else key)["Body"].read()
+        except Exception as e:
+            self._logger.info(
+                "Could not get {} from S3 due to {}".format(key, e))
+            return None
+        else:
+            self._logger.info("Successfully get {} from S3".format(key))
+        return body
+
+    def get_bytes_if_changed(self, key, etag=None):
+        """
+        Conditional GET of s3://bucket/key into memory.
+        Returns (body, etag); body is None and etag is the given etag when the object still has that etag,
+        and (None, None) when it cannot be read.
+        """
+        kwargs = {"Bucket": self.bucket,
+                  "Key": "{}/{}".format(self.prefix, key) if self.prefix else key}
+        if etag:
+            kwargs["IfNoneMatch"] = etag
+        try:
+            resp = self._s3.get_object(**kwargs)
+        except Exception as e:
+            code = getattr(e, "response", {}).get("Error", {}).get("Code")
+            if etag and code in ("304", "NotModified"):
+                return None, etag
+            self._logger.info(
+                "Could not get {} from S3 due to {}".format(key, e))
+            return None, None
+        self._logger.info("Successfully get {} from S3".format(key))
+        return resp["Body"].read(), resp.get("ETag")
+
     def put(self, local_path, key):
         """Upload local_path to s3: // bucket/key and print upload progress."""
         try:
@@ -76,6 +119,21 @@ class S3(object):
         else:
             self._logger.info("Successfully uploaded {} to S3".format(key))
 
+    def put_bytes(self, body, key):
+        """Upload body from memory to s3://bucket/key. Returns True on success."""
+        try:
+            self._s3.put_object(Bucket=self.bucket,
+                                Key="{}/{}".format(self.prefix,
+                                                   key) if self.prefix else key,
+                                Body=body)
+        except Exception as e:
+            self._logger.info(
+                "Could not upload {} to S3 due to {}".format(key, e))
+            return False
+        else:
+            self._logger.info("Successfully uploaded {} to S3".format(key))
+        return True
+
     def list_objects(self, prefix):
         """Get a list of all keys in an S3 bucket."""
         keys = set()
@@ -103,6 +161,33 @@ class S3(object):
             Bucket=self.bucket, Key=key)
         self._logger.info(f"Successfully deleted s3://{self.bucket}/{key}")
 
+    def delete_many(self, keys, max_workers=4):
+        """
+        Delete keys with delete_objects, DELETE_BATCH_SIZE keys per call, running batches in parallel.
+        Returns the list of {"Key", "Code", "Message"} errors of the keys that were not deleted.
+        """
+        batches = [keys[i:i + DELETE_BATCH_SIZE]
+                   for i in range(0, len(keys), DELETE_BATCH_SIZE)]
+        if not batches:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(len(batches), max_workers)) as executor:
+            errors = list(chain.from_iterable(
+                executor.map(self._delete_batch, batches)))
+        self._logger.info(
+            f"Deleted {len(keys) - len(errors)} of {len(keys)} keys from s3://{self.bucket} in {len(batches)} batches")
+        return errors
+
+    def _delete_batch(self, keys):
+        try:
+            resp = self._s3.delete_objects(Bucket=self.bucket,
+                                           Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True})
+        except Exception as e:
+            self._logger.info(
+                f"Could not delete {len(keys)} keys from s3://{self.bucket} due to {e}")
+            return [{"Key": key, "Code": type(e).__name__, "Message": str(e)} for key in keys]
+        return resp.get("Errors", [])
+
 
 class ProgressPercentage(object):
     def __init__(self, filename):
@@ -0,0 +1,63 @@
+import collections
+import threading
+
+from clock import SYSTEM_CLOCK
+from lib.log import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class ScanBudget:
+    """
+    Admission control of queries by the data they are expected to scan (Task.expected_bytes).
+    A query is admitted while the expected bytes of the admitted queries still running stay under max_bytes_in_flight
+    and, when max_bytes_per_window is set, the expected bytes of the queries admitted in the last window_seconds
+    stay under it. A query bigger than a limit on its own is admitted when nothing else counts against that limit,
+    so it cannot wait forever. Queries without an estimate count as 0 bytes.
+    """
+
+    def __init__(self, max_bytes_in_flight=None, max_bytes_per_window=None, window_seconds=3600, clock=SYSTEM_CLOCK):
+        """
+        :param max_bytes_in_flight: the most expected bytes of running queries, unlimited if None
+        :param max_bytes_per_window: the most expected bytes of the queries admitted in window_seconds, unlimited if None
+        :param window_seconds: the length of the sliding window of max_bytes_per_window
+        :param clock: where the time is read from, the clock of the task queue
+        """
+        self.max_bytes_in_flight = float(max_bytes_in_flight) if max_bytes_in_flight else None
+        self.max_bytes_per_window = float(max_bytes_per_window) if max_bytes_per_window else None
+        self.window_seconds = float(window_seconds)
+        self.clock = clock
+        self.bytes_in_flight = 0
+        self._admitted = collections.deque()
+        self._bytes_in_window = 0
+        self._holders = set()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._admitted and now - self._admitted[0][0] > self.window_seconds:
+            self._bytes_in_window -= self._admitted.popleft()[1]
+
+    def try_admit(self, task):
+        """Counts the task against the budget if it fits, returns whether it did"""
+        expected_bytes = task.expected_bytes or 0
+        with self._lock:
+            now = self.clock.monotonic()
+            self._expire(now)
+            if self.max_bytes_in_flight is not None and self.bytes_in_flight > 0 and \
+                    self.bytes_in_flight + expected_bytes > self.max_bytes_in_flight:
+                return False
+            if self.max_bytes_per_window is not None and self._bytes_in_window > 0 and \
+                    self._bytes_in_window + expected_bytes > self.max_bytes_per_window:
+                return False
+            self.bytes_in_flight += expected_bytes
+            self._bytes_in_window += expected_bytes
+            self._admitted.append((now, expected_bytes))
+            self._holders.add(task)
+            return True
+
+    def release(self, task):
+        """Gives back the in flight bytes of an admitted task"""
+        with self._lock:
+            if task in self._holders:
+                self._holders.discard(task)
+                self.bytes_in_flight = max(self.bytes_in_flight - (task.expected_bytes or 0), 0)
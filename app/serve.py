@@ -0,0 +1,218 @@
+import datetime
+import json
+import os
+import signal
+import socket
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+from lib.log import setup_logger
+from lib.notification import SlackNotification
+from query_slots import QuerySlots
+
+logger = setup_logger(__name__)
+slackBot = SlackNotification(__name__)
+
+
+class SpoolServer:
+    """
+    Long-lived runner that takes jobs from a spool directory.
+    A job is a json file dropped in <spool>/incoming:
+        {"config": "../configs/prod.json", "overrides": {"maxQueries": "2"}}
+    config is the path of a config file (relative paths are relative to the working directory) and
+    overrides are merged into every step of it. Jobs are moved to processing/ when they start and to
+    done/ or failed/ when they end. The state of every job is kept in <spool>/status.json.
+    A job in processing/ has a lease file naming the server running it, renewed every poll; jobs whose server
+    is gone (a dead process on this host, or a lease not renewed for lease_seconds) are put back in incoming/.
+    All jobs share the process-wide boto3 clients and, when max_queries is set, one budget of concurrent queries.
+    """
+
+    def __init__(self, spool_dir, max_jobs=4, max_queries=None, poll_seconds=5, lease_seconds=None):
+        """
+        :param spool_dir: the spool directory
+        :param max_jobs: the number of jobs run at the same time
+        :param max_queries: the number of athena queries run at the same time across all jobs, unlimited if None
+        :param poll_seconds: how often incoming/ is checked for new jobs
+        :param lease_seconds: how long the job of a server on another host is kept after its lease was last renewed,
+                              defaults to 12 polls and at least a minute
+        """
+        self.spool_dir = spool_dir
+        self.max_jobs = int(max_jobs)
+        self.poll_seconds = float(poll_seconds)
+        self.lease_seconds = float(lease_seconds or max(12 * self.poll_seconds, 60))
+        self.owner = {"host": socket.gethostname(), "pid": os.getpid()}
+        self.shared_slots = QuerySlots(max_queries) if max_queries else None
+        self.status_path = os.path.join(spool_dir, "status.json")
+        self.status = self._read_status()
+        self._status_lock = threading.Lock()
+        self._stopping = threading.Event()
+        for name in ("incoming", "processing", "done", "failed"):
+            os.makedirs(self._dir(name), exist_ok=True)
+
+    def _dir(self, name):
+        return os.path.join(self.spool_dir, name)
+
+    def _read_status(self):
+        if os.path.isfile(self.status_path):
+            with open(self.status_path) as f:
+                return json.load(f)
+        return {}
+
+    def _set_status(self, job_id, **fields):
+        with self._status_lock:
+            self.status.setdefault(job_id, {}).update(fields)
+            fd, tmp_path = tempfile.mkstemp(dir=self.spool_dir)
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.status, f, indent=4)
+            os.replace(tmp_path, self.status_path)
+
+    @staticmethod
+    def _now():
+        return str(datetime.datetime.now())
+
+    def stop(self, *args):
+        """Stops taking new jobs, the running jobs are finished first"""
+        logger.info("Stopping, waiting for the running jobs to finish")
+        self._stopping.set()
+
+    def _claim_jobs(self, limit):
+        """Moves up to limit job files from incoming/ to processing/, oldest first"""
+        claimed = []
+        names = sorted((name for name in os.listdir(self._dir("incoming")) if name.endswith(".json")),
+                       key=lambda name: os.path.getmtime(os.path.join(self._dir("incoming"), name)))
+        for name in names[:limit]:
+            path = os.path.join(self._dir("processing"), name)
+            try:
+                # rename is atomic, a job is only claimed once even with several servers on the spool
+                os.rename(os.path.join(self._dir("incoming"), name), path)
+            except OSError:
+                continue
+            self._renew_lease(path)
+            claimed.append(path)
+        return claimed
+
+    @staticmethod
+    def _lease_path(path):
+        return path + ".lease"
+
+    def _renew_lease(self, path):
+        """Writes the lease of a claimed job, or updates its mtime once written"""
+        lease_path = self._lease_path(path)
+        if not os.path.exists(path):
+            # the job just ended
+            return
+        if os.path.exists(lease_path):
+            os.utime(lease_path)
+            return
+        with open(lease_path, "w") as f:
+            json.dump(self.owner, f)
+
+    def _owner_gone(self, path):
+        """Whether the server that claimed a job in processing/ is no longer running it"""
+        lease_path = self._lease_path(path)
+        try:
+            with open(lease_path) as f:
+                owner = json.load(f)
+            renewed = os.path.getmtime(lease_path)
+        except (OSError, ValueError):
+            # no lease yet: the job was just claimed, or claimed by a server that died before writing it
+            owner = None
+            try:
+                renewed = os.stat(path).st_ctime
+            except OSError:
+                return False
+        if owner and owner.get("host") == self.owner["host"]:
+            if owner.get("pid") == self.owner["pid"]:
+                return False
+            try:
+                os.kill(owner["pid"], 0)
+            except ProcessLookupError:
+                return True
+            except OSError:
+                # the process exists but belongs to someone else
+                return False
+            return False
+        return datetime.datetime.now().timestamp() - renewed > self.lease_seconds
+
+    def run_job(self, path):
+        job_id = os.path.basename(path)[:-len(".json")]
+        self._set_status(job_id, state="RUNNING", started=self._now())
+        try:
+            with open(path) as f:
+                job = json.load(f)
+            if not isinstance(job, dict) or "config" not in job:
+                raise ValueError(f"job {job_id} has no config")
+            self._set_status(job_id, config=job["config"])
+            data = Config(job["config"]).data
+            if "steps" not in data:
+                # a single step config
+                data = {"steps": [data]}
+            for step in data["steps"]:
+                step.update(job.get("overrides") or {})
+
+            # imported here, run imports this module for its serve mode
+            from run import run_config
+            run_config(data, self.shared_slots)
+        except Exception as e:
+            logger.exception(f"Job {job_id} failed: {e}")
+            slackBot.warn(f"Job {job_id} failed: {e}")
+            self._set_status(job_id, state="FAILED",
+                             finished=self._now(), error=str(e))
+            self._finish(path, "failed")
+        else:
+            self._set_status(job_id, state="SUCCEEDED",
+                             finished=self._now(), error=None)
+            self._finish(path, "done")
+
+    def _finish(self, path, directory):
+        os.replace(path, os.path.join(
+            self._dir(directory), os.path.basename(path)))
+        try:
+            os.remove(self._lease_path(path))
+        except OSError:
+            pass
+
+    def _requeue_interrupted_jobs(self):
+        # jobs left in processing/ by a server that was killed are run again, not those of live servers
+        for name in os.listdir(self._dir("processing")):
+            path = os.path.join(self._dir("processing"), name)
+            if not name.endswith(".json") or not self._owner_gone(path):
+                continue
+            logger.info(f"Requeueing interrupted job {name}")
+            try:
+                os.replace(path, os.path.join(self._dir("incoming"), name))
+            except OSError:
+                # requeued by another server meanwhile
+                continue
+            try:
+                os.remove(self._lease_path(path))
+            except OSError:
+                pass
+
+    def serve_forever(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.info(
+            f"Serving jobs from {self._dir('incoming')}, {self.max_jobs} at a time")
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_jobs) as executor:
+            while not self._stopping.is_set():
+                running = dict((future, path) for future, path in running.items() if not future.done())
+                for path in running.values():
+                    try:
+                        self._renew_lease(path)
+                    except OSError as e:
+                        logger.info(f"Could not renew the lease of {path}: {e}")
+                # also picks up the jobs of servers that died while this one runs
+                self._requeue_interrupted_jobs()
+                for path in self._claim_jobs(self.max_jobs - len(running)):
+                    job_id = os.path.basename(path)[:-len(".json")]
+                    logger.info(f"Starting job {job_id}")
+                    self._set_status(job_id, state="QUEUED", submitted=self._now(),
+                                     started=None, finished=None, error=None)
+                    running[executor.submit(self.run_job, path)] = path
+                self._stopping.wait(self.poll_seconds)
+        logger.info("Stopped")
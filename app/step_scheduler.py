@@ -0,0 +1,156 @@
+import re
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from lib.log import setup_logger
+from task_queue import shutdown_requested
+
+logger = setup_logger(__name__)
+
+
+class StepSchedulerError(Exception):
+    """
+    Raised when the step graph is invalid or when one or more steps failed
+    """
+
+    def __init__(self, reason):
+        Exception.__init__(
+            self, 'Step scheduler failed: reason {}'.format(reason))
+        self.reason = reason
+
+
+class StepScheduler:
+    """
+    Runs the steps of a config as a DAG.
+    A step depends on the steps named in its `dependsOn` list (matched on `name` or `controlKey`).
+    When `dependsOn` is not set, the dependencies are inferred: a step depends on every earlier step
+    whose `dropTableName` is referenced in its sql.
+    Steps whose dependencies are done are run at the same time, at most max_concurrent_steps at once.
+    With max_concurrent_steps of 1 the steps run one after the other and the first failure stops the run,
+    like a plain loop over the steps.
+    """
+
+    def __init__(self, steps, sqls, max_concurrent_steps=1):
+        """
+        :param steps: the list of step config dicts, in declared order
+        :param sqls: the sql template of each step, in the same order as steps
+        :param max_concurrent_steps: the maximum number of steps to run at any one time
+        :type max_concurrent_steps int
+        """
+        self.steps = steps
+        self.max_concurrent_steps = max(int(max_concurrent_steps or 1), 1)
+        self.dependencies = self._build_dependencies(steps, sqls)
+
+    @staticmethod
+    def step_id(step):
+        return step.get('name') or step['controlKey']
+
+    def _build_dependencies(self, steps, sqls):
+        ids = [self.step_id(step) for step in steps]
+        if len(set(ids)) != len(ids):
+            raise StepSchedulerError(
+                "step names/controlKeys must be unique: {}".format(ids))
+
+        dependencies = {}
+        for index, step in enumerate(steps):
+            if step.get('dependsOn') is not None:
+                depends_on = step['dependsOn']
+                if isinstance(depends_on, str):
+                    depends_on = [depends_on] if depends_on else []
+                for dependency in depends_on:
+                    if dependency not in ids:
+                        raise StepSchedulerError(
+                            "step {} depends on unknown step {}".format(ids[index], dependency))
+                dependencies[ids[index]] = set(depends_on)
+            else:
+                dependencies[ids[index]] = set(
+                    ids[i] for i in range(index)
+                    if self._references_table(sqls[index], steps[i].get('dropTableName')))
+
+            logger.info(
+                f"Step {ids[index]} depends on {sorted(dependencies[ids[index]])}")
+
+        self._check_acyclic(ids, dependencies)
+        return dependencies
+
+    @staticmethod
+    def _references_table(sql, table_name):
+        if not sql or not table_name:
+            return False
+        return re.search(r"(?<![\w.]){}(?!\w)".format(re.escape(table_name.lower())), sql.lower()) is not None
+
+    @staticmethod
+    def _check_acyclic(ids, dependencies):
+        visiting, done = set(), set()
+
+        def visit(step_id):
+            if step_id in done:
+                return
+            if step_id in visiting:
+                raise StepSchedulerError(
+                    "dependency cycle through step {}".format(step_id))
+            visiting.add(step_id)
+            for dependency in dependencies[step_id]:
+                visit(dependency)
+            visiting.discard(step_id)
+            done.add(step_id)
+
+        for step_id in ids:
+            visit(step_id)
+
+    def run(self, process_step):
+        """
+        Runs process_step(step, index) for every step, respecting dependencies.
+        When steps run concurrently, a failed step skips its dependants and the other steps keep running,
+        StepSchedulerError is raised at the end if any step failed or was skipped.
+        When they run one at a time, the error of the first step to fail is raised and the later steps are not run.
+        """
+        fail_fast = self.max_concurrent_steps == 1
+        ids = [self.step_id(step) for step in self.steps]
+        remaining = list(range(len(self.steps)))
+        succeeded, failed = set(), {}
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_steps) as executor:
+            while remaining or running:
+                # skip steps that can never run because a dependency failed
+                for index in list(remaining):
+                    blocked_by = self.dependencies[ids[index]] & set(failed)
+                    if blocked_by:
+                        logger.info(
+                            f"Skipping step {ids[index]} because {sorted(blocked_by)} did not succeed")
+                        failed[ids[index]] = "skipped"
+                        remaining.remove(index)
+
+                if shutdown_requested():
+                    for index in remaining:
+                        failed[ids[index]] = "not started, shutdown requested"
+                    remaining = []
+
+                # start ready steps in declared order
+                for index in list(remaining):
+                    if len(running) >= self.max_concurrent_steps:
+                        break
+                    if self.dependencies[ids[index]] <= succeeded:
+                        logger.info(f"Starting step {ids[index]}")
+                        running[executor.submit(
+                            process_step, self.steps[index], index)] = index
+                        remaining.remove(index)
+
+                if not running:
+                    continue
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    index = running.pop(future)
+                    error = future.exception()
+                    if error:
+                        logger.error(f"Step {ids[index]} failed: {error}")
+                        failed[ids[index]] = str(error)
+                        if fail_fast:
+                            raise error
+                    else:
+                        logger.info(f"Step {ids[index]} succeeded")
+                        succeeded.add(ids[index])
+
+        if failed:
+            raise StepSchedulerError(failed)
@@ -15,3 +15,29 @@ class Task:
         self.id = None
         self.retries = 0
         self.name = name
+        self.expected_seconds = None
+        # the expected bytes scanned by the task, see ScanBudget
+        self.expected_bytes = None
+        # the expected run time used to order pending tasks, see AthenaClient scheduling_policy
+        self.schedule_seconds = None
+        self.started_at = None
+        # when the task was added to its queue, time.monotonic()
+        self.added_at = None
+        self.late_polls = 0
+        # when a task backing off after a transient error can start again, see TaskQueue._back_off
+        self.retry_at = None
+        # tasks that must succeed before this task can start
+        self.depends_on = []
+        # tasks that must be done, succeeded or failed for good, before this task can start
+        self.runs_after = []
+        # tasks waiting on this task, and the number of depends_on and runs_after tasks that are not done yet
+        self.dependents = []
+        self.unmet_dependencies = 0
+        # the order the task was added to its queue in
+        self.sequence = 0
+        # the run time after which a duplicate of the task is started, None to never duplicate it
+        self.hedge_after = None
+        # the running duplicate of the task, or for a duplicate the task it duplicates
+        self.hedge = None
+        self.hedge_of = None
+        self.hedged = False
@@ -1,13 +1,71 @@
 from lib.log import setup_logger
 from lib.notification import SlackNotification
-import time
-import queue
+from lib import trace
+import asyncio
+import concurrent.futures
+import threading
+import heapq
+import itertools
+import math
+import random
+from collections import Counter
 from task import Task
-import datetime
+from clock import SYSTEM_CLOCK
 
 logger = setup_logger(__name__)
 slackbot = SlackNotification(__name__)
 
+# the most pending tasks passed over per poll because they do not fit the scan budget
+ADMISSION_LOOKAHEAD = 64
+
+# number of threads running the blocking aws calls of all queues
+EXECUTOR_WORKERS = 32
+
+# error classes, see TaskQueue._classify_error: a transient error is retried after a back off, a permanent one is not
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# the event loop driving the queues of every step and config of the process, on its own thread
+_loop = None
+_loop_lock = threading.Lock()
+
+
+# set by request_shutdown, for example on SIGTERM: every queue stops polling at its next check
+_shutdown = threading.Event()
+
+
+def request_shutdown(*args):
+    """Makes every queue of the process stop waiting for its tasks, usable as a signal handler"""
+    logger.info("Shutdown requested")
+    _shutdown.set()
+
+
+def shutdown_requested():
+    return _shutdown.is_set()
+
+
+def _shared_executor():
+    """The thread pool shared by all queues, created on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=EXECUTOR_WORKERS, thread_name_prefix="task-queue")
+        return _executor
+
+
+def _shared_loop():
+    """The event loop shared by all queues, started on a daemon thread on first use"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="task-queue-loop", daemon=True).start()
+        return _loop
+
 
 class RetryException(Exception):
     def __init__(self, reason):
@@ -16,6 +74,13 @@ class RetryException(Exception):
         self.reason = reason
 
 
+class FailedTasksException(Exception):
+    def __init__(self, tasks):
+        Exception.__init__(self, '{0} tasks failed: {1}'.format(
+            len(tasks), ", ".join("{0} ({1})".format(task.name, task.error) for task in tasks[:10])))
+        self.tasks = tasks
+
+
 class TaskQueue:
     """
     This is an abstract class that contains all required common functionality to
@@ -25,72 +90,237 @@ class TaskQueue:
                    Once tasks are completed they are removed from this queue.
                    No. of tasks in active queue <= max_size.
     pending_queue - Contains tasks that are awaiting execution.
-                    Tasks from pending_queue are added to active_queue in FIFO
-                    fashion.
+                    Tasks from pending_queue are added to active_queue by priority, then in FIFO
+                    fashion. It is a heap of the tasks that are ready to run; tasks whose
+                    dependencies have not succeeded yet are held aside until they have, and
+                    tasks being retried wait out their back off in a heap by retry time.
+    The number of active tasks by priority and by name are counted as tasks come and go,
+    so the work per poll does not grow with the number of pending tasks.
     """
 
-    def __init__(self, max_size, retry_limit=3, timeout_minutes=10, sleep_seconds=10):
-        self.pending_tasks = []
+    def __init__(self, max_size, retry_limit=3, timeout_minutes=10, sleep_seconds=10, poll_scheduler=None,
+                 shared_slots=None, retry_base_seconds=5, retry_max_seconds=300):
+        self._pending_heap = []
+        self._blocked_tasks = set()
+        self._backoff_heap = []
+        self._pending_by_priority = Counter()
+        self._sequence = itertools.count()
         self.active_queue = []
+        self._active_by_priority = Counter()
+        self._active_by_name = Counter()
         self.max_size = int(max_size)
         self.retry_limit = retry_limit
+        # a task is retried after retry_base_seconds, doubled on every retry up to retry_max_seconds, with jitter
+        self.retry_base_seconds = float(retry_base_seconds)
+        self.retry_max_seconds = float(retry_max_seconds)
+        # the tasks that failed for good, wait_for_completion raises FailedTasksException at the end if any
+        self.failed_tasks = []
         self.timeout_minutes = int(timeout_minutes)
         self.timeout_seconds = int(timeout_minutes)*60
         self.sleep_seconds = int(sleep_seconds)
-        self.interleaved_priority = False
+        # when None, sleep_seconds is slept between every poll
+        self.poll_scheduler = poll_scheduler
+        # a QuerySlots budget shared with other queues, a slot is held by every active task
+        self.shared_slots = shared_slots
+        # a ScanBudget limiting the expected bytes scanned by the active tasks, None for no limit
+        self.scan_budget = None
+        # where the queue reads the time and sleeps, a VirtualClock in simulations
+        self.clock = SYSTEM_CLOCK
+        # the name of the queue in traces
+        self.trace_name = type(self).__name__
+        # the concurrent.futures executor the blocking aws calls run on, a thread pool shared by all queues if None
+        self.executor = None
+        self._in_flight = set()
 
-    def add_task(self, name, priority, args):
-        """This method adds a tasks to the pending_tasks queue"""
+    def add_task(self, name, priority, args, expected_seconds=None, depends_on=None, schedule_seconds=None,
+                 runs_after=None):
+        """This method adds a tasks to the pending_tasks queue
+           depends_on is a list of tasks that must succeed before this task starts
+           runs_after is a list of tasks that must be done before this task starts, but may have failed
+           schedule_seconds is the expected run time used to order pending tasks, defaults to expected_seconds
+        """
 
         task = Task(name, priority, args)
-        self.pending_tasks.append(task)
+        task.expected_seconds = expected_seconds
+        task.schedule_seconds = expected_seconds if schedule_seconds is None else schedule_seconds
+        task.depends_on = list(depends_on or [])
+        task.runs_after = []
+        task.sequence = next(self._sequence)
+        task.added_at = self.clock.monotonic()
+        self._pending_by_priority[task.priority] += 1
+
+        for dependency in task.depends_on:
+            if not (dependency.is_complete and not dependency.error):
+                dependency.dependents.append(task)
+                task.unmet_dependencies += 1
+        for dependency in runs_after or []:
+            self._run_after(task, dependency)
+
+        if task.unmet_dependencies:
+            self._blocked_tasks.add(task)
+        else:
+            self._push_pending(task)
 
         return task
 
-    # check status of each task in active queue and update its status based on if it has error
-    def _empty_active_queue(self):
+    def _run_after(self, task, dependency):
         """
-        Removes completed task from active queue and populates freed spots with tasks
-        in the front of pending_tasks queue
+        Makes a task that is not in the pending heap yet wait until dependency is done, succeeded or failed.
+        A task backing off is held aside when its back off ends before the dependency is done.
         """
-        logger.info(
-            "[Athena Runner Step 4.1/5] check queries status for tasks in active queue... ")
+        task.runs_after.append(dependency)
+        if not (dependency.is_complete and not dependency.error) and dependency not in self.failed_tasks:
+            dependency.dependents.append(task)
+            task.unmet_dependencies += 1
 
-        # Remove completed tasks from active queue
-        for index, task in enumerate(self.active_queue):
-            self._update_task_status(task)
-            if task.error:
-                if task.retries < self.retry_limit:
-                    logger.info("Retrying job {0}, previously raised error with error {1}".
-                                format(task.name, task.error))
-                    task.retries += 1
-                    task.error = None
-                    self._trigger_task(task)
-                else:
-                    task.is_complete = True
-                    self.active_queue.pop(index)
-                    raise RetryException("{0} [name: '{1}', id: {2}]".format(
-                                         task.error, task.name, task.id))
-
-            if task.is_complete:
-                if task.error:
-                    logger.error("Task failed: ID {0}, error is {1}".format(
-                        task.id, task.error))
-                else:
-                    logger.info("Task is completed: ID {0}".format(task.id))
-                self.active_queue.pop(index)
+    def _sort_key(self, task):
+        """The order pending tasks are started in, lowest first"""
+        return (task.priority,)
 
-        self._log_priorities_status_in_both_queues()
+    def _push_pending(self, task):
+        heapq.heappush(self._pending_heap,
+                       (self._sort_key(task), task.sequence, task))
+
+    def _pop_pending(self):
+        task = heapq.heappop(self._pending_heap)[2]
+        self._pending_by_priority[task.priority] -= 1
+        return task
+
+    def _release_dependents(self, task):
+        """Moves the tasks that were only waiting on the given, succeeded, task to the pending heap"""
+        for dependent in task.dependents:
+            self._release_dependent(dependent)
+        task.dependents = []
+
+    def _release_dependent(self, dependent):
+        """Counts one more dependency of the task as met, and moves it to the pending heap if it was the last one"""
+        dependent.unmet_dependencies -= 1
+        if dependent.unmet_dependencies == 0 and dependent in self._blocked_tasks:
+            self._blocked_tasks.discard(dependent)
+            self._push_pending(dependent)
+
+    def _fail_task(self, task):
+        """
+        Records the task as failed for good, and every task that depends on it, which will never be able to start.
+        The tasks that only run after it are released as if it had succeeded.
+        """
+        failed = [task]
+        while failed:
+            task = failed.pop()
+            self.failed_tasks.append(task)
+            self._task_failed(task)
+            for dependent in task.dependents:
+                if task in dependent.runs_after and task not in dependent.depends_on:
+                    self._release_dependent(dependent)
+                elif dependent in self._blocked_tasks:
+                    self._blocked_tasks.discard(dependent)
+                    self._pending_by_priority[dependent.priority] -= 1
+                    dependent.is_complete = True
+                    dependent.error = "depends on {0} which failed".format(task.name)
+                    logger.error("Task failed: {0}, {1}".format(dependent.name, dependent.error))
+                    failed.append(dependent)
+            task.dependents = []
+
+    def _task_failed(self, task):
+        """Called for every task that failed for good, including the tasks depending on it. Does nothing by default"""
+        pass
+
+    def _classify_error(self, task):
+        """
+        Whether the error of a task is TRANSIENT or PERMANENT. Every error is retried by default,
+        subclasses tell the errors that running the task again cannot fix apart.
+        """
+        return TRANSIENT
+
+    def _retry_delay(self, task):
+        """The back off before a task is retried: exponential in its retries, with equal jitter"""
+        delay = min(self.retry_base_seconds * 2 ** max(task.retries - 1, 0), self.retry_max_seconds)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _back_off(self, task):
+        """Moves a failed task out of the active queue, to be pending again once its back off is over"""
+        task.retries += 1
+        delay = self._retry_delay(task)
+        logger.info("Retrying job {0} in {1:.1f}s, previously raised error {2}".format(
+            task.name, delay, task.error))
+        task.error = None
+        task.retry_at = self.clock.monotonic() + delay
+        self._deactivate(task)
+        self._pending_by_priority[task.priority] += 1
+        heapq.heappush(self._backoff_heap, (task.retry_at, task.sequence, task))
+
+    def _release_backed_off_tasks(self):
+        """Moves the tasks whose back off is over to the pending heap"""
+        now = self.clock.monotonic()
+        while self._backoff_heap and self._backoff_heap[0][0] <= now:
+            task = heapq.heappop(self._backoff_heap)[2]
+            if task.unmet_dependencies:
+                self._blocked_tasks.add(task)
+            else:
+                self._push_pending(task)
+
+    def _activate(self, task):
+        """Adds the task to the active queue, its shared slot must already be acquired"""
+        self.active_queue.append(task)
+        self._active_by_priority[task.priority] += 1
+        self._active_by_name[task.name] += 1
+        trace.slot_acquired(self.trace_name, task)
+
+    def _deactivate(self, task):
+        trace.slot_released(self.trace_name, task)
+        self._active_by_priority[task.priority] -= 1
+        if self._active_by_priority[task.priority] == 0:
+            del self._active_by_priority[task.priority]
+        self._active_by_name[task.name] -= 1
+        if self._active_by_name[task.name] == 0:
+            del self._active_by_name[task.name]
+        if self.shared_slots is not None:
+            self.shared_slots.release(self)
+        if self.scan_budget is not None:
+            self.scan_budget.release(task)
+
+    def _start_task(self, task):
+        """Triggers the task and records when it started"""
+        task.started_at = self.clock.monotonic()
+        task.late_polls = 0
+        self._trigger_task(task)
+
+    def _tasks_to_refresh(self):
+        """The active tasks whose status is refreshed, all but those that failed to start"""
+        return [task for task in self.active_queue if not task.error]
+
+    def _settle_active_queue(self):
+        """
+        Removes completed and failed tasks from the active queue, from their refreshed status.
+        A task with a TRANSIENT error and retries left gives up its slot and is pending again after a back off.
+        A task with a PERMANENT error, or out of retries, fails for good along with the tasks depending on it;
+        the other tasks keep running.
+        """
+        still_active = []
+        for task in self.active_queue:
+            if task.error:
+                error_class = self._classify_error(task)
+                if error_class == TRANSIENT and task.retries < self.retry_limit:
+                    self._back_off(task)
+                    continue
+                logger.error("Task failed: {0} [id: {1}] after {2} retries, {3} error {4}".format(
+                    task.name, task.id, task.retries, error_class, task.error))
+                task.is_complete = True
+                self._deactivate(task)
+                self._fail_task(task)
+            elif task.is_complete:
+                logger.info("Task is completed: ID {0}".format(task.id))
+                self._release_dependents(task)
+                self._deactivate(task)
+            else:
+                still_active.append(task)
+        self.active_queue = still_active
 
     def _running_jobs(self, job_name):
         """
         Return the number of concurrent jobs
         """
-        running_jobs = 0
-        for each_job in self.active_queue:
-            if each_job.name == job_name:
-                running_jobs += 1
-        return running_jobs
+        return self._active_by_name[job_name]
 
     @property
     def number_active(self):
@@ -98,81 +328,202 @@ class TaskQueue:
 
     @property
     def number_pending(self):
-        return len(self.pending_tasks)
+        return len(self._pending_heap) + len(self._blocked_tasks) + len(self._backoff_heap)
+
+    @property
+    def pending_tasks(self):
+        """All pending tasks, ready ones first in the order they will start, then the ones backing off"""
+        return [entry[2] for entry in sorted(self._pending_heap)] + \
+            [entry[2] for entry in sorted(self._backoff_heap)] + \
+            sorted(self._blocked_tasks, key=lambda task: task.sequence)
 
     @property
     def remaining_queries(self):
-        return len(self.pending_tasks)+len(self.active_queue)
+        return self.number_pending+len(self.active_queue)
 
     @property
     def max_priority_in_active_queue(self):
         if len(self.active_queue) == 0:
             return 999
-        return max(list(map(lambda task: task.priority, self.active_queue)))
-
-    def _fill_active_queue(self):
+        # only a handful of distinct priorities are ever active
+        return max(self._active_by_priority)
 
-        logger.info("[Athena Runner Step 4.2/5] move task from pending queue to active queue if there's task in pending queue and execute queries in the tasks ... ")
-        # Add add tasks to active queue if size of queue is less the max query limit
-        for i in range(0, self.max_size - self.number_active):
-            if len(self.pending_tasks) > 0:
-                task = self.pending_tasks[0]
+    def _admit_pending_tasks(self):
+        """
+        Moves tasks from the pending heap to the active queue while there is room, acquiring their shared slots.
+        Tasks that do not fit the scan budget are passed over, up to ADMISSION_LOOKAHEAD of them,
+        so lighter tasks behind them can start; they keep their place in the heap.
+        Returns the admitted tasks, which must then be started.
+        """
+        admitted = []
+        deferred = []
+        self._release_backed_off_tasks()
+        try:
+            # Add add tasks to active queue if size of queue is less the max query limit
+            # only tasks whose dependencies have succeeded are in the pending heap
+            while self.number_active < self.max_size and self._pending_heap:
+                task = self._pending_heap[0][2]
                 logger.info("\nmax_priority_in_active_queue is " +
                             str(self.max_priority_in_active_queue))
                 if task.priority <= self.max_priority_in_active_queue:
-                    if self.interleaved_priority:
-                        if len(self.active_queue) == 0:
-                            self.active_queue.append(task)
-                            self.pending_tasks.pop(0)
-                            self._trigger_task(task)
-                        else:
+                    if self.shared_slots is not None and not self.shared_slots.try_acquire(self):
+                        logger.info(
+                            "pending because all shared query slots are in use")
+                        break
+                    if self.scan_budget is not None and not self.scan_budget.try_admit(task):
+                        if self.shared_slots is not None:
+                            self.shared_slots.release(self)
+                        if len(deferred) >= ADMISSION_LOOKAHEAD:
                             logger.info(
-                                f"pending at {task.priority} due to interleaved priority requirement")
-
-                            self._log_priorities_status_in_both_queues()
-                    else:
-                        self.active_queue.append(task)
-                        self.pending_tasks.pop(0)
-                        self._trigger_task(task)
+                                "pending because the scan budget is used up")
+                            break
+                        deferred.append(heapq.heappop(self._pending_heap))
+                        continue
+                    self._pop_pending()
+                    self._activate(task)
+                    admitted.append(task)
                 else:
                     logger.info(
                         f"pending at {task.priority} due to priority > max priority")
-                    self._log_priorities_status_in_both_queues()
-            else:
-                break
-        self._log_priorities_status_in_both_queues()
+                    break
+        finally:
+            for entry in deferred:
+                heapq.heappush(self._pending_heap, entry)
+        if deferred:
+            logger.info(
+                f"{len(deferred)} tasks wait for scan budget, expected bytes in flight {self.scan_budget.bytes_in_flight:.0f}")
+        return admitted
 
     def _log_priorities_status_in_both_queues(self):
         logger.info("Current active queue is : " +
                     str(list(map(lambda task: task.priority, self.active_queue))))
-        logger.info("Current pending queue is : " +
-                    str(list(map(lambda task: task.priority, self.pending_tasks))))
+        logger.info("Current pending queue by priority is : " +
+                    str(dict((priority, count) for priority, count in sorted(self._pending_by_priority.items()) if count)) +
+                    f", {len(self._blocked_tasks)} waiting on dependencies")
 
     def wait_for_completion(self):
         """
-        This method runs until execution of all tasks is completed
+        This method runs until execution of all tasks is completed.
+        The queue is driven by the event loop shared by the process, so the steps and configs run by
+        several threads are all polled from one loop; the calling thread only waits for the result.
         """
+        finished = threading.Event()
+
+        async def run():
+            try:
+                return await self.wait_for_completion_async()
+            finally:
+                finished.set()
 
-        start_time = datetime.datetime.now()
+        future = asyncio.run_coroutine_threadsafe(run(), _shared_loop())
+        try:
+            return future.result()
+        except BaseException:
+            # interrupted while waiting (KeyboardInterrupt...): cancel the run, and wait for it to stop its tasks
+            future.cancel()
+            finished.wait()
+            raise
 
-        while self.number_active > 0 or self.number_pending > 0:
-            logger.info("{} active tasks are awaiting execution".format(
-                self.number_active))
-            logger.info(f" ^ queries remaining {self.remaining_queries}")
+    async def wait_for_completion_async(self):
+        """
+        Runs until execution of all tasks is completed, from an event loop.
+        The blocking aws calls run on self.executor (a shared thread pool by default): the status of
+        each batch of active tasks is refreshed concurrently, and the admitted tasks are started concurrently.
+        wait_for_completion runs it on the event loop shared by the process, several queues can also be
+        awaited together from any other loop.
+        When cancelled, the aws calls already running are waited for before the cancellation goes on,
+        so every started task has its id and can be stopped.
+        Raises FailedTasksException once no task is left to run if some tasks failed for good.
+        """
+
+        start_time = self.clock.monotonic()
+        try:
+            while self.number_active > 0 or self.number_pending > 0:
+                logger.info("{} active tasks are awaiting execution".format(
+                    self.number_active))
+                logger.info(f" ^ queries remaining {self.remaining_queries}")
+
+                if self.clock.monotonic() - start_time > self.timeout_seconds:
+                    msg = "Timeout. Execution took longer than {} minutes".format(
+                        str(self.timeout_minutes))
+                    logger.info(msg)
+                    slackbot.warn(msg)
+                    break
+                if shutdown_requested():
+                    logger.info(
+                        f"Stopping with {self.number_active} active tasks, shutdown requested")
+                    break
 
-            if (datetime.datetime.now() - start_time).total_seconds() > self.timeout_seconds:
-                msg = "Timeout. Execution took longer than {} minutes".format(
-                    str(self.timeout_minutes))
+                await self._poll()
+                sleep_seconds = self._next_sleep_seconds(start_time)
+                msg = f" ~ sleeping for {str(sleep_seconds)}"
                 logger.info(msg)
-                slackbot.warn(msg)
-                break
-            self._empty_active_queue()
-            self._fill_active_queue()
-            msg = f" ~ sleeping for {str(self.sleep_seconds)}"
-            logger.info(msg)
-            time.sleep(self.sleep_seconds)
+                with trace.span("sleep", seconds=sleep_seconds):
+                    await self._sleep(sleep_seconds)
+        except asyncio.CancelledError:
+            logger.info(
+                f"Cancelled, waiting for {len(self._in_flight)} running aws calls")
+            concurrent.futures.wait(list(self._in_flight))
+            raise
 
         logger.info("Done")
+        if self.failed_tasks:
+            raise FailedTasksException(self.failed_tasks)
+
+    def _submit(self, fn, *args):
+        """Runs a blocking call on self.executor, returns an awaitable of its result"""
+        future = (self.executor or _shared_executor()).submit(fn, *args)
+        self._in_flight.add(future)
+        future.add_done_callback(self._in_flight.discard)
+        return asyncio.wrap_future(future)
+
+    async def _poll(self):
+        """
+        One poll cycle: refreshes the status of the active tasks, settles the completed and failed ones,
+        then starts pending tasks in the free slots
+        """
+        logger.info(
+            "[Athena Runner Step 4.1/5] check queries status for tasks in active queue... ")
+        with trace.span("empty active queue", active=self.number_active):
+            await asyncio.gather(*(self._submit(self._update_task_statuses, batch)
+                                   for batch in self._status_batches(self._tasks_to_refresh())))
+            # on the executor too, settling can call aws (AthenaClient stops the losing query of a hedge)
+            await self._submit(self._settle_active_queue)
+        logger.info("[Athena Runner Step 4.2/5] move task from pending queue to active queue if there's task in pending queue and execute queries in the tasks ... ")
+        with trace.span("fill active queue", pending=self.number_pending):
+            to_start = self._admit_pending_tasks()
+            await asyncio.gather(*(self._submit(self._start_task, task) for task in to_start))
+        self._log_priorities_status_in_both_queues()
+
+        with trace.span("end poll cycle"):
+            await self._submit(self._end_poll_cycle)
+
+    async def _sleep(self, seconds):
+        """Sleeps for the given seconds, or until a shutdown is requested"""
+        deadline = self.clock.monotonic() + seconds
+        while not shutdown_requested():
+            remaining = deadline - self.clock.monotonic()
+            if remaining <= 0:
+                break
+            await self.clock.sleep(min(remaining, 1))
+
+    def _next_sleep_seconds(self, start_time):
+        """
+        How long to sleep before the next poll, never past the timeout
+        """
+        if self.poll_scheduler is None:
+            return self.sleep_seconds
+
+        sleep_seconds = self.poll_scheduler.next_sleep(
+            self.active_queue, self.clock.monotonic(), waiting=bool(self._pending_heap))
+        if self._backoff_heap:
+            # wake up for the next retry
+            sleep_seconds = min(sleep_seconds, max(
+                self._backoff_heap[0][0] - self.clock.monotonic(), 0))
+        seconds_to_timeout = self.timeout_seconds - \
+            (self.clock.monotonic() - start_time)
+        # rounded up to the millisecond: a retry due in less than that must not make the queue poll without sleeping
+        return math.ceil(max(min(sleep_seconds, seconds_to_timeout), 0) * 1000) / 1000
 
     def _trigger_task(self, task):
         """
@@ -187,10 +538,29 @@ class TaskQueue:
         """
         raise NotImplementedError("must be implemented by subclass")
 
+    def _update_task_statuses(self, tasks):
+        """Updates the status of several tasks at once.
+           Subclasses can override this to use a batch api, by default each task is updated on its own
+        """
+        for task in tasks:
+            self._update_task_status(task)
+
+    def _status_batches(self, tasks):
+        """Splits the tasks into the batches whose status can be refreshed concurrently by
+           _update_task_statuses, by default one batch
+        """
+        return [tasks] if tasks else []
+
+    def _end_poll_cycle(self):
+        """Called once per poll cycle, after the queues are updated. Does nothing by default"""
+        pass
+
     def _empty_pending_queue(self):
         """
         Empty pending queue of tasks - prevent them from being run
         :return: None
         """
-        while len(self.pending_tasks) > 0:
-            self.pending_tasks.pop()
+        self._pending_heap = []
+        self._blocked_tasks = set()
+        self._backoff_heap = []
+        self._pending_by_priority = Counter()
@@ -0,0 +1,48 @@
+"""
+Import-time benchmark of the runner entry point.
+
+Imports app/run.py in fresh interpreters with -X importtime and reports the median total import time,
+the slowest modules, and whether the heavy AWS/http modules were imported before any config is read.
+
+usage: python benchmarks/bench_import_time.py [repeats]
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+HEAVY_MODULES = ("boto3", "botocore", "s3transfer", "requests", "awsretry")
+
+
+def import_times():
+    """Returns {module: cumulative microseconds} for one fresh import of run"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import run"],
+                            cwd=APP_DIR, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            times[module.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    runs = [import_times() for _ in range(repeats)]
+    print(f"import run: median {statistics.median(run['run'] for run in runs) / 1000:.1f} ms over {repeats} runs")
+
+    slowest = sorted(runs[-1].items(), key=lambda item: -item[1])[:10]
+    print("slowest modules (cumulative ms):")
+    for module, cumulative in slowest:
+        print(f"  {cumulative / 1000:8.1f}  {module}")
+
+    loaded = subprocess.run([sys.executable, "-c", "import run, sys; print(' '.join(m for m in {} if m in sys.modules))".format(HEAVY_MODULES)],
+                            cwd=APP_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    print(f"heavy modules imported by run: {loaded or 'none'}")
+
+
+if __name__ == '__main__':
+    main()
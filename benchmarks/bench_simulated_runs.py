@@ -0,0 +1,132 @@
+"""
+Simulated runs of AthenaClient against the in-process fakes of benchmarks/fake_aws.py, on a virtual clock.
+
+For synthetic backlogs of pending hour jobs (1, 7 and 30 days by default, and a year with --year) it runs the real scheduler and reports
+    makespan        - simulated time from the first query to the last
+    utilization     - the average share of the maxQueries slots in use
+    calls/query     - athena api calls per succeeded hour job, throttled calls included
+    control writes  - the number of control file uploads and the bytes written
+    wall            - the real time the simulation took
+
+usage: python benchmarks/bench_simulated_runs.py [--days 1 7 30] [--year] [--max-queries 5] [--sleep-seconds 10]
+           [--duration lognormal:60,0.5] [--failure-rate 0.01] [--throttle-rate 0.0] [--adaptive-polling] [--poll-backoff 2]
+           [--scheduling-policy fifo] [--control-flush-seconds 0] [--seed 0]
+"""
+import argparse
+import datetime
+import logging
+import os
+import random
+import sys
+import time
+import types
+
+import awsretry
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "..", "app"))
+
+from fake_aws import FakeAthena, FakeS3, duration_distribution  # noqa: E402
+from lib.clients import clear_clients, register_client  # noqa: E402
+import lib.notification  # noqa: E402
+from athena import AthenaClient  # noqa: E402
+from clock import VirtualClock  # noqa: E402
+from control_data import ControlData  # noqa: E402
+from metrics import RunMetrics  # noqa: E402
+from s3 import S3  # noqa: E402
+
+REGION = "ap-southeast-2"
+BUCKET = "athena-runner-bench"
+
+
+def backlog_control(days):
+    """A control file with every hour of the last days pending"""
+    first = datetime.date.today() - datetime.timedelta(days=days)
+    return {"datelist": [{"year": str(day.year), "month": str(day.month).zfill(2), "day": str(day.day).zfill(2),
+                          "hourlist": [{"hour": hour, "queryid": "", "state": "", "dataScannedInBytes": None,
+                                        "runTimeInMillis": None, "startTime": None, "workgroup": None}
+                                       for hour in range(24)]}
+                         for day in (first + datetime.timedelta(days=i) for i in range(days))]}
+
+
+def simulate(days, args):
+    clock = VirtualClock()
+    # throttled calls are retried by awsretry, whose back off must sleep on the virtual clock too
+    awsretry.time = types.SimpleNamespace(sleep=clock.advance)
+    athena = FakeAthena(clock, duration_distribution(args.duration, random.Random(args.seed)),
+                        failure_rate=args.failure_rate, throttle_rate=args.throttle_rate, seed=args.seed)
+    s3 = FakeS3()
+    clear_clients()
+    register_client("athena", REGION, athena)
+    register_client("s3", REGION, s3)
+
+    config = {"database": "default", "workgroup": "primary", "resultsLocation": f"s3://{BUCKET}/results/",
+              "controlBucket": BUCKET, "controlKey": "bench/control.json",
+              # no days are appended to the backlog
+              "controlDays": "-2", "appendHours": "true"}
+    control_data = ControlData(backlog_control(days), config)
+    metrics = RunMetrics("bench", clock)
+    client = AthenaClient(db=config["database"], max_queries=args.max_queries, max_retries=3,
+                          timeout_minutes=10 ** 7, sleep_seconds=args.sleep_seconds, workgroup=config["workgroup"],
+                          control_s3=S3(bucket=BUCKET), control_key=config["controlKey"], control_data=control_data,
+                          adaptive_polling=args.adaptive_polling, min_sleep_seconds=1, poll_backoff=args.poll_backoff,
+                          max_sleep_seconds=max(args.sleep_seconds, 60),
+                          control_flush_seconds=args.control_flush_seconds,
+                          scheduling_policy=args.scheduling_policy, metrics=metrics, clock=clock)
+    for hour_job in control_data.pending_hour_jobs():
+        client.add_query(config, "select * from bench where dt = '<date>' and hour = <hour>", hour_job)
+
+    started = time.perf_counter()
+    try:
+        client.wait_for_completion()
+        error = None
+    except Exception as e:
+        error = e
+    wall = time.perf_counter() - started
+
+    summary = metrics.summary()
+    succeeded = sum(hour_job["state"] == "SUCCEEDED" for day in control_data.date_list for hour_job in day["hourlist"])
+    return {"days": days,
+            "hour jobs": days * 24,
+            "succeeded": succeeded,
+            "makespan s": clock.monotonic(),
+            "utilization": summary["slotOccupancy"] or 0.0,
+            "calls/query": sum(athena.calls.values()) / max(succeeded, 1),
+            "throttled": athena.throttled,
+            "control writes": s3.calls["PutObject"],
+            "control MB": sum(s3.bytes_written.values()) / 1e6,
+            "wall s": wall,
+            "error": type(error).__name__ if error else ""}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--days", type=int, nargs="+", default=[1, 7, 30])
+    # a year of backlog takes minutes of wall time, so it is only run on request
+    parser.add_argument("--year", action="store_true", help="also simulate a backlog of 365 days")
+    parser.add_argument("--max-queries", type=int, default=5)
+    parser.add_argument("--sleep-seconds", type=int, default=10)
+    parser.add_argument("--duration", default="lognormal:60,0.5")
+    parser.add_argument("--failure-rate", type=float, default=0.01)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--adaptive-polling", action="store_true")
+    parser.add_argument("--poll-backoff", type=float, default=2)
+    parser.add_argument("--scheduling-policy", default="fifo")
+    parser.add_argument("--control-flush-seconds", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    lib.notification.SlackNotification.warn = lambda self, message: None
+
+    columns = ["days", "hour jobs", "succeeded", "makespan s", "utilization", "calls/query",
+               "throttled", "control writes", "control MB", "wall s", "error"]
+    print(" ".join(f"{column:>14}" for column in columns))
+    for days in args.days + ([365] if args.year and 365 not in args.days else []):
+        result = simulate(days, args)
+        print(" ".join(f"{result[column]:>14.2f}" if isinstance(result[column], float) else f"{result[column]:>14}"
+                       for column in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Microbenchmark of the TaskQueue scheduler core.
+
+Queues N hour jobs on a TaskQueue whose tasks complete after a few polls without calling AWS,
+then measures the time spent in one poll cycle of wait_for_completion (TaskQueue._poll),
+with the status refreshes and task starts running on the queue's executor like in a run.
+The per-poll time should stay flat as N grows.
+
+usage: python benchmarks/bench_task_queue.py [N ...]
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "..", "app"))
+
+from task_queue import TaskQueue  # noqa: E402
+
+MAX_QUERIES = 4
+POLLS_TO_COMPLETE = 3
+MEASURED_POLLS = 200
+
+
+class BenchQueue(TaskQueue):
+    def _trigger_task(self, task):
+        task.id = task.sequence
+        task.polls = 0
+
+    def _update_task_status(self, task):
+        task.polls += 1
+        task.is_complete = task.polls >= POLLS_TO_COMPLETE
+
+
+def bench(number_of_jobs):
+    queue = BenchQueue(MAX_QUERIES, sleep_seconds=0)
+    for i in range(number_of_jobs):
+        # every other hour job waits on a drop table task, like a parquet step
+        drop_task = queue.add_task("bench", 1, {}) if i % 2 else None
+        queue.add_task("bench", 1, {"hour": i % 24},
+                       depends_on=[drop_task] if drop_task else None)
+
+    async def polls():
+        started = time.perf_counter()
+        for _ in range(MEASURED_POLLS):
+            await queue._poll()
+        return time.perf_counter() - started
+
+    return asyncio.run(polls()) / MEASURED_POLLS * 1e6
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    sizes = [int(arg) for arg in sys.argv[1:]] or [
+        100, 1000, 10000, 50000]
+    print(f"{'hour jobs':>10} {'us per poll':>12}")
+    for size in sizes:
+        print(f"{size:>10} {bench(size):>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
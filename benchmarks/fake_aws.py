@@ -0,0 +1,182 @@
+"""
+In-process fakes of the athena and s3 clients, for benchmarks that must not call AWS.
+
+FakeAthena implements the operations AthenaClient uses (start/get/batch-get/stop query execution) and
+FakeS3 the operations S3 uses (get/put/list/delete objects). Query durations come from a distribution,
+failures and throttling are injected at given rates, and time is read from a VirtualClock so queries
+"run" for hours in no real time. Register them with lib.clients.register_client before creating
+AthenaClient and S3 objects.
+"""
+import datetime
+import itertools
+import math
+import random
+import threading
+from collections import Counter
+
+from botocore.exceptions import ClientError
+
+EPOCH = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def duration_distribution(spec, rng):
+    """
+    A function returning query durations in seconds, from a spec like
+        fixed:60            always 60 seconds
+        uniform:30,120      uniformly between 30 and 120 seconds
+        lognormal:60,0.5    log-normal with median 60 seconds and sigma 0.5
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(",") if value]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return lambda: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"unknown duration distribution {spec}")
+
+
+def _client_error(code, message, operation):
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class FakeAthena:
+    """
+    Queries succeed after a duration drawn from duration(), or fail with probability failure_rate.
+    Each call raises ThrottlingException with probability throttle_rate.
+    """
+
+    def __init__(self, clock, duration, failure_rate=0.0, throttle_rate=0.0, seed=0):
+        self.clock = clock
+        self.duration = duration
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.throttled = 0
+        self.queries = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def _call(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+            if self.rng.random() < self.throttle_rate:
+                self.throttled += 1
+                raise _client_error("ThrottlingException", "Rate exceeded", operation)
+
+    def start_query_execution(self, QueryString, QueryExecutionContext=None, ResultConfiguration=None, WorkGroup=None):
+        self._call("StartQueryExecution")
+        with self._lock:
+            query_id = f"query-{next(self._ids)}"
+            self.queries[query_id] = {"sql": QueryString,
+                                      "submitted": self.clock.monotonic(),
+                                      "duration": self.duration(),
+                                      "fails": self.rng.random() < self.failure_rate,
+                                      "stopped_at": None,
+                                      "output": (ResultConfiguration or {}).get("OutputLocation")}
+        return {"QueryExecutionId": query_id}
+
+    def _execution(self, query_id):
+        query = self.queries[query_id]
+        now = self.clock.monotonic()
+        elapsed = now - query["submitted"]
+        if query["stopped_at"] is not None:
+            state = "CANCELLED"
+        elif elapsed < min(query["duration"], 1.0):
+            state = "QUEUED"
+        elif elapsed < query["duration"]:
+            state = "RUNNING"
+        else:
+            state = "FAILED" if query["fails"] else "SUCCEEDED"
+
+        status = {"State": state,
+                  "SubmissionDateTime": EPOCH + datetime.timedelta(seconds=query["submitted"])}
+        if state == "FAILED":
+            status["StateChangeReason"] = "injected failure"
+        statistics = {}
+        if state in ("SUCCEEDED", "FAILED"):
+            statistics = {"EngineExecutionTimeInMillis": int(query["duration"] * 1000),
+                          "DataScannedInBytes": int(query["duration"] * 1e7),
+                          "QueryQueueTimeInMillis": 0,
+                          "TotalExecutionTimeInMillis": int(query["duration"] * 1000)}
+        return {"QueryExecutionId": query_id, "Status": status, "Statistics": statistics,
+                "ResultConfiguration": {"OutputLocation": f"{query['output']}/{query_id}.csv"}}
+
+    def get_query_execution(self, QueryExecutionId):
+        self._call("GetQueryExecution")
+        return {"QueryExecution": self._execution(QueryExecutionId)}
+
+    def batch_get_query_execution(self, QueryExecutionIds):
+        self._call("BatchGetQueryExecution")
+        return {"QueryExecutions": [self._execution(query_id) for query_id in QueryExecutionIds],
+                "UnprocessedQueryExecutionIds": []}
+
+    def stop_query_execution(self, QueryExecutionId):
+        self._call("StopQueryExecution")
+        query = self.queries[QueryExecutionId]
+        if query["stopped_at"] is None and self.clock.monotonic() - query["submitted"] < query["duration"]:
+            query["stopped_at"] = self.clock.monotonic()
+        return {}
+
+
+class FakeS3:
+    """An in-memory bucket store, recording the number of calls and of bytes written"""
+
+    def __init__(self):
+        self.objects = {}
+        self.calls = Counter()
+        self.bytes_written = Counter()
+        self._lock = threading.Lock()
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.calls["GetObject"] += 1
+        with self._lock:
+            body = self.objects.get((Bucket, Key))
+        if body is None:
+            raise _client_error("NoSuchKey", "The specified key does not exist.", "GetObject")
+        etag = f'"{hash(body) & 0xffffffff:08x}"'
+        if IfNoneMatch == etag:
+            raise _client_error("304", "Not Modified", "GetObject")
+        return {"Body": _Body(body), "ETag": etag}
+
+    def put_object(self, Bucket, Key, Body):
+        self.calls["PutObject"] += 1
+        body = Body.encode("utf-8") if isinstance(Body, str) else bytes(Body)
+        with self._lock:
+            self.objects[(Bucket, Key)] = body
+            self.bytes_written[Key] += len(body)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None):
+        self.calls["ListObjectsV2"] += 1
+        with self._lock:
+            keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        page = keys[start:start + 1000]
+        response = {"Contents": [{"Key": key} for key in page]} if page else {}
+        if start + 1000 < len(keys):
+            response["NextContinuationToken"] = str(start + 1000)
+        return response
+
+    def delete_object(self, Bucket, Key):
+        self.calls["DeleteObject"] += 1
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        self.calls["DeleteObjects"] += 1
+        with self._lock:
+            for obj in Delete["Objects"]:
+                self.objects.pop((Bucket, obj["Key"]), None)
+        return {"Errors": []}
+
+
+class _Body:
+    def __init__(self, body):
+        self._body = body
+
+    def read(self):
+        return self._body
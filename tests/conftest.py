@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# the app modules import each other by name, like in the container, and the aws fakes live with the benchmarks
+sys.path.insert(0, os.path.join(ROOT, "app"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
@@ -0,0 +1,298 @@
+import datetime
+import json
+
+from fake_aws import FakeAthena, FakeS3
+from lib.clients import clear_clients, register_client
+import pytest
+
+from athena import AthenaClient, AthenaClientError, range_batching_error
+from clock import VirtualClock
+from control_data import ControlData
+from metrics import RunMetrics
+from s3 import S3
+import task_queue
+from task import Task
+from task_queue import FailedTasksException, PERMANENT, TRANSIENT
+
+REGION = "ap-southeast-2"
+BUCKET = "athena-runner-test"
+
+
+class SyntaxErrorAthena(FakeAthena):
+    """Every query ending with one of the given suffixes fails with a SYNTAX_ERROR, which is not retried"""
+
+    def __init__(self, clock, failing_suffixes):
+        super(SyntaxErrorAthena, self).__init__(clock, lambda: 60)
+        self.failing_suffixes = tuple(failing_suffixes)
+
+    def _execution(self, query_id):
+        execution = super(SyntaxErrorAthena, self)._execution(query_id)
+        if self.queries[query_id]["sql"].endswith(self.failing_suffixes) and \
+                execution["Status"]["State"] == "SUCCEEDED":
+            execution["Status"]["State"] = "FAILED"
+            execution["Status"]["StateChangeReason"] = "SYNTAX_ERROR: line 1:8: Column 'x' cannot be resolved"
+        return execution
+
+
+class ScriptedAthena(FakeAthena):
+    """Each query started runs for the next (seconds, fails) of the script"""
+
+    def __init__(self, clock, script):
+        super(ScriptedAthena, self).__init__(clock, lambda: 60)
+        self.script = list(script)
+
+    def start_query_execution(self, QueryString, **kwargs):
+        response = super(ScriptedAthena, self).start_query_execution(QueryString, **kwargs)
+        query = self.queries[response["QueryExecutionId"]]
+        query["duration"], query["fails"] = self.script.pop(0)
+        return response
+
+
+def control(pending_hours, history_days=0):
+    """
+    A control file ending yesterday, with the last pending_hours hours of yesterday pending and the others SUCCEEDED.
+    The history_days days before have every hour SUCCEEDED in 60 seconds.
+    """
+    days = [datetime.date.today() - datetime.timedelta(days=days_ago) for days_ago in range(history_days + 1, 0, -1)]
+    return {"datelist": [{"year": str(day.year), "month": str(day.month).zfill(2), "day": str(day.day).zfill(2),
+                          "hourlist": [{"hour": hour, "queryid": "",
+                                        "state": "" if last and hour >= 24 - pending_hours else "SUCCEEDED",
+                                        "dataScannedInBytes": None, "runTimeInMillis": None if last else 60000,
+                                        "startTime": None, "workgroup": None}
+                                       for hour in range(24)]}
+                         for last, day in ((index == history_days, day) for index, day in enumerate(days))]}
+
+
+def test_failed_hour_does_not_fail_the_next_hours_of_a_shared_table():
+    clock = VirtualClock()
+    athena = SyntaxErrorAthena(clock, ["hour = 20"])
+    clear_clients()
+    register_client("athena", REGION, athena)
+    register_client("s3", REGION, FakeS3())
+
+    config = {"database": "default", "workgroup": "primary", "resultsLocation": f"s3://{BUCKET}/results/",
+              # no day is appended to the control file of yesterday
+              "controlBucket": BUCKET, "controlKey": "test/control.json", "controlDays": "-2",
+              "appendHours": "true", "parquet": "true", "dropTableName": "shared_table"}
+    control_data = ControlData(control(6), config)
+    client = AthenaClient(db=config["database"], max_queries=3, max_retries=3, timeout_minutes=600,
+                          sleep_seconds=10, workgroup=config["workgroup"], control_s3=S3(bucket=BUCKET),
+                          control_key=config["controlKey"], control_data=control_data, clock=clock)
+    for hour_job in control_data.pending_hour_jobs():
+        client.add_query(config, "select * from t where dt = '<date>' and hour = <hour>", hour_job)
+
+    try:
+        client.wait_for_completion()
+    except FailedTasksException:
+        pass
+    else:
+        raise AssertionError("the failed hour should fail the run")
+    finally:
+        clear_clients()
+
+    states = {hour_job["hour"]: hour_job["state"] for hour_job in control_data.date_list[0]["hourlist"][18:]}
+    assert states == {18: "SUCCEEDED", 19: "SUCCEEDED", 20: "FAILED", 21: "SUCCEEDED", 22: "SUCCEEDED",
+                      23: "SUCCEEDED"}
+    # the hours of the table still ran one after the other, each after the drop of the table
+    ctas_and_drops = [query["sql"].split()[0] for query in athena.queries.values()]
+    assert ctas_and_drops == ["DROP", "CREATE"] * 6
+
+
+def run_hedged(script):
+    """Runs the last hour of yesterday, with a 60 seconds history, on a ScriptedAthena"""
+    clock = VirtualClock()
+    athena = ScriptedAthena(clock, script)
+    clear_clients()
+    register_client("athena", REGION, athena)
+    register_client("s3", REGION, FakeS3())
+
+    config = {"database": "default", "workgroup": "primary", "resultsLocation": f"s3://{BUCKET}/results/",
+              "controlBucket": BUCKET, "controlKey": "test/control.json", "controlDays": "-2", "appendHours": "true"}
+    control_data = ControlData(control(1, history_days=3), config)
+    metrics = RunMetrics(config["controlKey"], clock)
+    client = AthenaClient(db=config["database"], max_queries=2, max_retries=3, timeout_minutes=600,
+                          sleep_seconds=10, workgroup=config["workgroup"], control_s3=S3(bucket=BUCKET),
+                          control_key=config["controlKey"], control_data=control_data, clock=clock,
+                          hedge_percentile=90, hedge_factor=2, metrics=metrics)
+    for hour_job in control_data.pending_hour_jobs():
+        client.add_query(config, "select * from t where dt = '<date>' and hour = <hour>", hour_job)
+    try:
+        client.wait_for_completion()
+    finally:
+        clear_clients()
+    return athena, control_data.date_list[-1]["hourlist"][23], metrics
+
+
+def test_duplicate_finishing_first_is_kept_and_recorded_once():
+    athena, hour_job, metrics = run_hedged([(1000, False), (60, False)])
+
+    assert hour_job["state"] == "SUCCEEDED"
+    assert hour_job["queryid"] == "query-1"
+    assert athena.queries["query-0"]["stopped_at"] is not None
+    # the duplicate writes to the output location of the hour
+    assert athena.queries["query-1"]["output"] == athena.queries["query-0"]["output"]
+    assert [record["queryId"] for record in metrics.queries.values()] == ["query-1"]
+
+
+def test_duplicate_decides_the_outcome_when_the_query_fails_first():
+    athena, hour_job, metrics = run_hedged([(300, True), (400, False)])
+
+    assert hour_job["state"] == "SUCCEEDED"
+    assert hour_job["queryid"] == "query-1"
+    # the failed query is not retried
+    assert len(athena.queries) == 2
+    assert [(record["queryId"], record["state"]) for record in metrics.queries.values()] == [("query-1", "SUCCEEDED")]
+
+
+def run_resumed(athena, control_data, config, timeout_minutes=600):
+    """Runs the pending hours of the control data in resume mode, re-attaching to the queries in flight"""
+    register_client("athena", REGION, athena)
+    register_client("s3", REGION, FakeS3())
+    client = AthenaClient(db=config["database"], max_queries=2, max_retries=3, timeout_minutes=timeout_minutes,
+                          sleep_seconds=10, workgroup=config["workgroup"], control_s3=S3(bucket=BUCKET),
+                          control_key=config["controlKey"], control_data=control_data, clock=athena.clock,
+                          resume=True)
+    for hour_range in control_data.pending_hour_ranges(1, keep_in_flight=True):
+        client.add_range_query(config, "select * from t where dt = '<date>' and hour = <hour>", hour_range,
+                               attach=control_data.in_flight(hour_range[0][1]))
+    try:
+        client.wait_for_completion()
+    finally:
+        clear_clients()
+
+
+RESUME_CONFIG = {"database": "default", "workgroup": "primary", "resultsLocation": f"s3://{BUCKET}/results/",
+                 "controlBucket": BUCKET, "controlKey": "test/control.json", "controlDays": "-2",
+                 "appendHours": "true"}
+
+
+def test_run_stopped_early_leaves_its_query_running_for_the_next_run(monkeypatch):
+    monkeypatch.setattr(task_queue.slackbot, "warn", lambda message: None)
+    clock = VirtualClock()
+    athena = ScriptedAthena(clock, [(7200, False)])
+    control_data = ControlData(control(1), RESUME_CONFIG)
+
+    run_resumed(athena, control_data, RESUME_CONFIG, timeout_minutes=1)
+
+    hour_job = control_data.date_list[-1]["hourlist"][23]
+    assert (hour_job["queryid"], hour_job["state"]) == ("query-0", "RUNNING")
+    assert athena.queries["query-0"]["stopped_at"] is None
+
+    # the next run reads the control file written by this one
+    control_data = ControlData(json.loads(control_data.to_json()), RESUME_CONFIG)
+    run_resumed(athena, control_data, RESUME_CONFIG)
+
+    hour_job = control_data.date_list[-1]["hourlist"][23]
+    assert (hour_job["queryid"], hour_job["state"]) == ("query-0", "SUCCEEDED")
+    assert list(athena.queries) == ["query-0"]
+
+
+def test_queries_in_flight_are_re_attached_and_the_other_hours_started():
+    clock = VirtualClock()
+    athena = ScriptedAthena(clock, [(600, False), (600, False), (60, False)])
+    in_flight = athena.start_query_execution("select * from t where dt = 'yesterday' and hour >= 20")["QueryExecutionId"]
+    control_dict = control(4)
+    for hour_job in control_dict["datelist"][-1]["hourlist"][20:22]:
+        hour_job.update(queryid=in_flight, state="RUNNING")
+    control_data = ControlData(control_dict, RESUME_CONFIG)
+
+    run_resumed(athena, control_data, RESUME_CONFIG)
+
+    hour_jobs = control_data.date_list[-1]["hourlist"][20:]
+    assert [(hour_job["queryid"], hour_job["state"]) for hour_job in hour_jobs] == [
+        ("query-0", "SUCCEEDED"), ("query-0", "SUCCEEDED"), ("query-1", "SUCCEEDED"), ("query-2", "SUCCEEDED")]
+    # the two hours of the query in flight were re-attached together, not started again
+    assert len(athena.queries) == 3
+
+
+def test_re_attached_table_query_that_fails_drops_its_table_before_the_retry():
+    clock = VirtualClock()
+    athena = ScriptedAthena(clock, [(300, True), (60, False), (60, False)])
+    config = dict(RESUME_CONFIG, parquet="true", dropTableName="shared_table")
+    in_flight = athena.start_query_execution("CREATE TABLE shared_table AS select 1")["QueryExecutionId"]
+    control_dict = control(1)
+    control_dict["datelist"][-1]["hourlist"][23].update(queryid=in_flight, state="RUNNING")
+    control_data = ControlData(control_dict, config)
+
+    run_resumed(athena, control_data, config)
+
+    hour_job = control_data.date_list[-1]["hourlist"][23]
+    assert (hour_job["queryid"], hour_job["state"]) == ("query-2", "SUCCEEDED")
+    assert [query["sql"].split()[0] for query in athena.queries.values()] == ["CREATE", "DROP", "CREATE"]
+
+
+RANGE_SQL = "select * from t where (dt, hour) between ('<start_date>', <start_hour>) and ('<end_date>', <end_hour>)"
+
+
+def test_range_batching_needs_the_range_placeholders_and_partitioned_output():
+    partitioned = {"parquet": "true", "partition_by": "'dt', 'hour'"}
+
+    assert range_batching_error(partitioned, RANGE_SQL) is None
+    assert range_batching_error({}, "create table x with (partitioned_by = ARRAY['dt']) as " + RANGE_SQL) is None
+    assert range_batching_error(partitioned, "select * from t where dt = '<start_date>'") == \
+        "the sql template has no <start_hour>, <end_date>, <end_hour>"
+    assert range_batching_error({"parquet": "false", "partition_by": "'dt'"}, RANGE_SQL).startswith(
+        "the output is not partitioned")
+
+
+def test_range_query_runs_consecutive_hours_as_one_query():
+    clock = VirtualClock()
+    athena = ScriptedAthena(clock, [(60, False)] * 6)
+    clear_clients()
+    register_client("athena", REGION, athena)
+    register_client("s3", REGION, FakeS3())
+    config = dict(RESUME_CONFIG, parquet="true", partition_by="'dt', 'hour'")
+    control_dict = control(5)
+    # hour 21 already succeeded, the pending hours are 19-20 and 22-23
+    control_dict["datelist"][-1]["hourlist"][21]["state"] = "SUCCEEDED"
+    control_data = ControlData(control_dict, config)
+    client = AthenaClient(db=config["database"], max_queries=2, max_retries=3, timeout_minutes=600,
+                          sleep_seconds=10, workgroup=config["workgroup"], control_s3=S3(bucket=BUCKET),
+                          control_key=config["controlKey"], control_data=control_data, clock=clock)
+    hour_ranges = control_data.pending_hour_ranges(24)
+    with pytest.raises(AthenaClientError):
+        client.add_range_query(config, "select * from t where hour = <hour>", hour_ranges[0])
+    for hour_range in hour_ranges:
+        client.add_range_query(config, RANGE_SQL, hour_range)
+    try:
+        client.wait_for_completion()
+    finally:
+        clear_clients()
+
+    assert [[hour_job["hour"] for _, hour_job in hour_range] for hour_range in hour_ranges] == [[19, 20], [22, 23]]
+    # one temp table per range, dropped before and after its query
+    ctas = {query["sql"].split("between")[1]: query_id for query_id, query in athena.queries.items()
+            if query["sql"].startswith("CREATE")}
+    assert len(ctas) == 2 and len(athena.queries) == 6
+    date_string = control_data.date_string(control_data.date_list[-1])
+    first, second = ctas[f" ('{date_string}', 19) and ('{date_string}', 20)"], \
+        ctas[f" ('{date_string}', 22) and ('{date_string}', 23)"]
+    yesterday = control_data.date_list[-1]["hourlist"]
+    assert [(hour_job["queryid"], hour_job["state"]) for hour_job in yesterday[19:]] == [
+        (first, "SUCCEEDED"), (first, "SUCCEEDED"), ("", "SUCCEEDED"), (second, "SUCCEEDED"), (second, "SUCCEEDED")]
+    # each hour is charged half of the query
+    assert yesterday[19]["runTimeInMillis"] == 30000
+
+
+@pytest.mark.parametrize("error, error_class", [
+    ("ThrottlingException: Rate exceeded", TRANSIENT),
+    ("INTERNAL_ERROR_QUERY_ENGINE: Amazon Athena experienced an internal error", TRANSIENT),
+    ("injected failure", TRANSIENT),
+    ("SYNTAX_ERROR: line 1:8: Column 'x' cannot be resolved", PERMANENT),
+    ("EXCEEDED_TIME_LIMIT: Query exceeded maximum time limit", PERMANENT),
+    ("Query exhausted resources at this scale factor", PERMANENT),
+    ("Query timed out", PERMANENT),
+    # a permanent error is not retried even when it mentions a transient one
+    ("INTERNAL_ERROR: table default.t does not exist", PERMANENT),
+])
+def test_errors_are_classified_from_their_message(error, error_class):
+    clear_clients()
+    register_client("athena", REGION, FakeAthena(VirtualClock(), lambda: 60))
+    try:
+        client = AthenaClient(max_queries=1, control_data=None)
+    finally:
+        clear_clients()
+    task = Task("query", 1, {})
+    task.error = error
+
+    assert client._classify_error(task) == error_class
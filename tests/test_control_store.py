@@ -0,0 +1,163 @@
+import json
+
+from fake_aws import FakeS3
+from lib.clients import clear_clients, register_client
+from checkpoint import ControlCheckpointer
+from clock import VirtualClock
+from control_store import SegmentedControlStore
+from s3 import S3
+
+REGION = "ap-southeast-2"
+BUCKET = "athena-runner-test"
+CONTROL_KEY = "test/control.json"
+
+
+class DateListControlData:
+    """The part of ControlData the checkpointer uses"""
+
+    def __init__(self, date_list):
+        self.date_list = date_list
+
+    def to_json(self):
+        return json.dumps({"datelist": self.date_list})
+
+
+def day(date_string, states):
+    year, month, day_of_month = date_string.split("-")
+    return {"year": year, "month": month, "day": day_of_month,
+            "hourlist": [{"hour": hour, "queryid": "", "state": state} for hour, state in enumerate(states)]}
+
+
+def bucket():
+    fake_s3 = FakeS3()
+    clear_clients()
+    register_client("s3", REGION, fake_s3)
+    return fake_s3, S3(bucket=BUCKET)
+
+
+def keys(fake_s3, prefix):
+    return sorted(key for bucket_name, key in fake_s3.objects if key.startswith(prefix))
+
+
+def put_json(fake_s3, key, data):
+    fake_s3.put_object(Bucket=BUCKET, Key=key, Body=json.dumps(data))
+
+
+def get_json(fake_s3, key):
+    return json.loads(fake_s3.objects[(BUCKET, key)])
+
+
+def test_legacy_control_file_is_migrated_to_segments():
+    fake_s3, control_s3 = bucket()
+    date_list = [day("2024-01-31", ["SUCCEEDED"] * 2), day("2024-02-01", ["SUCCEEDED", ""])]
+    put_json(fake_s3, CONTROL_KEY, {"datelist": date_list})
+
+    store = SegmentedControlStore(control_s3, CONTROL_KEY)
+    assert store.load() == {"datelist": date_list}
+    assert store.needs_compaction and store.compaction_due
+
+    store.compact(date_list)
+    assert keys(fake_s3, "test/control/") == ["test/control/index.json", "test/control/segments/2024-01.json",
+                                              "test/control/segments/2024-02.json"]
+    assert get_json(fake_s3, "test/control/index.json") == {
+        "version": 1, "segments": ["2024-01", "2024-02"], "openSegments": ["2024-02"], "journalSeq": 0}
+    assert get_json(fake_s3, "test/control/segments/2024-01.json") == {"datelist": date_list[:1]}
+    assert not store.needs_compaction
+
+    # the next run reads the store and not the legacy file, January is finished and not read
+    assert SegmentedControlStore(control_s3, CONTROL_KEY).load() == {"datelist": date_list[1:]}
+
+
+def test_load_reads_only_open_segments_and_the_last_one():
+    fake_s3, control_s3 = bucket()
+    date_list = [day("2024-01-15", ["SUCCEEDED", ""]), day("2024-02-15", ["SUCCEEDED"] * 2),
+                 day("2024-03-15", ["SUCCEEDED"] * 2), day("2024-04-15", ["SUCCEEDED"] * 2)]
+    SegmentedControlStore(control_s3, CONTROL_KEY).compact(date_list)
+    fake_s3.calls.clear()
+
+    store = SegmentedControlStore(control_s3, CONTROL_KEY)
+    assert store.load() == {"datelist": [date_list[0], date_list[3]]}
+    # the index and the two segments, the closed segments of February and March are not read
+    assert fake_s3.calls["GetObject"] == 3
+    assert not store.needs_compaction
+
+
+def test_journal_of_an_interrupted_run_is_replayed_and_compacted():
+    fake_s3, control_s3 = bucket()
+    date_list = [day("2024-01-15", ["SUCCEEDED"] * 2), day("2024-02-15", ["SUCCEEDED"] * 2),
+                 day("2024-03-15", ["SUCCEEDED", ""])]
+    SegmentedControlStore(control_s3, CONTROL_KEY).compact(date_list)
+
+    # a run journals its changes and stops before compacting
+    interrupted = SegmentedControlStore(control_s3, CONTROL_KEY)
+    interrupted.load()
+    interrupted.append_journal([("2024-03-15", {"hour": 1, "queryid": "q1", "state": "FAILED"})])
+    interrupted.append_journal([("2024-03-15", {"hour": 1, "queryid": "q2", "state": "SUCCEEDED"}),
+                                # a change to a closed segment loads that segment
+                                ("2024-01-15", {"hour": 0, "queryid": "q3", "state": "FAILED"}),
+                                ("2024-03-16", {"hour": 0, "queryid": "q4", "state": "SUCCEEDED"})])
+    assert keys(fake_s3, "test/control/journal/") == ["test/control/journal/000000000001.json",
+                                                      "test/control/journal/000000000002.json"]
+
+    store = SegmentedControlStore(control_s3, CONTROL_KEY)
+    replayed = store.load()["datelist"]
+    assert [SegmentedControlStore.date_of(replayed_day) for replayed_day in replayed] == [
+        "2024-01-15", "2024-03-15", "2024-03-16"]
+    assert replayed[0]["hourlist"][0] == {"hour": 0, "queryid": "q3", "state": "FAILED"}
+    assert replayed[1]["hourlist"][1] == {"hour": 1, "queryid": "q2", "state": "SUCCEEDED"}
+    assert replayed[2]["hourlist"] == [{"hour": 0, "queryid": "q4", "state": "SUCCEEDED"}]
+    assert store.needs_compaction and store.last_seq == 2
+
+    store.compact(replayed)
+    assert keys(fake_s3, "test/control/journal/") == []
+    assert get_json(fake_s3, "test/control/index.json") == {
+        "version": 1, "segments": ["2024-01", "2024-02", "2024-03"], "openSegments": ["2024-01"], "journalSeq": 2}
+    assert get_json(fake_s3, "test/control/segments/2024-03.json") == {"datelist": replayed[1:]}
+    # the segment of February was not loaded and is left as it was
+    assert get_json(fake_s3, "test/control/segments/2024-02.json") == {"datelist": date_list[1:2]}
+
+
+def test_journal_entries_already_folded_into_the_segments_are_skipped():
+    fake_s3, control_s3 = bucket()
+    date_list = [day("2024-03-15", ["SUCCEEDED", ""])]
+    store = SegmentedControlStore(control_s3, CONTROL_KEY)
+    store.load()
+    store.append_journal([("2024-03-15", {"hour": 1, "queryid": "q1", "state": "FAILED"})])
+    # the compaction wrote the index but could not delete the journal entry
+    store.journal_keys = []
+    store.compact(date_list)
+
+    reloaded = SegmentedControlStore(control_s3, CONTROL_KEY)
+    assert reloaded.load() == {"datelist": date_list}
+    assert reloaded.journal_keys == [] and not reloaded.needs_compaction
+
+
+def test_checkpointer_journals_changes_and_compacts_on_the_forced_flush():
+    fake_s3, control_s3 = bucket()
+    put_json(fake_s3, CONTROL_KEY, {"datelist": [day("2024-03-15", ["SUCCEEDED", ""])]})
+    store = SegmentedControlStore(control_s3, CONTROL_KEY, compact_every=3)
+    control_data = DateListControlData(store.load()["datelist"])
+    checkpointer = ControlCheckpointer(control_data, control_s3, CONTROL_KEY, store=store, clock=VirtualClock())
+
+    hour_job = control_data.date_list[0]["hourlist"][1]
+    hour_job.update(queryid="q1", state="QUEUED")
+    checkpointer.mark_dirty("2024-03-15", hour_job)
+    # the migration of the legacy file is due, so the first checkpoint compacts
+    assert checkpointer.flush()
+    assert keys(fake_s3, "test/control/") == ["test/control/index.json", "test/control/segments/2024-03.json"]
+
+    hour_job.update(state="RUNNING")
+    checkpointer.mark_dirty("2024-03-15", hour_job)
+    hour_job.update(state="SUCCEEDED")
+    checkpointer.mark_dirty("2024-03-15", hour_job)
+    assert checkpointer.flush()
+    # the two changes of the same hour job are one journal change
+    assert get_json(fake_s3, "test/control/journal/000000000001.json") == {
+        "changes": [{"date": "2024-03-15", "job": {"hour": 1, "queryid": "q1", "state": "SUCCEEDED"}}]}
+    assert not checkpointer.flush()
+
+    # the end of the run folds the journal into the segments
+    assert checkpointer.flush(force=True)
+    assert keys(fake_s3, "test/control/journal/") == []
+    assert get_json(fake_s3, "test/control/index.json")["openSegments"] == []
+    assert checkpointer.uploads == 3
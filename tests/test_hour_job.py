@@ -0,0 +1,110 @@
+import datetime
+import json
+
+from fake_aws import FakeS3
+from lib.clients import clear_clients, register_client
+from checkpoint import ControlCheckpointer
+from clock import VirtualClock
+from control_data import ControlData
+from control_store import SegmentedControlStore
+from hour_job import HourJob, HourJobIndex, to_json_default
+from s3 import S3
+
+REGION = "ap-southeast-2"
+BUCKET = "athena-runner-test"
+CONTROL_KEY = "test/control.json"
+
+
+def test_hour_job_round_trips_the_control_file_dict():
+    job = {"hour": 7, "queryid": "q1", "state": "SUCCEEDED", "dataScannedInBytes": 1024, "runTimeInMillis": 60000,
+           "startTime": "2024-03-15 07:00:00", "workgroup": "primary", "comment": "rerun"}
+    hour_job = HourJob.from_dict("2024-03-15", job)
+
+    assert hour_job.to_dict() == job
+    assert json.loads(json.dumps(hour_job, default=to_json_default)) == job
+    assert hour_job["state"] == "SUCCEEDED" and hour_job.get("comment") == "rerun"
+    assert hour_job.get("missing") is None and "comment" in hour_job and "missing" not in hour_job
+
+    hour_job.update({"state": "FAILED", "queryid": "q2", "retries": 1})
+    assert hour_job.to_dict() == dict(job, state="FAILED", queryid="q2", retries=1)
+
+
+def test_hour_job_of_an_old_control_file_gets_the_missing_fields():
+    hour_job = HourJob.from_dict("2024-03-15", {"hour": 7, "state": None})
+
+    assert hour_job.to_dict() == {"hour": 7, "queryid": "", "state": "", "dataScannedInBytes": None,
+                                  "runTimeInMillis": None, "startTime": None, "workgroup": None}
+
+
+def test_index_follows_state_changes():
+    index = HourJobIndex()
+    done = HourJob("2024-03-15", 0, state="SUCCEEDED")
+    pending = HourJob("2024-03-15", 1)
+    index.add(done)
+    index.add(pending)
+
+    assert index.get("2024-03-15", "1") is pending
+    assert index.get("2024-03-15", 2) is None
+    assert index.in_state("SUCCEEDED") == {done}
+    assert index.not_in_state("SUCCEEDED") == [pending]
+
+    pending["state"] = "SUCCEEDED"
+    assert index.in_state("SUCCEEDED") == {done, pending}
+    assert index.not_in_state("SUCCEEDED") == []
+    assert index.in_state("RUNNING") == set()
+
+
+def test_index_keeps_every_hour_job_of_a_duplicated_hour():
+    index = HourJobIndex()
+    first = HourJob("2024-03-15", 7, state="SUCCEEDED")
+    second = HourJob("2024-03-15", 7)
+    index.add(first)
+    index.add(second)
+    index.add(second)
+
+    assert index.get_all("2024-03-15", 7) == [first, second]
+    assert index.get("2024-03-15", 7) is second
+    assert (first.occurrence, second.occurrence) == (0, 1)
+    assert index.not_in_state("SUCCEEDED") == [second]
+    assert HourJob("2024-03-15", 7).occurrence == 0
+
+
+def today_control(states):
+    now = datetime.datetime.now()
+    return {"datelist": [{"year": str(now.year), "month": str(now.month).zfill(2), "day": str(now.day).zfill(2),
+                          "hourlist": [{"hour": now.hour, "queryid": f"q{index}", "state": state}
+                                       for index, state in enumerate(states)]}]}
+
+
+def test_control_disabled_run_in_the_same_hour_keeps_the_duplicate_hour():
+    control_data = ControlData(today_control(["SUCCEEDED"]), {"controlDisabled": "true"})
+    day = control_data.date_list[-1]
+    date_string = ControlData.date_string(day)
+    first, second = day["hourlist"]
+
+    assert first["queryid"] == "q0" and second["queryid"] == ""
+    assert control_data.index.get_all(date_string, second["hour"]) == [first, second]
+    assert control_data.pending_hour_jobs() == [(date_string, second)]
+    assert control_data.appended_hour_jobs == [(date_string, second)]
+    assert json.loads(control_data.to_json())["datelist"][-1]["hourlist"] == [first.to_dict(), second.to_dict()]
+
+
+def test_duplicate_hours_are_journaled_and_replayed_separately():
+    fake_s3 = FakeS3()
+    clear_clients()
+    register_client("s3", REGION, fake_s3)
+    control_s3 = S3(bucket=BUCKET)
+    SegmentedControlStore(control_s3, CONTROL_KEY).compact(today_control(["SUCCEEDED", "FAILED"])["datelist"])
+
+    store = SegmentedControlStore(control_s3, CONTROL_KEY)
+    control_data = ControlData(store.load(), {"controlDisabled": "true"})
+    checkpointer = ControlCheckpointer(control_data, control_s3, CONTROL_KEY, store=store, clock=VirtualClock())
+    date_string, hour_job = control_data.pending_hour_jobs()[0]
+    hour_job.update({"queryid": "q1-rerun", "state": "SUCCEEDED"})
+    checkpointer.mark_dirty(date_string, hour_job)
+    assert checkpointer.flush()
+
+    # the run stops before compacting, the next run replays the journal
+    replayed = SegmentedControlStore(control_s3, CONTROL_KEY).load()["datelist"][-1]["hourlist"]
+    assert [(job["queryid"], job["state"]) for job in replayed] == [
+        ("q0", "SUCCEEDED"), ("q1-rerun", "SUCCEEDED"), ("", "")]
@@ -0,0 +1,78 @@
+import json
+import os
+
+from clock import VirtualClock
+from metrics import RunMetrics, percentile
+from task import Task
+
+
+def execution(query_id, state="SUCCEEDED", millis=1000, scanned=100):
+    return {"QueryExecutionId": query_id, "Status": {"State": state},
+            "Statistics": {"EngineExecutionTimeInMillis": millis, "DataScannedInBytes": scanned,
+                           "QueryQueueTimeInMillis": 10, "QueryPlanningTimeInMillis": 5}}
+
+
+def task(added_at, started_at, retries=0):
+    task = Task("config", 1, {"hour_jobs": [("2024-03-15", {"hour": 7})]})
+    task.added_at, task.started_at, task.retries = added_at, started_at, retries
+    return task
+
+
+def test_percentile_is_the_nearest_rank():
+    values = list(range(1, 101))
+
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile([3, None, 1, 2], 50) == 2
+    assert percentile([7], 99) == 7
+    assert percentile([None], 50) is None
+
+
+def test_summary_of_the_queries_of_a_step():
+    clock = VirtualClock()
+    metrics = RunMetrics("config/step1/control.json", clock)
+    metrics.record_poll(2, 4)
+    for index in range(10):
+        metrics.record_query(task(0, index, retries=index % 2), execution(f"q{index}", millis=1000 * (index + 1)))
+    metrics.record_query(task(0, 0), execution("failed", state="FAILED", millis=None, scanned=50))
+    clock.advance(10)
+    metrics.record_poll(4, 4)
+    clock.advance(10)
+    metrics.record_poll(0, 4)
+
+    summary = metrics.summary()
+
+    assert (summary["config"], summary["step"]) == ("config", "config/step1/control.json")
+    assert (summary["queries"], summary["succeeded"], summary["retries"]) == (11, 10, 5)
+    assert summary["EngineExecutionTimeInMillis"] == {"p50": 5000, "p95": 10000, "p99": 10000}
+    assert summary["waitMillis"]["p50"] == 4000
+    assert summary["submitToStartMillis"]["p99"] == 15
+    assert summary["DataScannedInBytes"]["total"] == 1050
+    assert summary["durationSeconds"] == 20
+    # 2 of 4 slots for 10 seconds, then 4 of 4
+    assert summary["slotOccupancy"] == 0.75
+    assert metrics.queries["q3"]["hours"] == ["2024-03-15 07"]
+
+
+def test_steps_of_a_config_write_their_own_reports(tmp_path):
+    reports = []
+    for step in ("config/step1/control.json", "config/step2/control.json"):
+        metrics = RunMetrics(step, VirtualClock())
+        metrics.record_query(task(0, 1), execution(step))
+        reports.append(metrics.write_report(str(tmp_path)))
+        metrics.write_prometheus(str(tmp_path))
+
+    assert [os.path.basename(report).split("-")[0] for report in reports] == [
+        "config_step1_control", "config_step2_control"]
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith(".prom")) == [
+        "athena_runner_config_step1_control.prom", "athena_runner_config_step2_control.prom"]
+    with open(reports[1]) as f:
+        assert json.load(f)["step"] == "config/step2/control.json"
+    with open(reports[1][:-len("-summary.json")] + ".jsonl") as f:
+        assert [json.loads(line)["queryId"] for line in f] == ["config/step2/control.json"]
+    with open(tmp_path / "athena_runner_config_step2_control.prom") as f:
+        prometheus = f.read()
+    assert 'athena_runner_queries{config="config",step="config/step2/control.json"} 1' in prometheus
+    assert 'athena_runner_query_wait_milliseconds{config="config",step="config/step2/control.json",quantile="0.5"} 1000' \
+        in prometheus
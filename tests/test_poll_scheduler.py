@@ -0,0 +1,34 @@
+from poll_scheduler import PollScheduler
+from task import Task
+
+
+def started_task(started_at, expected_seconds):
+    task = Task("task", 1, {})
+    task.started_at = started_at
+    task.expected_seconds = expected_seconds
+    return task
+
+
+def test_polls_when_a_task_is_expected_to_finish():
+    scheduler = PollScheduler(default_seconds=10, min_seconds=1, max_seconds=60)
+    assert scheduler.next_sleep([started_task(0, 4)], now=0) == 4
+    assert scheduler.next_sleep([started_task(0, 100)], now=0) == 10
+
+
+def test_late_tasks_back_off_up_to_max_seconds():
+    scheduler = PollScheduler(default_seconds=10, min_seconds=1, max_seconds=60, backoff=2)
+    task = started_task(0, 5)
+    sleeps = [scheduler.next_sleep([task], now=100) for _ in range(6)]
+    assert sleeps == [10, 20, 40, 60, 60, 60]
+
+
+def test_late_tasks_are_polled_every_default_seconds_while_tasks_wait_for_a_slot():
+    scheduler = PollScheduler(default_seconds=10, min_seconds=1, max_seconds=60, backoff=2)
+    task = started_task(0, 5)
+    assert [scheduler.next_sleep([task], now=100, waiting=True) for _ in range(3)] == [10, 10, 10]
+
+
+def test_backoff_of_one_polls_late_tasks_every_default_seconds():
+    scheduler = PollScheduler(default_seconds=10, min_seconds=1, max_seconds=60, backoff=1)
+    task = started_task(0, 5)
+    assert [scheduler.next_sleep([task], now=100) for _ in range(3)] == [10, 10, 10]
@@ -0,0 +1,83 @@
+import types
+
+import query_slots
+from query_slots import FairQuerySlots, QuerySlots
+
+
+def test_query_slots_are_shared_up_to_the_budget():
+    slots = QuerySlots(2)
+
+    assert slots.try_acquire("a") and slots.try_acquire("b")
+    assert not slots.try_acquire("a")
+    slots.release("b")
+    assert slots.try_acquire("a")
+
+
+def test_free_slot_goes_to_the_waiting_config_with_the_smallest_weighted_share():
+    slots = FairQuerySlots(4)
+    heavy = slots.account("heavy", weight=3)
+    light = slots.account("light", weight=1)
+
+    for _ in range(4):
+        assert heavy.try_acquire(None)
+    # light is refused by the budget and waits
+    assert not light.try_acquire(None)
+
+    heavy.release(None)
+    # heavy has 3 slots for weight 3, light 0 for weight 1: the free slot is kept for light
+    assert not heavy.try_acquire(None)
+    assert light.try_acquire(None)
+
+    heavy.release(None)
+    # light now has 1 slot for weight 1 and heavy 2 for weight 3, heavy gets the next one
+    assert not light.try_acquire(None)
+    assert heavy.try_acquire(None)
+    assert (heavy.in_use, light.in_use, slots.in_use) == (3, 1, 4)
+
+
+def test_config_at_its_own_limit_does_not_wait_for_a_shared_slot():
+    slots = FairQuerySlots(4)
+    limited = slots.account("limited", max_queries=1)
+    other = slots.account("other")
+
+    assert limited.try_acquire(None)
+    assert not limited.try_acquire(None)
+    for _ in range(3):
+        assert other.try_acquire(None)
+    assert slots.in_use == 4
+
+    other.release(None)
+    # limited was refused by its own limit, so other is not held back
+    assert other.try_acquire(None)
+
+
+def test_idle_config_stops_holding_back_the_others(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(query_slots, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    slots = FairQuerySlots(2, waiting_seconds=60)
+    busy = slots.account("busy")
+    idle = slots.account("idle")
+
+    assert busy.try_acquire(None) and busy.try_acquire(None)
+    assert not idle.try_acquire(None)
+    busy.release(None)
+    # idle asked 30 seconds ago and still has priority
+    now[0] = 30
+    assert not busy.try_acquire(None)
+
+    # idle has not asked for 61 seconds
+    now[0] = 61
+    assert busy.try_acquire(None)
+
+
+def test_done_config_is_forgotten():
+    slots = FairQuerySlots(2)
+    first = slots.account("first")
+    second = slots.account("second")
+
+    assert first.try_acquire(None) and first.try_acquire(None)
+    assert not second.try_acquire(None)
+    first.release(None)
+    second.done()
+
+    assert first.try_acquire(None)
@@ -0,0 +1,102 @@
+import json
+import types
+
+import pytest
+
+from fake_aws import FakeS3
+from lib.clients import clear_clients, register_client
+import result_cache
+from result_cache import ResultCache
+from s3 import S3
+
+REGION = "ap-southeast-2"
+BUCKET = "athena-runner-test"
+CACHE_KEY = "test/result_cache.json"
+
+
+@pytest.fixture
+def now(monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr(result_cache, "time", types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+@pytest.fixture
+def fake_s3():
+    fake_s3 = FakeS3()
+    clear_clients()
+    register_client("s3", REGION, fake_s3)
+    return fake_s3
+
+
+def execution(query_id, output=True, fake_s3=None):
+    location = f"s3://{BUCKET}/results/{query_id}.csv"
+    if output:
+        fake_s3.put_object(Bucket=BUCKET, Key=f"results/{query_id}.csv", Body="a,b")
+    return {"QueryExecutionId": query_id, "ResultConfiguration": {"OutputLocation": location},
+            "Statistics": {"DataScannedInBytes": 10, "EngineExecutionTimeInMillis": 20}}
+
+
+def test_entries_are_reused_until_they_expire(now, fake_s3):
+    cache = ResultCache(S3(bucket=BUCKET), CACHE_KEY, ttl_seconds=60).load()
+    key = ResultCache.cache_key("select 1", "default", "primary", f"s3://{BUCKET}/results/")
+    assert cache.lookup(key) is None
+
+    cache.record(key, execution("q1", fake_s3=fake_s3))
+    now[0] += 60
+    assert cache.lookup(key)["queryId"] == "q1"
+    now[0] += 1
+    assert cache.lookup(key) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_entry_whose_output_was_deleted_is_not_reused(now, fake_s3):
+    cache = ResultCache(S3(bucket=BUCKET), CACHE_KEY).load()
+    cache.record("kept", execution("q1", fake_s3=fake_s3))
+    cache.record("deleted", execution("q2", output=False, fake_s3=fake_s3))
+
+    assert cache.lookup("kept")["outputLocation"] == f"s3://{BUCKET}/results/q1.csv"
+    assert cache.lookup("deleted") is None
+
+
+def test_cache_key_depends_on_the_query_and_where_it_runs():
+    key = ResultCache.cache_key("select 1", "default", "primary", "s3://b/results/")
+
+    assert key == ResultCache.cache_key("select 1", "default", "primary", "s3://b/results/")
+    assert key != ResultCache.cache_key("select 2", "default", "primary", "s3://b/results/")
+    assert key != ResultCache.cache_key("select 1", "default", "other", "s3://b/results/")
+    assert key != ResultCache.cache_key("select 1", "default", "primary", "s3://b/other/")
+
+
+def test_save_keeps_the_most_recent_entries_and_those_of_other_runs(now, fake_s3):
+    other_run = ResultCache(S3(bucket=BUCKET), CACHE_KEY, max_entries=3).load()
+    this_run = ResultCache(S3(bucket=BUCKET), CACHE_KEY, max_entries=3).load()
+
+    other_run.record("expired", execution("q0", fake_s3=fake_s3))
+    assert other_run.save()
+    now[0] += 86401
+    for index in range(1, 4):
+        now[0] += 1
+        (this_run if index % 2 else other_run).record(f"key{index}", execution(f"q{index}", fake_s3=fake_s3))
+    assert other_run.save()
+    now[0] += 1
+    this_run.record("key4", execution("q4", fake_s3=fake_s3))
+
+    assert this_run.save()
+    assert not this_run.save()
+    saved = json.loads(fake_s3.objects[(BUCKET, CACHE_KEY)])["entries"]
+    # the expired entry is dropped, and the oldest fresh one is evicted past max_entries
+    assert sorted(saved) == ["key2", "key3", "key4"]
+    assert sorted(ResultCache(S3(bucket=BUCKET), CACHE_KEY, max_entries=3).load().entries) == ["key2", "key3", "key4"]
+
+
+def test_failed_save_keeps_the_entries_for_the_next_one(now, fake_s3, monkeypatch):
+    cache = ResultCache(S3(bucket=BUCKET), CACHE_KEY).load()
+    cache.record("key1", execution("q1", fake_s3=fake_s3))
+    put_bytes = cache.s3.put_bytes
+    monkeypatch.setattr(cache.s3, "put_bytes", lambda body, key: False)
+
+    assert not cache.save()
+    monkeypatch.setattr(cache.s3, "put_bytes", put_bytes)
+    assert cache.save()
+    assert list(json.loads(fake_s3.objects[(BUCKET, CACHE_KEY)])["entries"]) == ["key1"]
@@ -0,0 +1,69 @@
+from clock import VirtualClock
+from scan_budget import ScanBudget
+from task import Task
+
+
+def task(expected_bytes):
+    task = Task(f"query of {expected_bytes} bytes", 1, {})
+    task.expected_bytes = expected_bytes
+    return task
+
+
+def test_queries_are_admitted_while_the_bytes_in_flight_fit():
+    budget = ScanBudget(max_bytes_in_flight=100)
+    first, second, third = task(60), task(40), task(1)
+
+    assert budget.try_admit(first) and budget.try_admit(second)
+    assert not budget.try_admit(third)
+    assert budget.bytes_in_flight == 100
+
+    budget.release(first)
+    assert budget.try_admit(third)
+    assert budget.bytes_in_flight == 41
+
+
+def test_release_only_counts_admitted_queries_once():
+    budget = ScanBudget(max_bytes_in_flight=100)
+    admitted, refused = task(80), task(30)
+    assert budget.try_admit(admitted)
+    assert not budget.try_admit(refused)
+
+    budget.release(refused)
+    assert budget.bytes_in_flight == 80
+    budget.release(admitted)
+    budget.release(admitted)
+    assert budget.bytes_in_flight == 0
+
+
+def test_query_bigger_than_the_budget_runs_alone():
+    budget = ScanBudget(max_bytes_in_flight=100)
+    big, small = task(500), task(10)
+
+    assert budget.try_admit(big)
+    assert not budget.try_admit(small)
+    budget.release(big)
+    assert budget.try_admit(small)
+    assert not budget.try_admit(big)
+
+
+def test_queries_without_an_estimate_are_always_admitted():
+    budget = ScanBudget(max_bytes_in_flight=100)
+
+    assert budget.try_admit(task(100))
+    assert budget.try_admit(task(None)) and budget.try_admit(task(0))
+
+
+def test_window_limits_the_bytes_admitted_until_they_slide_out():
+    clock = VirtualClock()
+    budget = ScanBudget(max_bytes_per_window=100, window_seconds=3600, clock=clock)
+    first, second = task(70), task(40)
+
+    assert budget.try_admit(first)
+    # finished queries still count against the window
+    budget.release(first)
+    assert not budget.try_admit(second)
+
+    clock.advance(3600)
+    assert not budget.try_admit(second)
+    clock.advance(1)
+    assert budget.try_admit(second)
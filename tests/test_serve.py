@@ -0,0 +1,103 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import serve
+from serve import SpoolServer
+
+
+def drop_job(spool_dir, name, job):
+    with open(os.path.join(spool_dir, "incoming", name), "w") as f:
+        json.dump(job, f)
+
+
+def write_lease(path, owner, age_seconds=0):
+    with open(path + ".lease", "w") as f:
+        json.dump(owner, f)
+    renewed = time.time() - age_seconds
+    os.utime(path + ".lease", (renewed, renewed))
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_claimed_jobs_move_to_processing_with_a_lease(tmp_path):
+    server = SpoolServer(str(tmp_path), max_jobs=2)
+    for index, name in enumerate(["b.json", "a.json", "c.json", "notes.txt"]):
+        drop_job(str(tmp_path), name, {"config": "configs/prod.json"})
+        os.utime(tmp_path / "incoming" / name, (index, index))
+
+    claimed = server._claim_jobs(2)
+
+    # oldest first
+    assert [os.path.basename(path) for path in claimed] == ["b.json", "a.json"]
+    assert sorted(os.listdir(tmp_path / "incoming")) == ["c.json", "notes.txt"]
+    for path in claimed:
+        with open(path + ".lease") as f:
+            assert json.load(f) == server.owner
+        assert not server._owner_gone(path)
+
+
+def test_jobs_of_a_dead_server_on_this_host_are_requeued(tmp_path):
+    server = SpoolServer(str(tmp_path))
+    dead = str(tmp_path / "processing" / "dead.json")
+    alive = str(tmp_path / "processing" / "alive.json")
+    for path, pid in ((dead, dead_pid()), (alive, os.getppid())):
+        with open(path, "w") as f:
+            json.dump({"config": "configs/prod.json"}, f)
+        write_lease(path, {"host": server.owner["host"], "pid": pid})
+
+    server._requeue_interrupted_jobs()
+
+    assert os.listdir(tmp_path / "incoming") == ["dead.json"]
+    assert sorted(os.listdir(tmp_path / "processing")) == ["alive.json", "alive.json.lease"]
+
+
+def test_jobs_of_another_host_are_requeued_once_the_lease_expires(tmp_path):
+    server = SpoolServer(str(tmp_path), poll_seconds=5, lease_seconds=60)
+    owner = {"host": server.owner["host"] + "-other", "pid": server.owner["pid"]}
+    expired = str(tmp_path / "processing" / "expired.json")
+    renewed = str(tmp_path / "processing" / "renewed.json")
+    for path, age_seconds in ((expired, 61), (renewed, 59)):
+        with open(path, "w") as f:
+            json.dump({"config": "configs/prod.json"}, f)
+        write_lease(path, owner, age_seconds)
+
+    server._requeue_interrupted_jobs()
+
+    assert os.listdir(tmp_path / "incoming") == ["expired.json"]
+    assert sorted(os.listdir(tmp_path / "processing")) == ["renewed.json", "renewed.json.lease"]
+
+
+def test_renewing_a_lease_keeps_the_job(tmp_path):
+    server = SpoolServer(str(tmp_path), lease_seconds=60)
+    drop_job(str(tmp_path), "job.json", {"config": "configs/prod.json"})
+    path, = server._claim_jobs(1)
+    write_lease(path, dict(server.owner, host=server.owner["host"] + "-other"), age_seconds=120)
+    assert server._owner_gone(path)
+
+    server._renew_lease(path)
+
+    assert not server._owner_gone(path)
+
+
+def test_job_without_config_fails_and_releases_its_lease(tmp_path, monkeypatch):
+    warnings = []
+    monkeypatch.setattr(serve.slackBot, "warn", warnings.append)
+    server = SpoolServer(str(tmp_path))
+    drop_job(str(tmp_path), "broken.json", {"overrides": {"maxQueries": "2"}})
+    path, = server._claim_jobs(1)
+
+    server.run_job(path)
+
+    assert os.listdir(tmp_path / "processing") == []
+    assert os.listdir(tmp_path / "failed") == ["broken.json"]
+    with open(tmp_path / "status.json") as f:
+        status = json.load(f)["broken"]
+    assert status["state"] == "FAILED" and status["error"] == "job broken has no config"
+    assert warnings == ["Job broken failed: job broken has no config"]
@@ -0,0 +1,87 @@
+import threading
+
+import pytest
+
+from step_scheduler import StepScheduler, StepSchedulerError
+
+
+def step(name, drop_table=None, depends_on=None):
+    step = {"name": name, "controlKey": f"config/{name}/control.json"}
+    if drop_table:
+        step["dropTableName"] = drop_table
+    if depends_on is not None:
+        step["dependsOn"] = depends_on
+    return step
+
+
+def test_dependencies_are_inferred_from_the_tables_of_earlier_steps():
+    steps = [step("load", "db.events"), step("daily", "db.daily"), step("report"), step("other")]
+    sqls = ["select 1", "select * from DB.EVENTS", "select * from db.daily join db.events_archive using (id)",
+            "select * from db.events_daily"]
+
+    scheduler = StepScheduler(steps, sqls)
+
+    assert scheduler.dependencies == {"load": set(), "daily": {"load"}, "report": {"daily"}, "other": set()}
+
+
+def test_depends_on_replaces_the_inferred_dependencies():
+    steps = [step("load", "events"), step("daily", depends_on=[]), step("report", depends_on="config/daily/control.json")]
+    steps[1].pop("name")
+
+    scheduler = StepScheduler(steps, ["", "select * from events", ""])
+
+    assert scheduler.dependencies == {"load": set(), "config/daily/control.json": set(),
+                                      "report": {"config/daily/control.json"}}
+
+
+def test_invalid_step_graphs_are_rejected():
+    with pytest.raises(StepSchedulerError, match="dependency cycle"):
+        StepScheduler([step("a", depends_on=["b"]), step("b", depends_on=["a"])], ["", ""])
+    with pytest.raises(StepSchedulerError, match="unknown step c"):
+        StepScheduler([step("a", depends_on=["c"])], [""])
+    with pytest.raises(StepSchedulerError, match="must be unique"):
+        StepScheduler([step("a"), step("a")], ["", ""])
+
+
+def test_one_step_at_a_time_stops_at_the_first_failure():
+    ran = []
+
+    def process_step(step, index):
+        ran.append(step["name"])
+        if step["name"] == "b":
+            raise ValueError("b failed")
+
+    scheduler = StepScheduler([step("a"), step("b"), step("c")], ["", "", ""])
+    with pytest.raises(ValueError, match="b failed"):
+        scheduler.run(process_step)
+
+    assert ran == ["a", "b"]
+
+
+def test_concurrent_steps_skip_the_dependants_of_a_failed_step():
+    ran = []
+    lock = threading.Lock()
+
+    def process_step(step, index):
+        with lock:
+            ran.append(step["name"])
+        if step["name"] == "load":
+            raise ValueError("load failed")
+
+    steps = [step("load", "events"), step("daily", "daily"), step("other"), step("report")]
+    scheduler = StepScheduler(steps, ["", "select * from events", "", "select * from daily"],
+                              max_concurrent_steps=2)
+    with pytest.raises(StepSchedulerError) as error:
+        scheduler.run(process_step)
+
+    assert sorted(ran) == ["load", "other"]
+    assert error.value.reason == {"load": "load failed", "daily": "skipped", "report": "skipped"}
+
+
+def test_independent_steps_run_at_the_same_time():
+    both_started = threading.Barrier(2, timeout=5)
+
+    def process_step(step, index):
+        both_started.wait()
+
+    StepScheduler([step("a"), step("b")], ["", ""], max_concurrent_steps=2).run(process_step)
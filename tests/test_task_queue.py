@@ -0,0 +1,53 @@
+import heapq
+
+import pytest
+
+from clock import VirtualClock
+from poll_scheduler import PollScheduler
+from task_queue import TaskQueue, FailedTasksException, PERMANENT
+
+
+class ScriptedQueue(TaskQueue):
+    """A queue whose tasks complete on their first poll, failing for good when their args say so"""
+
+    def __init__(self):
+        super(ScriptedQueue, self).__init__(2, retry_limit=0, timeout_minutes=1, sleep_seconds=0)
+        self.started = []
+
+    def _trigger_task(self, task):
+        task.id = task.sequence
+        self.started.append(task.arguments["name"])
+
+    def _update_task_status(self, task):
+        if task.arguments.get("fails"):
+            task.error = "failed"
+        else:
+            task.is_complete = True
+
+    def _classify_error(self, task):
+        return PERMANENT
+
+
+def test_runs_after_starts_once_a_failed_task_is_done():
+    queue = ScriptedQueue()
+    first = queue.add_task("first", 1, {"name": "first", "fails": True})
+    after = queue.add_task("after", 1, {"name": "after"}, runs_after=[first])
+    dependent = queue.add_task("dependent", 1, {"name": "dependent"}, depends_on=[first])
+
+    with pytest.raises(FailedTasksException):
+        queue.wait_for_completion()
+
+    assert queue.started == ["first", "after"]
+    assert after.error is None and after.is_complete
+    assert dependent.error is not None
+    assert queue.failed_tasks == [first, dependent]
+
+
+def test_sleep_before_a_retry_due_within_a_millisecond_is_not_zero():
+    queue = ScriptedQueue()
+    queue.poll_scheduler = PollScheduler(default_seconds=10)
+    queue.clock = VirtualClock(100.0)
+    task = queue.add_task("retried", 1, {"name": "retried"})
+    heapq.heappush(queue._backoff_heap, (100.00004, task.sequence, task))
+
+    assert queue._next_sleep_seconds(start_time=100.0) == 0.001